@@ -15,9 +15,32 @@
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
 from arch.models import MachineArchitecture, PackageArchitecture
+from util.cache import get_cached
 from util.logging import info_message
 
 
+def get_or_create_machine_arch(name):
+    """ Get or create a MachineArchitecture, using the ingestion cache if active
+        Returns the MachineArchitecture
+    """
+    name = str(name)
+    return get_cached(
+        'machinearchitecture', name,
+        lambda: MachineArchitecture.objects.get_or_create(name=name)[0],
+    )
+
+
+def get_or_create_package_arch(name):
+    """ Get or create a PackageArchitecture, using the ingestion cache if active
+        Returns the PackageArchitecture
+    """
+    name = str(name)
+    return get_cached(
+        'packagearchitecture', name,
+        lambda: PackageArchitecture.objects.get_or_create(name=name)[0],
+    )
+
+
 def clean_package_architectures():
     """ Remove package architectures that are no longer in use
     """
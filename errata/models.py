@@ -16,12 +16,15 @@
 
 import json
 
-from django.db import IntegrityError, models
+from django.db import models
+from django.db.models import Q
 from django.urls import reverse
 
 from errata.managers import ErratumManager
 from packages.models import Package, PackageUpdate
-from packages.utils import find_evr, get_matching_packages
+from packages.utils import (
+    find_evr, get_matching_packages, mark_security_updates,
+)
 from security.models import CVE, Reference
 from security.utils import get_or_create_cve, get_or_create_reference
 from util import get_url
@@ -64,34 +67,10 @@ class Erratum(models.Model):
 
     def scan_for_security_updates(self):
         if self.e_type == 'security':
-            for package in self.fixed_packages.all():
-                affected_updates = PackageUpdate.objects.filter(
-                    newpackage=package,
-                    security=False,
-                )
-                for affected_update in affected_updates:
-                    affected_update.security = True
-                    try:
-                        affected_update.save()
-                    except IntegrityError as e:
-                        error_message(text=e)
-                        # a version of this update already exists that is
-                        # marked as a security update, so delete this one
-                        affected_update.delete()
-            for package in self.affected_packages.all():
-                affected_updates = PackageUpdate.objects.filter(
-                    oldpackage=package,
-                    security=False,
-                )
-                for affected_update in affected_updates:
-                    affected_update.security = True
-                    try:
-                        affected_update.save()
-                    except IntegrityError as e:
-                        error_message(text=e)
-                        # a version of this update already exists that is
-                        # marked as a security update, so delete this one
-                        affected_update.delete()
+            affected_updates = PackageUpdate.objects.filter(
+                Q(newpackage__in=self.fixed_packages.all()) | Q(oldpackage__in=self.affected_packages.all()),
+            )
+            mark_security_updates(affected_updates)
 
     def fetch_osv_dev_data(self):
         osv_dev_url = f'https://api.osv.dev/v1/vulns/{self.name}'
@@ -18,43 +18,55 @@ from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
 
 from errata.models import Erratum
+from repos.utils import record_package_changes
+from util.counters import register_count, update_counts
+
+register_count(Erratum, 'affected_packages_count', 'affected_packages')
+register_count(Erratum, 'fixed_packages_count', 'fixed_packages')
+register_count(Erratum, 'osreleases_count', 'osreleases')
+register_count(Erratum, 'cves_count', 'cves')
+register_count(Erratum, 'references_count', 'references')
 
 
 @receiver(m2m_changed, sender=Erratum.affected_packages.through)
 def update_affected_packages_count(sender, instance, action, **kwargs):
     """Update affected_packages_count when Erratum.affected_packages M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.affected_packages_count = instance.affected_packages.count()
-        instance.save(update_fields=['affected_packages_count'])
+        update_counts(instance, 'affected_packages_count')
 
 
 @receiver(m2m_changed, sender=Erratum.fixed_packages.through)
 def update_fixed_packages_count(sender, instance, action, **kwargs):
     """Update fixed_packages_count when Erratum.fixed_packages M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.fixed_packages_count = instance.fixed_packages.count()
-        instance.save(update_fields=['fixed_packages_count'])
+        update_counts(instance, 'fixed_packages_count')
+
+
+@receiver(m2m_changed, sender=Erratum.fixed_packages.through)
+def record_fixed_packages_changes(sender, instance, action, reverse, pk_set, **kwargs):
+    """Record a change of the mirrors that contain a package when Erratum.fixed_packages M2M changes."""
+    if action in ('post_add', 'post_remove') and pk_set:
+        record_package_changes([instance.id] if reverse else pk_set)
+    elif action == 'pre_clear':
+        record_package_changes([instance.id] if reverse else instance.fixed_packages.values_list('id', flat=True))
 
 
 @receiver(m2m_changed, sender=Erratum.osreleases.through)
 def update_osreleases_count(sender, instance, action, **kwargs):
     """Update osreleases_count when Erratum.osreleases M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.osreleases_count = instance.osreleases.count()
-        instance.save(update_fields=['osreleases_count'])
+        update_counts(instance, 'osreleases_count')
 
 
 @receiver(m2m_changed, sender=Erratum.cves.through)
 def update_cves_count(sender, instance, action, **kwargs):
     """Update cves_count when Erratum.cves M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.cves_count = instance.cves.count()
-        instance.save(update_fields=['cves_count'])
+        update_counts(instance, 'cves_count')
 
 
 @receiver(m2m_changed, sender=Erratum.references.through)
 def update_references_count(sender, instance, action, **kwargs):
     """Update references_count when Erratum.references M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.references_count = instance.references.count()
-        instance.save(update_fields=['references_count'])
+        update_counts(instance, 'references_count')
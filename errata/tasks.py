@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+from functools import partial
+
 from celery import shared_task
 from django.core.cache import cache
 
@@ -26,6 +28,7 @@ from errata.sources.distros.ubuntu import update_ubuntu_errata
 from repos.models import Repository
 from security.tasks import update_cves, update_cwes
 from util import get_setting_of_type
+from util.counters import deferred_counts
 from util.logging import error_message, warning_message
 
 
@@ -51,40 +54,46 @@ def update_errata(erratum_type=None, force=False, repo=None):
 
     if cache.add(lock_key, 'true', lock_expire):
         try:
-            errata_os_updates = []
-            erratum_types = ['yum', 'rocky', 'alma', 'arch', 'ubuntu', 'debian', 'centos']
-            erratum_type_defaults = ['yum', 'rocky', 'alma', 'arch', 'ubuntu', 'debian']
-            if erratum_type:
-                if erratum_type not in erratum_types:
-                    error_message(text=f'Erratum type `{erratum_type}` not in {erratum_types}')
-                else:
-                    errata_os_updates = erratum_type
-            else:
-                errata_os_updates = get_setting_of_type(
-                    setting_name='ERRATA_OS_UPDATES',
-                    setting_type=list,
-                    default=erratum_type_defaults,
-                )
-            if 'yum' in errata_os_updates:
-                update_yum_repo_errata(repo_id=repo, force=force)
-            if 'arch' in errata_os_updates:
-                update_arch_errata()
-            if 'alma' in errata_os_updates:
-                update_alma_errata()
-            if 'rocky' in errata_os_updates:
-                update_rocky_errata()
-            if 'debian' in errata_os_updates:
-                update_debian_errata()
-            if 'ubuntu' in errata_os_updates:
-                update_ubuntu_errata()
-            if 'centos' in errata_os_updates:
-                update_centos_errata()
+            _update_errata(erratum_type, force, repo)
         finally:
             cache.delete(lock_key)
     else:
         warning_message('Already updating Errata, skipping task.')
 
 
+def _update_errata(erratum_type=None, force=False, repo=None):
+    """ Update errata from each of the enabled sources
+    """
+    errata_os_updates = []
+    erratum_types = ['yum', 'rocky', 'alma', 'arch', 'ubuntu', 'debian', 'centos']
+    erratum_type_defaults = ['yum', 'rocky', 'alma', 'arch', 'ubuntu', 'debian']
+    if erratum_type:
+        if erratum_type not in erratum_types:
+            error_message(text=f'Erratum type `{erratum_type}` not in {erratum_types}')
+        else:
+            errata_os_updates = erratum_type
+    else:
+        errata_os_updates = get_setting_of_type(
+            setting_name='ERRATA_OS_UPDATES',
+            setting_type=list,
+            default=erratum_type_defaults,
+        )
+    errata_sources = (
+        ('yum', partial(update_yum_repo_errata, repo_id=repo, force=force)),
+        ('arch', update_arch_errata),
+        ('alma', update_alma_errata),
+        ('rocky', update_rocky_errata),
+        ('debian', update_debian_errata),
+        ('ubuntu', update_ubuntu_errata),
+        ('centos', update_centos_errata),
+    )
+    for source, update_source_errata in errata_sources:
+        if source in errata_os_updates:
+            # recount the cached counts once per source rather than per change
+            with deferred_counts():
+                update_source_errata()
+
+
 @shared_task(priority=2)
 def update_errata_and_cves():
     """ Task to update all errata
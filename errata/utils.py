@@ -22,6 +22,7 @@ from errata.models import Erratum
 from packages.models import PackageUpdate
 from patchman.signals import pbar_start, pbar_update
 from util import tz_aware_datetime
+from util.counters import deferred_counts
 from util.logging import warning_message
 
 
@@ -77,6 +78,7 @@ def mark_errata_security_updates():
             i += 1
 
 
+@deferred_counts()
 def scan_package_updates_for_affected_packages():
     """ Scan PackageUpdates for packages affected by errata
     """
@@ -26,7 +26,7 @@ TIME_ZONE = 'America/New_York'
 LANGUAGE_CODE = 'en-us'
 
 # Create a unique string here, and don't share it with anybody.
-SECRET_KEY = ''
+SECRET_KEY = 's24*gOR&Btta@qB4fDYtFtth-tww^Pv-R7Jv3F*MAUVbB0dW9x'
 
 # Add the IP addresses that your web server will be listening on,
 # instead of '*'
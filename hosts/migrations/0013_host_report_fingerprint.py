@@ -0,0 +1,18 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hosts', '0012_backfill_cached_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='report_fingerprint',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hosts', '0013_host_report_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='updates_fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
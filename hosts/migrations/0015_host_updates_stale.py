@@ -0,0 +1,18 @@
+# Generated by Django 4.2.29 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hosts', '0014_host_updates_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='updates_stale',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -15,29 +15,30 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import hashlib
+import time
+from collections import defaultdict
+
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.urls import reverse
 from django.utils import timezone
-
-try:
-    from version_utils.rpm import labelCompare
-except ImportError:
-    from rpm import labelCompare
-
 from taggit.managers import TaggableManager
 
 from arch.models import MachineArchitecture
 from domains.models import Domain
 from errata.models import Erratum
-from hosts.utils import update_rdns
+from hosts.utils import add_update_timing, update_rdns
 from modules.models import Module
 from operatingsystems.models import OSVariant
-from packages.models import Package, PackageUpdate
-from packages.utils import get_or_create_package_update
-from repos.models import Repository
-from repos.utils import find_best_repo
-from util.logging import info_message
+from packages.kernels import DEB_KERNEL_PREFIXES, get_deb_kernel_flavour
+from packages.models import Package, PackageName, PackageUpdate
+from packages.utils import get_or_create_package_updates
+from packages.versions import get_version_key
+from repos.models import MirrorLatestPackage, MirrorPackage, Repository
+from repos.utils import get_best_repo_resolver
+from util import get_datetime_now
+from util.logging import debug_message, info_message
 
 
 class Host(models.Model):
@@ -65,6 +66,14 @@ class Host(models.Model):
     bug_updates_count = models.PositiveIntegerField(default=0, db_index=True)
     packages_count = models.PositiveIntegerField(default=0, db_index=True)
     errata_count = models.PositiveIntegerField(default=0, db_index=True)
+    # Fingerprint of the last processed report, used to skip unchanged reports
+    report_fingerprint = models.CharField(max_length=64, blank=True, null=True)
+    # Fingerprint of the package, repo and module sets, used to group hosts
+    # that will have the same updates
+    updates_fingerprint = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    # Whether the packages, repos or modules changed since the updates were
+    # last found in full, used to skip hosts in incremental update finding
+    updates_stale = models.BooleanField(default=True)
 
     from hosts.managers import HostManager
     objects = HostManager()
@@ -159,172 +168,358 @@ class Host(models.Model):
                   mirror__repo__enabled=True)
         return Package.objects.select_related('name', 'arch').filter(hostrepos_q).distinct()
 
-    def process_update(self, package, highest_package):
+    def get_host_repo_mirrors(self):
+        """ Returns the Mirrors that provide the packages returned by
+            get_host_repo_packages()
+        """
+        from repos.models import Mirror
         if self.host_repos_only:
-            host_repos = Q(repo__host=self)
+            mirrors_q = Q(repo__in=self.repos.all(),
+                          enabled=True,
+                          repo__enabled=True,
+                          repo__hostrepo__enabled=True)
         else:
-            host_repos = Q(repo__osrelease__osvariant__host=self, repo__arch=self.arch) | Q(repo__host=self)
-        mirrors = highest_package.mirror_set.filter(host_repos).select_related('repo')
-        security = False
-        # if any of the containing repos are security, mark the update as a security update
-        for mirror in mirrors:
-            if mirror.repo.security:
-                security = True
-        update = get_or_create_package_update(oldpackage=package, newpackage=highest_package, security=security)
-        self.updates.add(update)
-        info_message(text=f'{update}')
-        return update.id
-
-    def find_updates(self):
-
-        kernels_q = Q(name__name='kernel') | \
-            Q(name__name__startswith='kernel-') | \
-            Q(name__name__startswith='virtualbox-kmp-') | \
-            Q(name__name__startswith='linux-image-') | \
-            Q(name__name__startswith='linux-headers-') | \
-            Q(name__name__regex=r'^linux-modules-\d') | \
-            Q(name__name__regex=r'^linux-modules-extra-\d') | \
-            Q(name__name__startswith='linux-tools-') | \
-            Q(name__name__startswith='linux-cloud-tools-') | \
-            Q(name__name__startswith='linux-kbuild-') | \
-            Q(name__name__startswith='linux-support-') | \
-            Q(name__name='linux') | \
-            Q(name__name='linux-lts') | \
-            Q(name__name='linux-zen') | \
-            Q(name__name='linux-hardened') | \
-            Q(name__name='linux-rt') | \
-            Q(name__name='linux-rt-lts') | \
-            Q(name__name='linux-headers') | \
-            Q(name__name='linux-lts-headers') | \
-            Q(name__name='linux-zen-headers') | \
-            Q(name__name='linux-hardened-headers') | \
-            Q(name__name='linux-rt-headers') | \
-            Q(name__name='linux-rt-lts-headers')
-        repo_packages = self.get_host_repo_packages()
-        host_packages = self.packages.exclude(kernels_q).distinct()
-        kernel_packages = self.packages.filter(kernels_q)
+            mirrors_q = \
+                Q(repo__osrelease__osvariant__host=self,
+                  repo__arch=self.arch,
+                  enabled=True,
+                  repo__enabled=True) | \
+                Q(repo__in=self.repos.all(),
+                  enabled=True,
+                  repo__enabled=True)
+        return Mirror.objects.filter(mirrors_q).distinct()
+
+    def get_updatable_package_names(self, packages, get_key):
+        """ Uses the latest Package index of the host's mirrors to find the
+            names of installed packages that may have updates available.
+            Returns a list of PackageName ids, or None if any of the mirrors
+            has not been indexed yet.
+        """
+        mirrors = self.get_host_repo_mirrors()
+        if mirrors.filter(latest_packages_indexed=False).exists():
+            return None
+        latest_packages = defaultdict(list)
+        indexed = MirrorLatestPackage.objects.filter(
+            mirror__in=mirrors,
+            package__name__in={package.name_id for package in packages},
+        ).select_related('package')
+        for latest in indexed:
+            latest_packages[get_key(latest.package)].append(latest.package)
+        name_ids = set()
+        for package in packages:
+            for latest in latest_packages.get(get_key(package), []):
+                if package.compare_version(latest) == -1:
+                    name_ids.add(package.name_id)
+                    break
+        return list(name_ids)
 
-        errata_ids = set()
+    def get_updates_fingerprint(self):
+        """ Returns a fingerprint of the installed packages, repos and
+            modules of the host. Hosts that share this fingerprint and the
+            same arch, osvariant, kernel and host_repos_only setting will
+            have the same updates.
+        """
+        package_ids = sorted(self.packages.values_list('id', flat=True))
+        repos = sorted(HostRepo.objects.filter(host=self).values_list('repo_id', 'enabled', 'priority'))
+        module_ids = sorted(self.modules.values_list('id', flat=True))
+        data = f'packages:{package_ids}\nrepos:{repos}\nmodules:{module_ids}'
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def update_updates_fingerprint(self):
+        """ Recompute and save the updates fingerprint of the host
+        """
+        self.updates_fingerprint = self.get_updates_fingerprint()
+        self.save(update_fields=['updates_fingerprint'])
 
+    def _get_repo_mirrors_q(self):
+        """ Returns a Q object matching every Mirror that can provide
+            updates for this host, whether or not it is enabled
+        """
         if self.host_repos_only:
-            update_ids = self.find_host_repo_updates(host_packages, repo_packages, errata_ids)
-        else:
-            update_ids = self.find_osrelease_repo_updates(host_packages, repo_packages, errata_ids)
-
-        kernel_update_ids = self.find_kernel_updates(kernel_packages, repo_packages)
-        for ku_id in kernel_update_ids:
-            update_ids.append(ku_id)
+            return Q(repo__in=self.repos.all())
+        return Q(repo__osrelease__osvariant__host=self, repo__arch=self.arch) | \
+            Q(repo__in=self.repos.all())
 
-        for update in self.updates.all():
-            if update.id not in update_ids:
-                self.updates.remove(update)
+    def repos_changed_since(self, ts):
+        """ Returns True if the packages of any Mirror that can provide
+            updates for this host have changed since ts
+        """
+        from repos.models import Mirror
+        return Mirror.objects.filter(self._get_repo_mirrors_q(), packages_updated__gt=ts).exists()
+
+    def get_changed_package_names(self, ts):
+        """ Returns the set of PackageName ids that were added to or removed
+            from any Mirror that can provide updates for this host since ts.
+            The set contains None if any of the packages may have changed.
+            Timestamps only have a resolution of one second, so changes made
+            in the same second as ts are included.
+        """
+        from repos.models import Mirror, MirrorPackageChange
+        mirrors = Mirror.objects.filter(self._get_repo_mirrors_q()).values('id')
+        changes = MirrorPackageChange.objects.filter(mirror__in=mirrors, changed_at__gte=ts)
+        return set(changes.values_list('name_id', flat=True).distinct())
+
+    def get_security_package_ids(self, package_ids):
+        """ Returns the set of package_ids that are in any enabled security
+            repo of the host, found with one query
+        """
+        if self.host_repos_only:
+            host_repos = Q(mirror__repo__host=self)
+        else:
+            host_repos = Q(mirror__repo__osrelease__osvariant__host=self, mirror__repo__arch=self.arch) | \
+                Q(mirror__repo__host=self)
+        mirror_packages = MirrorPackage.objects.filter(
+            host_repos,
+            package__in=package_ids,
+            mirror__enabled=True,
+            mirror__repo__enabled=True,
+            mirror__repo__security=True,
+        )
+        return set(mirror_packages.values_list('package_id', flat=True))
+
+    def process_update(self, package, highest_package, add=True):
+        update_ids = self.process_updates([(package, highest_package)])
+        if not update_ids:
+            return
+        if add:
+            self.updates.add(*update_ids)
+        return update_ids[0]
+
+    def process_updates(self, updates):
+        """ Get or create the PackageUpdates for a list of (package,
+            highest_package) tuples with one bulk call. An update is a
+            security update if any of the host's repos that contain the
+            highest package is a security repo, which is looked up for all
+            of the updates at once.
+            Returns the list of PackageUpdate ids.
+        """
+        if not updates:
+            return []
+        start = time.monotonic()
+        security_ids = self.get_security_package_ids({highest_package.id for _, highest_package in updates})
+        seconds = time.monotonic() - start
+        add_update_timing('security_lookup', seconds)
+        debug_message(text=f'{self} : security lookup for {len(updates)} updates took {seconds:.4f}s')
+        update_ids = get_or_create_package_updates([
+            (package.id, highest_package.id, highest_package.id in security_ids)
+            for package, highest_package in updates
+        ])
+        ids = list(update_ids.values())
+        for update in PackageUpdate.objects.filter(id__in=ids).select_related(
+                'oldpackage__name', 'oldpackage__arch', 'newpackage__name', 'newpackage__arch'):
+            info_message(text=f'{update}')
+        return ids
+
+    def _apply_m2m_diff(self, relation, wanted_ids):
+        """ Make the members of one of the host's m2m relations equal to
+            wanted_ids, with at most one delete and one bulk insert.
+            m2m_changed is not sent, so the caller must update any cached
+            counts that depend on the relation.
+        """
+        manager = getattr(self, relation)
+        through = manager.through
+        target_field = manager.target_field_name
+        current_ids = set(manager.values_list('id', flat=True))
+        stale_ids = current_ids - wanted_ids
+        if stale_ids:
+            through.objects.filter(host=self, **{f'{target_field}__in': stale_ids}).delete()
+        new_ids = wanted_ids - current_ids
+        if new_ids:
+            through.objects.bulk_create(
+                [through(host=self, **{f'{target_field}_id': new_id}) for new_id in new_ids],
+                ignore_conflicts=True,
+            )
 
-        for erratum in self.errata.all():
-            if erratum.id not in errata_ids:
-                self.errata.remove(erratum)
+    def find_updates(self, name_ids=None):
+        """ Find the updates and errata for the host. If name_ids is given,
+            only the updates for those PackageName ids are re-evaluated,
+            together with the names fixed by the current errata of the host,
+            which may have been found through the given names. The other
+            updates of the host are kept as they are. Finding all updates
+            clears updates_stale.
+        """
+        if name_ids is None:
+            # clear the flag before reading the packages of the host, so that
+            # changes made while the updates are found mark it stale again
+            Host.objects.filter(id=self.id, updates_stale=True).update(updates_stale=False)
+            self.updates_stale = False
+            try:
+                self._find_updates()
+            except Exception:
+                Host.objects.filter(id=self.id).update(updates_stale=True)
+                self.updates_stale = True
+                raise
+        else:
+            self._find_updates(name_ids)
 
-    def find_host_repo_updates(self, host_packages, repo_packages, errata_ids):
+    def _find_updates(self, name_ids=None):
+        """ Find the updates and errata for the host, see find_updates()
+        """
+        ts = get_datetime_now()
+        repo_packages = self.get_host_repo_packages()
+        host_packages = self.packages.filter(name__kernel_family__isnull=True).distinct()
+        kernel_packages = self.packages.filter(name__kernel_family__isnull=False)
 
-        update_ids = []
+        errata_ids = set()
+        kept_update_ids = []
+        find_kernels = True
+        if name_ids is not None:
+            name_ids = set(name_ids)
+            errata_fixed_packages = Erratum.fixed_packages.through.objects.filter(erratum__host=self)
+            name_ids.update(errata_fixed_packages.values_list('package__name_id', flat=True))
+            find_kernels = PackageName.objects.filter(id__in=name_ids, kernel_family__isnull=False).exists()
+            host_packages = host_packages.filter(name__in=name_ids)
+            kept_updates = self.updates.exclude(oldpackage__name__in=name_ids)
+            if find_kernels:
+                kept_updates = kept_updates.filter(oldpackage__name__kernel_family__isnull=True)
+            kept_update_ids = list(kept_updates.values_list('id', flat=True))
+
+        get_best_repo = None
+        if self.host_repos_only:
+            get_best_repo = self.get_best_repo_resolver()
+            updates = self.find_host_repo_updates(host_packages, repo_packages, errata_ids, get_best_repo)
+        else:
+            updates = self.find_osrelease_repo_updates(host_packages, repo_packages, errata_ids)
+
+        if find_kernels:
+            updates.extend(self._find_kernel_updates(kernel_packages, repo_packages, get_best_repo))
+        update_ids = self.process_updates(updates)
+        update_ids.extend(kept_update_ids)
+
+        # apply the final update and errata sets as one diff per relation
+        # and recount the cached counts once
+        self._apply_m2m_diff('updates', set(update_ids))
+        self._apply_m2m_diff('errata', errata_ids)
+        counts = self.updates.aggregate(
+            sec_updates=Count('id', filter=Q(security=True)),
+            bug_updates=Count('id', filter=Q(security=False)),
+        )
+        self.sec_updates_count = counts['sec_updates']
+        self.bug_updates_count = counts['bug_updates']
+        self.errata_count = len(errata_ids)
+
+        self.updated_at = ts
+        self.save(update_fields=[
+            'updated_at', 'reboot_required', 'sec_updates_count', 'bug_updates_count', 'errata_count',
+        ])
+
+    def get_update_hostrepos(self):
+        """ Returns the HostRepos whose priorities are taken into account
+            when finding updates for a host_repos_only host
+        """
         hostrepos_q = Q(repo__mirror__enabled=True,
                         repo__mirror__refresh=True,
                         repo__mirror__repo__enabled=True,
                         host=self)
-        hostrepos = HostRepo.objects.select_related('host', 'repo').filter(hostrepos_q)
+        return HostRepo.objects.select_related('host', 'repo').filter(hostrepos_q)
+
+    def get_best_repo_resolver(self):
+        """ Returns a function that returns the best HostRepo of a Package
+            for this host. The HostRepos of all packages with the names of the
+            installed packages, and of all kernel packages, are loaded with
+            one query when it is first called.
+        """
+        packages = Package.objects.filter(
+            Q(name__in=self.packages.values('name')) | Q(name__kernel_family__isnull=False))
+        return get_best_repo_resolver(self.get_update_hostrepos(), packages)
+
+    def get_module_package_ids(self, package_ids):
+        """ Returns a tuple of the set of package_ids that belong to any
+            module, and the set of package_ids that belong to a module that
+            is enabled on the host. A package that belongs to a module is
+            only an eligible update if it is in both sets.
+        """
+        module_packages = Module.packages.through.objects.filter(package__in=package_ids)
+        module_gated_ids = set(module_packages.values_list('package_id', flat=True))
+        if not module_gated_ids:
+            return module_gated_ids, set()
+        module_enabled_ids = set(module_packages.filter(
+            module__in=self.modules.values('id')).values_list('package_id', flat=True))
+        return module_gated_ids, module_enabled_ids
+
+    def find_host_repo_updates(self, host_packages, repo_packages, errata_ids, get_best_repo=None):
+
+        if get_best_repo is None:
+            get_best_repo = self.get_best_repo_resolver()
+        repo_packages = repo_packages.exclude(version__startswith='9999')
+        return self._find_repo_updates(host_packages, repo_packages, errata_ids, get_best_repo)
+
+    def find_osrelease_repo_updates(self, host_packages, repo_packages, errata_ids):
+
+        return self._find_repo_updates(host_packages, repo_packages, errata_ids)
 
-        for package in host_packages:
+    def _find_repo_updates(self, host_packages, repo_packages, errata_ids, get_best_repo=None):
+        """ Find the highest eligible update for each installed package.
+            The installed packages, the candidate packages, their module
+            memberships, the errata they fix and the repos they are in are
+            loaded with a few set-based queries and compared in memory.
+            If get_best_repo is given, candidates are matched on category too
+            and repo priorities are taken into account, as for host_repos_only.
+        """
+        def get_key(p):
+            if get_best_repo is not None:
+                return (p.name_id, p.arch_id, p.packagetype, p.category_id)
+            return (p.name_id, p.arch_id, p.packagetype)
+
+        packages = list(host_packages)
+        if not packages:
+            return []
+        # only load candidates for names that the latest Package index shows
+        # may have updates available, or for all names if it is incomplete
+        host_names = self.get_updatable_package_names(packages, get_key)
+        if host_names is None:
+            host_names = host_packages.values('name')
+        candidates_qs = repo_packages.filter(name__in=host_names)
+
+        candidates = defaultdict(list)
+        for candidate in candidates_qs:
+            candidates[get_key(candidate)].append(candidate)
+
+        candidate_ids = candidates_qs.values('id')
+        module_gated_ids, module_enabled_ids = self.get_module_package_ids(candidate_ids)
+
+        package_errata = defaultdict(list)
+        fixed_packages = Erratum.fixed_packages.through.objects.filter(package__in=candidate_ids)
+        for package_id, erratum_id in fixed_packages.values_list('package_id', 'erratum_id'):
+            package_errata[package_id].append(erratum_id)
+
+        updates = []
+        new_errata_ids = set()
+        for package in packages:
             highest_package = package
-            best_repo = find_best_repo(package, hostrepos)
             priority = None
-            if best_repo is not None:
-                priority = best_repo.priority
+            if get_best_repo is not None:
+                best_repo = get_best_repo(package)
+                if best_repo is not None:
+                    priority = best_repo.priority
 
-            # find the packages that are potential updates
-            pu_q = Q(
-                name=package.name,
-                arch=package.arch,
-                packagetype=package.packagetype,
-                category=package.category,
-            )
-            potential_updates = repo_packages.filter(pu_q).exclude(version__startswith='9999')
-            for pu in potential_updates:
-                pu_is_module_package = False
-                pu_in_enabled_modules = False
-                if pu.module_set.exists():
-                    pu_is_module_package = True
-                    for module in pu.module_set.all():
-                        if module in self.modules.all():
-                            pu_in_enabled_modules = True
-                if pu_is_module_package:
-                    if not pu_in_enabled_modules:
-                        continue
+            for pu in candidates.get(get_key(package), []):
+                if pu.id in module_gated_ids and pu.id not in module_enabled_ids:
+                    continue
                 if package.compare_version(pu) == -1:
                     # package updates that are fixed by erratum (may already be superceded by another update)
-                    errata = pu.provides_fix_in_erratum.all()
-                    if errata:
-                        for erratum in errata:
-                            self.errata.add(erratum)
-                            errata_ids.add(erratum.id)
+                    new_errata_ids.update(package_errata.get(pu.id, []))
                     if highest_package.compare_version(pu) == -1:
                         if priority is not None:
                             # proceed only if the package is from a repo with a
                             # priority and that priority is >= the repo priority
-                            pu_best_repo = find_best_repo(pu, hostrepos)
+                            pu_best_repo = get_best_repo(pu)
                             if pu_best_repo:
-                                pu_priority = pu_best_repo.priority
-                                if pu_priority >= priority:
+                                if pu_best_repo.priority >= priority:
                                     highest_package = pu
                         else:
                             highest_package = pu
 
             if highest_package != package:
-                uid = self.process_update(package, highest_package)
-                if uid is not None:
-                    update_ids.append(uid)
-        return update_ids
-
-    def find_osrelease_repo_updates(self, host_packages, repo_packages, errata_ids):
-
-        update_ids = []
-        for package in host_packages:
-            highest_package = package
-
-            # find the packages that are potential updates
-            pu_q = Q(name=package.name,
-                     arch=package.arch,
-                     packagetype=package.packagetype)
-            potential_updates = repo_packages.filter(pu_q)
-            for pu in potential_updates:
-                pu_is_module_package = False
-                pu_in_enabled_modules = False
-                if pu.module_set.exists():
-                    pu_is_module_package = True
-                    for module in pu.module_set.all():
-                        if module in self.modules.all():
-                            pu_in_enabled_modules = True
-                if pu_is_module_package:
-                    if not pu_in_enabled_modules:
-                        continue
-                if package.compare_version(pu) == -1:
-                    # package updates that are fixed by erratum (may already be superceded by another update)
-                    errata = pu.provides_fix_in_erratum.all()
-                    if errata:
-                        for erratum in errata:
-                            self.errata.add(erratum)
-                            errata_ids.add(erratum.id)
-                    if highest_package.compare_version(pu) == -1:
-                        highest_package = pu
+                updates.append((package, highest_package))
 
-            if highest_package != package:
-                uid = self.process_update(package, highest_package)
-                if uid is not None:
-                    update_ids.append(uid)
-        return update_ids
+        errata_ids.update(new_errata_ids)
+        return updates
 
     def check_if_reboot_required(self, host_highest):
         """Check if a reboot is required (running kernel < installed highest).
 
-        Uses labelCompare for RPM-style version tuples parsed from uname -r.
+        Uses rpm version ordering for the version parsed from uname -r.
         Only valid for RPM kernels — DEB and Arch use compare_version via
         their respective find_*_kernel_updates methods.
         """
@@ -343,9 +538,9 @@ class Host(models.Model):
                  host_highest.release.startswith(rel + '.')):
             self.reboot_required = False
             return
-        kernel_ver = ('', str(ver), str(rel))
-        host_highest_ver = ('', host_highest.version, host_highest.release)
-        if labelCompare(kernel_ver, host_highest_ver) == -1:
+        kernel_ver = get_version_key(Package.RPM, '', str(ver), str(rel))
+        host_highest_ver = get_version_key(Package.RPM, '', host_highest.version, host_highest.release)
+        if kernel_ver < host_highest_ver:
             self.reboot_required = True
         else:
             self.reboot_required = False
@@ -353,26 +548,9 @@ class Host(models.Model):
     def _get_deb_kernel_flavour(self, pkg_name):
         """Extract the flavour suffix from a DEB kernel package name.
 
-        e.g. 'linux-image-6.8.0-51-generic' → 'generic'
-             'linux-image-6.8.0-51-lowlatency' → 'lowlatency'
-             'linux-image-6.1.0-28-cloud-amd64' → 'cloud-amd64'
-             'linux-modules-extra-6.8.0-51-generic' → 'generic'
-        Returns None if the flavour cannot be determined.
+        See packages.kernels.get_deb_kernel_flavour.
         """
-        for prefix in self._deb_kernel_prefixes:
-            if pkg_name.startswith(prefix):
-                # strip prefix, then split version from flavour
-                # e.g. '6.8.0-51-generic' or '6.1.0-28-cloud-amd64'
-                remainder = pkg_name[len(prefix):]
-                # version parts are numeric/dotted, flavour starts after
-                # e.g. '6.8.0-51-generic' → parts=['6.8.0', '51', 'generic']
-                parts = remainder.split('-')
-                # find first non-numeric part (not starting with digit)
-                for i, part in enumerate(parts):
-                    if part and not part[0].isdigit():
-                        return '-'.join(parts[i:])
-                return None
-        return None
+        return get_deb_kernel_flavour(pkg_name)
 
     def _get_running_kernel_flavour(self):
         """Extract the flavour from the running kernel string.
@@ -390,54 +568,56 @@ class Host(models.Model):
                     return '-'.join(parts[i:])
         return None
 
-    # longest prefixes first to avoid linux-modules- matching linux-modules-extra-
-    _deb_kernel_prefixes = [
-        'linux-image-unsigned-',
-        'linux-modules-extra-',
-        'linux-cloud-tools-',
-        'linux-image-uc-',
-        'linux-image-',
-        'linux-headers-',
-        'linux-modules-',
-        'linux-support-',
-        'linux-kbuild-',
-        'linux-tools-',
-    ]
-
     def find_kernel_updates(self, kernel_packages, repo_packages):
 
-        update_ids = []
+        update_ids = self.process_updates(self._find_kernel_updates(kernel_packages, repo_packages))
+        if update_ids:
+            self.updates.add(*update_ids)
+        self.save(update_fields=['reboot_required'])
+        return update_ids
+
+    def _find_kernel_updates(self, kernel_packages, repo_packages, get_best_repo=None):
+        """ Returns the kernel updates for the host as a list of (package,
+            highest_package) tuples and sets reboot_required, without saving
+        """
+        updates = []
         self.reboot_required = False
 
-        # build hostrepos for priority filtering (same as find_host_repo_updates)
-        hostrepos = None
-        if self.host_repos_only:
-            hostrepos_q = Q(repo__mirror__enabled=True,
-                            repo__mirror__refresh=True,
-                            repo__mirror__repo__enabled=True,
-                            host=self)
-            hostrepos = HostRepo.objects.select_related(
-                'host', 'repo').filter(hostrepos_q)
+        # resolve repos for priority filtering (same as find_host_repo_updates)
+        if self.host_repos_only and get_best_repo is None:
+            get_best_repo = self.get_best_repo_resolver()
 
-        deb_kernels = kernel_packages.filter(packagetype='D')
-        rpm_kernels = kernel_packages.filter(packagetype='R')
-        arch_kernels = kernel_packages.filter(packagetype='A')
+        # fetch installed and repo kernel packages once, using the kernel
+        # classification stored on each PackageName, and group them in memory
+        kernels_q = Q(name__kernel_family__isnull=False)
+        installed_kernels = list(self.packages.filter(kernels_q).select_related('name'))
+        repo_kernels = list(repo_packages.filter(kernels_q).select_related('name'))
+        kernel_packages = list(kernel_packages.select_related('name'))
 
-        update_ids.extend(self._find_rpm_kernel_updates(rpm_kernels, repo_packages, hostrepos))
-        update_ids.extend(self._find_deb_kernel_updates(deb_kernels, repo_packages, hostrepos))
-        update_ids.extend(self._find_arch_kernel_updates(arch_kernels, repo_packages, hostrepos))
+        rpm_kernels = [p for p in kernel_packages if p.packagetype == Package.RPM]
+        deb_kernels = [p for p in kernel_packages if p.packagetype == Package.DEB]
+        arch_kernels = [p for p in kernel_packages if p.packagetype == Package.ARCH]
 
-        self.save(update_fields=['reboot_required'])
-        return update_ids
+        installed_by_name = defaultdict(list)
+        for package in installed_kernels:
+            installed_by_name[package.name_id].append(package)
+        repo_by_name = defaultdict(list)
+        for package in repo_kernels:
+            repo_by_name[package.name_id].append(package)
 
-    def _find_rpm_kernel_updates(self, kernel_packages, repo_packages, hostrepos):
+        updates.extend(self._find_rpm_kernel_updates(rpm_kernels, installed_by_name, repo_by_name, get_best_repo))
+        updates.extend(self._find_deb_kernel_updates(deb_kernels, installed_kernels, repo_kernels, get_best_repo))
+        updates.extend(self._find_arch_kernel_updates(arch_kernels, repo_by_name, get_best_repo))
+        return updates
 
-        update_ids = []
+    def _find_rpm_kernel_updates(self, kernel_packages, installed_by_name, repo_by_name, get_best_repo):
+
+        updates = []
 
         # parse running kernel version for comparison
         parts = self.kernel.split('-')
         if len(parts) < 2:
-            return update_ids
+            return updates
         ver, rel = parts[:2]
         # strip arch suffix from uname -r release (e.g. '.x86_64')
         arch_suffix = '.' + self.arch.name
@@ -452,20 +632,18 @@ class Host(models.Model):
                 continue
             processed_names.add(package.name_id)
 
-            pu_q = Q(name=package.name)
-
             # determine baseline priority from the installed package's repo
             priority = None
-            if hostrepos is not None:
-                best_repo = find_best_repo(package, hostrepos)
+            if get_best_repo is not None:
+                best_repo = get_best_repo(package)
                 if best_repo is not None:
                     priority = best_repo.priority
 
             # find repo highest for this kernel name, respecting priority
             repo_highest = None
-            for pu in repo_packages.filter(pu_q):
+            for pu in repo_by_name[package.name_id]:
                 if priority is not None:
-                    pu_best_repo = find_best_repo(pu, hostrepos)
+                    pu_best_repo = get_best_repo(pu)
                     if not pu_best_repo or pu_best_repo.priority < priority:
                         continue
                 if repo_highest is None or repo_highest.compare_version(pu) == -1:
@@ -477,7 +655,7 @@ class Host(models.Model):
             # find host highest installed for reboot check
             host_highest = None
             running_package = None
-            for hp in self.packages.filter(pu_q):
+            for hp in installed_by_name[package.name_id]:
                 if host_highest is None or host_highest.compare_version(hp) == -1:
                     host_highest = hp
                 # match installed package to running kernel
@@ -496,9 +674,7 @@ class Host(models.Model):
                 base_package = host_highest
 
             if base_package and base_package.compare_version(repo_highest) == -1:
-                uid = self.process_update(base_package, repo_highest)
-                if uid is not None:
-                    update_ids.append(uid)
+                updates.append((base_package, repo_highest))
 
             # reboot check only on primary kernel packages
             if host_highest and package.name.name in (
@@ -509,26 +685,24 @@ class Host(models.Model):
             ):
                 self.check_if_reboot_required(host_highest)
 
-        return update_ids
+        return updates
 
-    def _find_arch_kernel_updates(self, kernel_packages, repo_packages, hostrepos):
+    def _find_arch_kernel_updates(self, kernel_packages, repo_by_name, get_best_repo):
 
-        update_ids = []
+        updates = []
 
         for package in kernel_packages:
-            pu_q = Q(name=package.name)
-
             # determine baseline priority from the installed package's repo
             priority = None
-            if hostrepos is not None:
-                best_repo = find_best_repo(package, hostrepos)
+            if get_best_repo is not None:
+                best_repo = get_best_repo(package)
                 if best_repo is not None:
                     priority = best_repo.priority
 
             repo_highest = None
-            for rp in repo_packages.filter(pu_q):
+            for rp in repo_by_name[package.name_id]:
                 if priority is not None:
-                    rp_best_repo = find_best_repo(rp, hostrepos)
+                    rp_best_repo = get_best_repo(rp)
                     if not rp_best_repo or rp_best_repo.priority < priority:
                         continue
                 if repo_highest is None or repo_highest.compare_version(rp) == -1:
@@ -538,9 +712,7 @@ class Host(models.Model):
                 continue
 
             if package.compare_version(repo_highest) == -1:
-                uid = self.process_update(package, repo_highest)
-                if uid is not None:
-                    update_ids.append(uid)
+                updates.append((package, repo_highest))
 
             # reboot check for main kernel packages (not -headers)
             # Arch uname -r format varies by flavour:
@@ -560,11 +732,11 @@ class Host(models.Model):
                 if pkg_ver != running_base and not pkg_ver.startswith(running_base + '.'):
                     self.reboot_required = True
 
-        return update_ids
+        return updates
 
-    def _find_deb_kernel_updates(self, kernel_packages, repo_packages, hostrepos):
+    def _find_deb_kernel_updates(self, kernel_packages, installed_kernels, repo_kernels, get_best_repo):
 
-        update_ids = []
+        updates = []
         running_flavour = self._get_running_kernel_flavour()
 
         # find the linux-image package matching the running kernel
@@ -577,44 +749,45 @@ class Host(models.Model):
 
         # determine baseline priority from the running kernel's repo
         priority = None
-        if hostrepos is not None and running_kernel_pkg is not None:
-            best_repo = find_best_repo(running_kernel_pkg, hostrepos)
+        if get_best_repo is not None and running_kernel_pkg is not None:
+            best_repo = get_best_repo(running_kernel_pkg)
             if best_repo is not None:
                 priority = best_repo.priority
 
+        # group deb kernel packages by family (prefix), restricted to the
+        # running flavour if we know it
+        repo_by_prefix = defaultdict(list)
+        for rp in repo_kernels:
+            if rp.packagetype != Package.DEB:
+                continue
+            if running_flavour and rp.name.kernel_flavour != running_flavour:
+                continue
+            repo_by_prefix[rp.name.kernel_family].append(rp)
+        installed_by_name = {}
+        for hp in installed_kernels:
+            if hp.packagetype == Package.DEB:
+                installed_by_name.setdefault(hp.name.name, hp)
+
         processed_prefixes = set()
         for package in kernel_packages:
-            pkg_name = package.name.name
-            flavour = self._get_deb_kernel_flavour(pkg_name)
+            flavour = package.name.kernel_flavour
 
             # if we know the running flavour, only process matching packages
             # if we don't (unflavoured kernel), process all kernel packages
             if running_flavour and flavour != running_flavour:
                 continue
 
-            # determine the prefix (e.g. 'linux-image-')
-            prefix = None
-            for p in self._deb_kernel_prefixes:
-                if pkg_name.startswith(p):
-                    prefix = p
-                    break
-            if prefix is None or prefix in processed_prefixes:
+            # the kernel family of a deb kernel package is its prefix (e.g. 'linux-image-')
+            prefix = package.name.kernel_family
+            if prefix not in DEB_KERNEL_PREFIXES or prefix in processed_prefixes:
                 continue
             processed_prefixes.add(prefix)
 
-            # build endswith filter for flavoured kernels
-            name_filter = Q(
-                name__name__startswith=prefix,
-                packagetype='D',
-            )
-            if running_flavour:
-                name_filter &= Q(name__name__endswith=f'-{running_flavour}')
-
             # find repo highest for this prefix+flavour, respecting priority
             repo_highest = None
-            for rp in repo_packages.filter(name_filter):
+            for rp in repo_by_prefix[prefix]:
                 if priority is not None:
-                    rp_best_repo = find_best_repo(rp, hostrepos)
+                    rp_best_repo = get_best_repo(rp)
                     if not rp_best_repo or rp_best_repo.priority < priority:
                         continue
                 if repo_highest is None or repo_highest.compare_version(rp) == -1:
@@ -624,34 +797,24 @@ class Host(models.Model):
                 continue
 
             # find the installed package matching the running kernel for this prefix
-            base_package = None
-            expected_name = prefix + self.kernel
-            for hp in self.packages.filter(name_filter):
-                if hp.name.name == expected_name:
-                    base_package = hp
-                    break
-
             # fallback: if no running match, use the installed package we started with
-            if base_package is None:
-                base_package = package
+            base_package = installed_by_name.get(prefix + self.kernel, package)
 
             if base_package.compare_version(repo_highest) == -1:
-                uid = self.process_update(base_package, repo_highest)
-                if uid is not None:
-                    update_ids.append(uid)
+                updates.append((base_package, repo_highest))
 
         # reboot check: see if a newer linux-image is installed but not running
-        # use compare_version (DEB semantics) instead of labelCompare
+        # use compare_version (DEB semantics) instead of rpm ordering
         if running_kernel_pkg:
             for package in kernel_packages:
                 if package.name.name.startswith('linux-image-'):
-                    flavour = self._get_deb_kernel_flavour(package.name.name)
+                    flavour = package.name.kernel_flavour
                     if running_flavour is None or flavour == running_flavour:
                         if running_kernel_pkg.compare_version(package) == -1:
                             self.reboot_required = True
                             break
 
-        return update_ids
+        return updates
 
 
 class HostRepo(models.Model):
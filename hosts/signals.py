@@ -14,32 +14,57 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 
-from hosts.models import Host
+from hosts.models import Host, HostRepo
+from util.counters import register_count, update_counts
+
+register_count(Host, 'packages_count', 'packages')
+register_count(Host, 'sec_updates_count', 'updates', security=True)
+register_count(Host, 'bug_updates_count', 'updates', security=False)
+register_count(Host, 'errata_count', 'errata')
 
 
 @receiver(m2m_changed, sender=Host.packages.through)
 def update_host_packages_count(sender, instance, action, **kwargs):
     """Update packages_count when Host.packages M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.packages_count = instance.packages.count()
-        instance.save(update_fields=['packages_count'])
+        update_counts(instance, 'packages_count')
 
 
 @receiver(m2m_changed, sender=Host.updates.through)
 def update_host_updates_count(sender, instance, action, **kwargs):
     """Update sec_updates_count and bug_updates_count when Host.updates M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.sec_updates_count = instance.updates.filter(security=True).count()
-        instance.bug_updates_count = instance.updates.filter(security=False).count()
-        instance.save(update_fields=['sec_updates_count', 'bug_updates_count'])
+        update_counts(instance, 'sec_updates_count', 'bug_updates_count')
 
 
 @receiver(m2m_changed, sender=Host.errata.through)
 def update_host_errata_count(sender, instance, action, **kwargs):
     """Update errata_count when Host.errata M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.errata_count = instance.errata.count()
-        instance.save(update_fields=['errata_count'])
+        update_counts(instance, 'errata_count')
+
+
+@receiver(m2m_changed, sender=Host.packages.through)
+@receiver(m2m_changed, sender=Host.modules.through)
+def clear_host_updates_fingerprint(sender, instance, action, reverse, pk_set, **kwargs):
+    """Clear the updates fingerprint and mark the updates stale when Host.packages or Host.modules M2M changes."""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            hosts = Host.objects.filter(id__in=pk_set) if pk_set else Host.objects.none()
+        else:
+            instance.updates_fingerprint = None
+            instance.updates_stale = True
+            hosts = Host.objects.filter(id=instance.id)
+        hosts.exclude(updates_fingerprint=None, updates_stale=True).update(updates_fingerprint=None, updates_stale=True)
+
+
+@receiver(post_save, sender=HostRepo)
+@receiver(post_delete, sender=HostRepo)
+def clear_hostrepo_updates_fingerprint(sender, instance, raw=False, **kwargs):
+    """Clear the updates fingerprint and mark the updates stale when a HostRepo is changed."""
+    if not raw:
+        Host.objects.filter(id=instance.host_id).exclude(updates_fingerprint=None, updates_stale=True).update(
+            updates_fingerprint=None, updates_stale=True)
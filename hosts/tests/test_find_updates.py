@@ -14,15 +14,24 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+from datetime import timedelta
+
 from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from arch.models import MachineArchitecture, PackageArchitecture
 from domains.models import Domain
+from errata.models import Erratum
 from hosts.models import Host, HostRepo
+from hosts.utils import (
+    find_host_updates_concurrently, find_host_updates_homogenous,
+    find_host_updates_incremental, get_update_jobs, get_update_timings,
+)
+from modules.models import Module
 from operatingsystems.models import OSRelease, OSVariant
-from packages.models import Package, PackageName, PackageUpdate
-from repos.models import Mirror, MirrorPackage, Repository
+from packages.models import Package, PackageName, PackageString, PackageUpdate
+from repos.models import Mirror, MirrorPackage, MirrorPackageChange, Repository
+from repos.utils import update_mirror_latest_packages, update_mirror_packages
 
 
 @override_settings(
@@ -145,6 +154,55 @@ class HostFindUpdatesTests(TestCase):
         self.assertEqual(update.oldpackage, old_pkg)
         self.assertEqual(update.newpackage, new_pkg)
 
+    def test_find_updates_module_packages_and_errata(self):
+        """Test find_updates skips packages of disabled modules and links errata."""
+        pkg_name = PackageName.objects.create(name='nodejs')
+        old_pkg, module_pkg, new_pkg = [
+            Package.objects.create(
+                name=pkg_name, arch=self.pkg_arch, epoch='', version=version,
+                release='1.el9', packagetype=Package.RPM,
+            ) for version in ('16.0', '20.0', '18.0')
+        ]
+        self.host.packages.add(old_pkg)
+        for package in (old_pkg, module_pkg, new_pkg):
+            MirrorPackage.objects.create(mirror=self.mirror, package=package)
+        module = Module.objects.create(
+            name='nodejs', stream='20', version='1', context='abc',
+            arch=self.pkg_arch, repo=self.repo,
+        )
+        module.packages.add(module_pkg)
+        erratum = Erratum.objects.create(
+            name='RLSA-2024:0001', e_type='security', synopsis='nodejs update',
+            issue_date=timezone.now(),
+        )
+        erratum.fixed_packages.add(new_pkg)
+
+        self.host.find_updates()
+        self.assertEqual(self.host.updates.get().newpackage, new_pkg)
+        self.assertEqual(list(self.host.errata.all()), [erratum])
+
+        self.host.modules.add(module)
+        self.host.find_updates()
+        self.assertEqual(self.host.updates.get().newpackage, module_pkg)
+
+    def test_find_updates_with_latest_package_index(self):
+        """Test find_updates uses the latest Package index of indexed mirrors."""
+        pkg_name = PackageName.objects.create(name='bash')
+        old_pkg, new_pkg = [
+            Package.objects.create(
+                name=pkg_name, arch=self.pkg_arch, epoch='', version=version,
+                release='1.el9', packagetype=Package.RPM,
+            ) for version in ('5.1.8', '5.1.16')
+        ]
+        self.host.packages.add(old_pkg)
+        MirrorPackage.objects.create(mirror=self.mirror, package=old_pkg)
+        update_mirror_latest_packages(self.mirror)
+        self.assertEqual(self.host.get_updatable_package_names([old_pkg], lambda p: p.name_id), [])
+
+        MirrorPackage.objects.create(mirror=self.mirror, package=new_pkg)
+        self.host.find_updates()
+        self.assertEqual(self.host.updates.get().newpackage, new_pkg)
+
     def test_find_updates_security_repo(self):
         """Test find_updates marks security repo updates correctly."""
         # Create a security repository
@@ -260,6 +318,37 @@ class HostFindUpdatesTests(TestCase):
         self.host.find_updates()
         self.assertEqual(self.host.updates.count(), 0)
 
+    def test_find_updates_applies_diff_and_counts(self):
+        """Test find_updates replaces stale updates and errata and recounts once."""
+        pkg_name = PackageName.objects.create(name='curl')
+        old_pkg, stale_pkg, new_pkg = [
+            Package.objects.create(
+                name=pkg_name, arch=self.pkg_arch, epoch='', version=version,
+                release='1.el9', packagetype=Package.RPM,
+            ) for version in ('7.0', '7.5', '8.0')
+        ]
+        self.host.packages.add(old_pkg)
+        MirrorPackage.objects.create(mirror=self.mirror, package=new_pkg)
+        stale_update = PackageUpdate.objects.create(oldpackage=old_pkg, newpackage=stale_pkg, security=True)
+        stale_erratum = Erratum.objects.create(
+            name='RLSA-2024:0002', e_type='bugfix', synopsis='old', issue_date=timezone.now(),
+        )
+        erratum = Erratum.objects.create(
+            name='RLSA-2024:0003', e_type='bugfix', synopsis='curl update', issue_date=timezone.now(),
+        )
+        erratum.fixed_packages.add(new_pkg)
+        self.host.updates.add(stale_update)
+        self.host.errata.add(stale_erratum)
+
+        self.host.find_updates()
+
+        self.host.refresh_from_db()
+        self.assertEqual(self.host.updates.get().newpackage, new_pkg)
+        self.assertEqual(list(self.host.errata.all()), [erratum])
+        self.assertEqual(self.host.sec_updates_count, 0)
+        self.assertEqual(self.host.bug_updates_count, 1)
+        self.assertEqual(self.host.errata_count, 1)
+
 
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
@@ -362,3 +451,220 @@ class HostProcessUpdateTests(TestCase):
         update_id = self.host.process_update(old_pkg, new_pkg)
         update = PackageUpdate.objects.get(id=update_id)
         self.assertTrue(update.security)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.host.get_security_package_ids([old_pkg.id, new_pkg.id]), {new_pkg.id})
+        mirror.enabled = False
+        mirror.save()
+        self.assertEqual(self.host.get_security_package_ids([new_pkg.id]), set())
+        self.assertIn('security_lookup', get_update_timings())
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class HomogenousHostUpdatesTests(TestCase):
+    """Tests for find_host_updates_homogenous()."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.machine_arch = MachineArchitecture.objects.create(name='x86_64')
+        self.pkg_arch = PackageArchitecture.objects.create(name='x86_64')
+        osrelease = OSRelease.objects.create(name='Rocky Linux 9')
+        self.osvariant = OSVariant.objects.create(
+            name='Rocky Linux 9 x86_64', osrelease=osrelease, arch=self.machine_arch)
+        self.domain = Domain.objects.create(name='example.com')
+        repo = Repository.objects.create(
+            name='baseos', arch=self.machine_arch, repotype=Repository.RPM, enabled=True)
+        mirror = Mirror.objects.create(repo=repo, url='http://example.com/baseos', enabled=True, refresh=True)
+        pkg_name = PackageName.objects.create(name='openssl')
+        self.old_pkg, self.new_pkg = [
+            Package.objects.create(
+                name=pkg_name, arch=self.pkg_arch, epoch='', version=version,
+                release='1.el9', packagetype=Package.RPM,
+            ) for version in ('3.0.0', '3.0.1')
+        ]
+        MirrorPackage.objects.create(mirror=mirror, package=self.new_pkg)
+        self.hosts = []
+        for i in range(3):
+            host = Host.objects.create(
+                hostname=f'host{i}.example.com', ipaddress='192.168.1.100', arch=self.machine_arch,
+                osvariant=self.osvariant, domain=self.domain, kernel='5.14.0-362.el9.x86_64',
+                lastreport=timezone.now(),
+            )
+            HostRepo.objects.create(host=host, repo=repo)
+            host.packages.add(self.old_pkg)
+            self.hosts.append(host)
+
+    def test_updates_fingerprint_cleared_on_change(self):
+        """Test the updates fingerprint is cleared when the package set changes."""
+        host = self.hosts[0]
+        host.update_updates_fingerprint()
+        self.assertEqual(host.updates_fingerprint, self.hosts[1].get_updates_fingerprint())
+        host.packages.add(self.new_pkg)
+        host.refresh_from_db()
+        self.assertIsNone(host.updates_fingerprint)
+        self.assertNotEqual(host.get_updates_fingerprint(), self.hosts[1].get_updates_fingerprint())
+
+    def test_updates_copied_to_homogenous_hosts(self):
+        """Test updates are found once per group and copied to the other hosts."""
+        self.hosts[2].packages.set([self.new_pkg])
+        find_host_updates_homogenous(Host.objects.all())
+        for host in self.hosts[:2]:
+            host.refresh_from_db()
+            self.assertEqual(host.updates.get().newpackage, self.new_pkg)
+            self.assertEqual(host.bug_updates_count, 1)
+            self.assertIsNotNone(host.updates_fingerprint)
+        self.assertEqual(self.hosts[2].updates.count(), 0)
+
+    def test_find_host_updates_concurrently_sqlite(self):
+        """Test concurrent update finding falls back to one process on SQLite."""
+        self.hosts[2].packages.set([self.new_pkg])
+        self.assertEqual(get_update_jobs(4), 1)
+        timings = find_host_updates_concurrently(Host.objects.all(), jobs=4)
+        self.assertEqual(len(timings), 3)
+        for host in self.hosts[:2]:
+            self.assertEqual(host.updates.get().newpackage, self.new_pkg)
+        self.assertEqual(self.hosts[2].updates.count(), 0)
+
+        timings = find_host_updates_concurrently(Host.objects.all(), jobs=4, homogenous=True)
+        self.assertEqual(sorted(count for _, count, _ in timings), [1, 2])
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class IncrementalHostUpdatesTests(TestCase):
+    """Tests for find_host_updates_incremental()."""
+
+    def setUp(self):
+        """Set up test data."""
+        machine_arch = MachineArchitecture.objects.create(name='x86_64')
+        PackageArchitecture.objects.create(name='x86_64')
+        osrelease = OSRelease.objects.create(name='Rocky Linux 9')
+        osvariant = OSVariant.objects.create(name='Rocky Linux 9 x86_64', osrelease=osrelease, arch=machine_arch)
+        domain = Domain.objects.create(name='example.com')
+        self.repo = Repository.objects.create(
+            name='baseos', arch=machine_arch, repotype=Repository.RPM, enabled=True)
+        self.mirror = Mirror.objects.create(
+            repo=self.repo, url='http://example.com/baseos', enabled=True, refresh=True)
+        self.host = Host.objects.create(
+            hostname='host.example.com', ipaddress='192.168.1.100', arch=machine_arch,
+            osvariant=osvariant, domain=domain, kernel='5.14.0-362.el9.x86_64',
+            lastreport=timezone.now() - timedelta(hours=1),
+        )
+        HostRepo.objects.create(host=self.host, repo=self.repo)
+        update_mirror_packages(self.mirror, self.get_packagestrings(('openssl', '3.0.0'), ('bash', '5.0')))
+        self.host.packages.set(Package.objects.all())
+        update_mirror_packages(self.mirror, self.get_packagestrings(('openssl', '3.0.1'), ('bash', '5.0')))
+        self.host.update_updates_fingerprint()
+        self.host.find_updates()
+
+    def get_packagestrings(self, *packages):
+        """Return PackageStrings for (name, version) tuples."""
+        return {
+            PackageString(name=name, epoch='', version=version, release='1.el9',
+                          arch='x86_64', packagetype=Package.RPM)
+            for name, version in packages
+        }
+
+    def get_updates(self):
+        """Return the (name, newversion) of the updates of the host."""
+        return sorted(self.host.updates.values_list('newpackage__name__name', 'newpackage__version'))
+
+    def test_mirror_package_changes_recorded(self):
+        """Test the changed package names of a mirror are recorded."""
+        MirrorPackageChange.objects.all().delete()
+        update_mirror_packages(self.mirror, self.get_packagestrings(('openssl', '3.0.1'), ('bash', '5.1')))
+        self.assertEqual(list(MirrorPackageChange.objects.values_list('name__name', flat=True)), ['bash'])
+
+    def test_only_changed_names_reevaluated(self):
+        """Test only the package names that changed in a mirror are re-evaluated."""
+        self.assertEqual(self.get_updates(), [('openssl', '3.0.1')])
+        # remove the openssl update without recording a change, so that it
+        # is only removed from the host if openssl is re-evaluated
+        MirrorPackage.objects.filter(mirror=self.mirror, package__name__name='openssl').delete()
+        update_mirror_packages(self.mirror, self.get_packagestrings(('bash', '5.1')))
+        MirrorPackageChange.objects.exclude(name__name='bash').delete()
+
+        find_host_updates_incremental(Host.objects.all())
+        self.assertEqual(self.get_updates(), [('bash', '5.1'), ('openssl', '3.0.1')])
+
+        # hosts without changes since their updates were found are skipped
+        updated_at = timezone.now() + timedelta(minutes=1)
+        Host.objects.update(updated_at=updated_at)
+        find_host_updates_incremental(Host.objects.all())
+        self.host.refresh_from_db()
+        self.assertEqual(self.host.updated_at, updated_at)
+        self.assertFalse(MirrorPackageChange.objects.exists())
+
+    def test_skipped_hosts_allow_cleanup(self):
+        """Test skipped hosts are marked as updated so old changes are removed."""
+        other_repo = Repository.objects.create(name='appstream', arch=self.repo.arch, repotype=Repository.RPM)
+        other_mirror = Mirror.objects.create(repo=other_repo, url='http://example.com/appstream')
+        update_mirror_packages(other_mirror, self.get_packagestrings(('perl', '5.32')))
+        MirrorPackageChange.objects.filter(mirror=self.mirror).delete()
+        MirrorPackageChange.objects.update(changed_at=timezone.now() - timedelta(minutes=10))
+        updated_at = timezone.now() - timedelta(minutes=30)
+        Host.objects.update(updated_at=updated_at)
+
+        find_host_updates_incremental(Host.objects.all())
+        self.host.refresh_from_db()
+        self.assertGreater(self.host.updated_at, updated_at)
+        self.assertFalse(MirrorPackageChange.objects.exists())
+
+    def test_disabled_repo_reevaluated_in_full(self):
+        """Test all updates are re-evaluated when a repo is disabled."""
+        self.repo.disable()
+        self.repo.save()
+        find_host_updates_incremental(Host.objects.all())
+        self.assertEqual(self.get_updates(), [])
+
+    def test_stale_host_reevaluated_in_full(self):
+        """Test hosts whose packages changed are re-evaluated in full even after their fingerprint is recomputed."""
+        self.assertFalse(Host.objects.get(id=self.host.id).updates_stale)
+        update_mirror_packages(
+            self.mirror, self.get_packagestrings(('openssl', '3.0.1'), ('bash', '5.0'), ('zlib', '1.1')))
+        MirrorPackageChange.objects.all().delete()
+        zlib = Package.objects.create(
+            name=PackageName.objects.get(name='zlib'), arch=PackageArchitecture.objects.get(name='x86_64'),
+            epoch='', version='1.0', release='1.el9', packagetype=Package.RPM)
+        self.host.packages.add(zlib)
+        # as done when a report is processed without finding updates
+        self.host.update_updates_fingerprint()
+        Host.objects.update(updated_at=timezone.now() + timedelta(minutes=1))
+
+        find_host_updates_incremental(Host.objects.all())
+        self.assertEqual(self.get_updates(), [('openssl', '3.0.1'), ('zlib', '1.1')])
+        self.assertFalse(Host.objects.get(id=self.host.id).updates_stale)
+
+    def test_hostrepo_change_marks_host_stale(self):
+        """Test changing the priority of a HostRepo marks the updates of the host stale."""
+        hostrepo = HostRepo.objects.get(host=self.host)
+        hostrepo.priority = 10
+        hostrepo.save()
+        self.assertTrue(Host.objects.get(id=self.host.id).updates_stale)
+
+    def test_repo_security_change_recorded(self):
+        """Test changing whether a repo is a security repo records a change of its mirrors."""
+        MirrorPackageChange.objects.all().delete()
+        self.repo.save()
+        self.assertFalse(MirrorPackageChange.objects.exists())
+        self.repo.security = True
+        self.repo.save()
+        self.assertEqual(list(MirrorPackageChange.objects.values_list('mirror', 'name')), [(self.mirror.id, None)])
+
+    def test_erratum_fixed_packages_change_recorded(self):
+        """Test adding a fixed package to an erratum records a change of the mirrors that contain it."""
+        MirrorPackageChange.objects.all().delete()
+        erratum = Erratum.objects.create(
+            name='RLSA-2024:0001', e_type='security', issue_date=timezone.now(), synopsis='openssl update')
+        package = Package.objects.get(name__name='openssl', version='3.0.1')
+        erratum.fixed_packages.add(package)
+        self.assertEqual(
+            list(MirrorPackageChange.objects.values_list('mirror', 'name__name')), [(self.mirror.id, 'openssl')])
+        MirrorPackageChange.objects.all().delete()
+        erratum.fixed_packages.add(package)
+        self.assertFalse(MirrorPackageChange.objects.exists())
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+from datetime import timedelta
+
 from django.db.models import Q
 from django.test import TestCase, override_settings
 from django.utils import timezone
@@ -193,6 +195,19 @@ class HostMethodTests(TestCase):
         db_host = Host.objects.get(pk=self.host.pk)
         self.assertEqual(db_host.bug_updates_count, 1)
 
+    def test_repos_changed_since(self):
+        """Test repos_changed_since() detects refreshed mirrors."""
+        repo = Repository.objects.create(
+            name='test-repo', arch=self.arch, repotype=Repository.DEB
+        )
+        HostRepo.objects.create(host=self.host, repo=repo, enabled=True)
+        mirror = Mirror.objects.create(repo=repo, url='http://example.com/repo')
+        ts = timezone.now()
+        self.assertFalse(self.host.repos_changed_since(ts))
+        mirror.packages_updated = ts + timedelta(seconds=1)
+        mirror.save()
+        self.assertTrue(self.host.repos_changed_since(ts))
+
 
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
@@ -777,6 +792,22 @@ class KernelPriorityTests(TestCase):
         )
         return host
 
+    def test_best_repo_resolver(self):
+        """Test the best repo resolver loads all package repos with one query."""
+        host = self._create_host(main_priority=500, bp_priority=100)
+        self.bp_repo.security = True
+        self.bp_repo.save()
+        self.bp_mirror.packages.add(self.img_43)
+        get_best_repo = host.get_best_repo_resolver()
+        with self.assertNumQueries(2):
+            self.assertEqual(get_best_repo(self.img_43).repo, self.bp_repo)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_best_repo(self.img_bp).repo, self.bp_repo)
+            self.assertEqual(get_best_repo(self.img_43).repo, self.bp_repo)
+        self.bp_repo.security = False
+        self.bp_repo.save()
+        self.assertEqual(host.get_best_repo_resolver()(self.img_43).repo, self.main_repo)
+
     def test_deb_backports_lower_priority_no_update(self):
         """DEB: backports kernel with lower priority should NOT be flagged."""
         host = self._create_host(main_priority=500, bp_priority=100)
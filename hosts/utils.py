@@ -15,13 +15,23 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import concurrent.futures
+import multiprocessing
+import time
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
 from socket import gaierror, gethostbyaddr, herror
 
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connection, connections, transaction
 from taggit.models import Tag
 
+from patchman.signals import pbar_start, pbar_update
 from util import get_datetime_now
-from util.logging import error_message, info_message
+from util.logging import error_message, info_message, warning_message
+
+# seconds spent in each timed step of finding updates in this process
+_update_timings = defaultdict(float)
 
 
 def update_rdns(host):
@@ -80,50 +90,209 @@ def get_or_create_host(report, arch, osvariant, domain):
         return host
 
 
+def get_homogenous_host_groups(hosts):
+    """ Group hosts that will have the same updates. Hosts are grouped by
+        their updates fingerprint, arch, osvariant, kernel and
+        host_repos_only setting.
+        Returns a list of lists of host ids
+    """
+    from hosts.models import Host
+
+    if not hasattr(hosts, 'filter'):
+        hosts = Host.objects.filter(id__in=[host.id for host in hosts])
+    for host in hosts.filter(updates_fingerprint__isnull=True).iterator():
+        host.update_updates_fingerprint()
+
+    group_fields = ('updates_fingerprint', 'arch_id', 'osvariant_id', 'kernel', 'host_repos_only')
+    rows = hosts.order_by(*group_fields, 'id').values_list(*group_fields, 'id')
+    return [[row[-1] for row in group] for _, group in groupby(rows, key=itemgetter(*range(len(group_fields))))]
+
+
+def find_host_group_updates(host_ids, ts, verbose=False):
+    """ Find updates for the first host in a group of homogenous hosts and
+        copy them to the other hosts in the group
+        Returns the host that updates were found for
+    """
+    from hosts.models import Host
+
+    host = Host.objects.get(id=host_ids[0])
+    if verbose:
+        info_message(text=str(host))
+    host.find_updates()
+    if verbose:
+        info_message(text='')
+    if len(host_ids) > 1:
+        copy_host_updates(host, host_ids[1:], ts)
+        for hostname in Host.objects.filter(id__in=host_ids[1:]).values_list('hostname', flat=True):
+            info_message(text=f'Added the same updates to {hostname}')
+    Host.objects.filter(id=host.id).update(updated_at=ts)
+    return host
+
+
 def find_host_updates_homogenous(hosts, verbose=False):
     """ Find updates for hosts, copying updates to homogenous hosts.
-        If a host has the same packages and repos as a previously
-        processed host, it is given the same updates.
+        Updates are found for one host in each group of homogenous hosts
+        and copied to the other hosts in the group.
+    """
+    ts = get_datetime_now()
+    for host_ids in get_homogenous_host_groups(hosts):
+        find_host_group_updates(host_ids, ts, verbose)
+
+
+def find_host_updates_incremental(hosts, verbose=False):
+    """ Re-evaluate the updates of hosts for the package names that were
+        added to or removed from their mirrors since their updates were last
+        found. Hosts whose updates are stale because their packages, repos
+        or modules changed, or whose mirrors may have changed entirely, are
+        re-evaluated in full. Hosts without changes are skipped, but are marked as
+        updated so that the changes recorded before this run can be cleaned
+        up.
     """
     from hosts.models import Host
+    from repos.utils import clean_mirror_package_changes
 
-    updated_host_ids = set()
     ts = get_datetime_now()
-    host_iter = hosts.iterator() if hasattr(hosts, 'iterator') else iter(hosts)
-    for host in host_iter:
+    skipped_ids = []
+    for host in hosts:
+        if host.updates_stale:
+            name_ids = None
+        else:
+            changed_name_ids = host.get_changed_package_names(host.updated_at)
+            if not changed_name_ids:
+                skipped_ids.append(host.id)
+                continue
+            if None in changed_name_ids:
+                name_ids = None
+            else:
+                name_ids = changed_name_ids
         if verbose:
             info_message(text=str(host))
-        if host.id not in updated_host_ids:
-            host.find_updates()
-            if verbose:
-                info_message(text='')
-            host.updated_at = ts
-            host.save(update_fields=['updated_at'])
-
-            filtered_hosts = Host.objects.filter(
-                packages_count=host.packages_count)
-            filtered_hosts = filtered_hosts.exclude(updated_at=ts)
-
-            package_ids = frozenset(host.packages.values_list('id', flat=True))
-            repo_ids = frozenset(host.repos.values_list('id', flat=True))
-            updates = list(host.updates.all())
-
-            for fhost in filtered_hosts.iterator():
-                frepo_ids = frozenset(fhost.repos.values_list('id', flat=True))
-                if repo_ids != frepo_ids:
-                    continue
-                fpackage_ids = frozenset(fhost.packages.values_list('id', flat=True))
-                if package_ids != fpackage_ids:
-                    continue
-
-                fhost.updates.set(updates)
-                fhost.reboot_required = host.reboot_required
-                fhost.updated_at = ts
-                fhost.save(update_fields=['updated_at', 'reboot_required'])
-                updated_host_ids.add(fhost.id)
-                info_message(text=f'Added the same updates to {fhost}')
-        elif verbose:
-            info_message(text='Updates already added in this run')
+        host.find_updates(name_ids)
+        if verbose:
+            info_message(text='')
+    # the updates of skipped hosts are current as of the start of this run,
+    # so that the changes recorded before it can be cleaned up
+    Host.objects.filter(id__in=skipped_ids, updated_at__lt=ts).update(updated_at=ts)
+    clean_mirror_package_changes()
+
+
+def get_update_jobs(jobs):
+    """ Returns the number of worker processes to use to find host updates.
+        SQLite only supports a single writer, so a single process is used.
+    """
+    if jobs > 1 and connection.vendor == 'sqlite':
+        warning_message(text='SQLite only supports a single writer, finding Host updates in a single process')
+        return 1
+    return max(jobs, 1)
+
+
+def _init_update_worker():
+    """ Ensure that a worker process opens its own database connections
+    """
+    connections.close_all()
+
+
+def _find_host_group_updates_timed(host_ids, ts):
+    """ Find updates for a group of homogenous hosts and time it
+        Returns a tuple of (hostname, number of hosts, seconds taken)
+    """
+    start = time.monotonic()
+    host = find_host_group_updates(host_ids, ts)
+    return str(host), len(host_ids), time.monotonic() - start
+
+
+def find_host_updates_concurrently(hosts, jobs, homogenous=False):
+    """ Find updates for hosts using a pool of worker processes.
+        If homogenous is True, updates are found once for each group of
+        homogenous hosts and copied to the other hosts in the group.
+        Returns a list of (hostname, number of hosts, seconds taken)
+    """
+    ts = get_datetime_now()
+    if homogenous:
+        groups = get_homogenous_host_groups(hosts)
+    else:
+        if hasattr(hosts, 'values_list'):
+            groups = [[host_id] for host_id in hosts.values_list('id', flat=True)]
+        else:
+            groups = [[host.id] for host in hosts]
+    jobs = get_update_jobs(jobs)
+    glen = len(groups)
+    timings = []
+    pbar_start.send(sender=None, ptext=f'Finding updates for {glen} Hosts using {jobs} processes', plen=glen)
+    if jobs == 1:
+        for i, host_ids in enumerate(groups):
+            timings.append(_find_host_group_updates_timed(host_ids, ts))
+            pbar_update.send(sender=None, index=i + 1)
+    else:
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, mp_context=context, initializer=_init_update_worker) as executor:
+            futures = [executor.submit(_find_host_group_updates_timed, host_ids, ts) for host_ids in groups]
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                try:
+                    timings.append(future.result())
+                except Exception as e:
+                    error_message(text=f'Error finding Host updates: {e}')
+                pbar_update.send(sender=None, index=i + 1)
+    show_host_update_timings(timings)
+    return timings
+
+
+def add_update_timing(name, seconds):
+    """ Add seconds to the named update finding timing counter of this process
+    """
+    _update_timings[name] += seconds
+
+
+def get_update_timings():
+    """ Returns a dict of the seconds spent in each timed step of finding
+        updates in this process
+    """
+    return dict(_update_timings)
+
+
+def show_host_update_timings(timings, slowest=5):
+    """ Print a summary of the time taken to find updates for each host
+    """
+    if not timings:
+        return
+    total = sum(seconds for _, _, seconds in timings)
+    hlen = sum(count for _, count, _ in timings)
+    info_message(text=f'Found updates for {hlen} Hosts in {total:.2f}s of processing time, '
+                      f'{total / len(timings):.2f}s per Host searched')
+    for hostname, count, seconds in sorted(timings, key=itemgetter(2), reverse=True)[:slowest]:
+        info_message(text=f'  {hostname} : {seconds:.2f}s ({count} Hosts)')
+    for name, seconds in sorted(get_update_timings().items()):
+        info_message(text=f'  {name} : {seconds:.2f}s')
+
+
+def copy_host_updates(host, host_ids, ts):
+    """ Replace the updates and errata of the hosts with host_ids with those
+        of host, using bulk writes, and copy the cached counts
+    """
+    from hosts.models import Host
+
+    update_ids = list(host.updates.values_list('id', flat=True))
+    errata_ids = list(host.errata.values_list('id', flat=True))
+    for relation, target_ids in (('updates', update_ids), ('errata', errata_ids)):
+        through = getattr(Host, relation).through
+        target_field = getattr(Host, relation).field.m2m_reverse_field_name()
+        through.objects.filter(host_id__in=host_ids).delete()
+        through.objects.bulk_create(
+            [through(host_id=host_id, **{f'{target_field}_id': target_id})
+             for host_id in host_ids for target_id in target_ids],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+    Host.objects.filter(id__in=host_ids).update(
+        updates_stale=False,
+        sec_updates_count=host.sec_updates_count,
+        bug_updates_count=host.bug_updates_count,
+        errata_count=host.errata_count,
+        reboot_required=host.reboot_required,
+        updated_at=ts,
+    )
 
 
 def clean_tags():
@@ -134,13 +303,7 @@ def clean_tags():
     )
     tlen = tags.count()
     if tlen == 0:
-<<<<<<< HEAD
-        info_message.send(sender=None, text='No orphaned Tags found.')
-    else:
-        info_message.send(sender=None, text=f'{tlen} orphaned Tags found.')
-=======
         info_message(text='No orphaned Tags found.')
     else:
         info_message(text=f'{tlen} orphaned Tags found.')
->>>>>>> docker
         tags.delete()
@@ -16,7 +16,7 @@
 
 from django.db import IntegrityError
 
-from arch.models import PackageArchitecture
+from arch.utils import get_or_create_package_arch
 from modules.models import Module
 from util.logging import error_message, info_message
 
@@ -25,7 +25,7 @@ def get_or_create_module(name, stream, version, context, arch, repo):
     """ Get or create a module object
         Returns the module
     """
-    m_arch, _ = PackageArchitecture.objects.get_or_create(name=arch)
+    m_arch = get_or_create_package_arch(arch)
     try:
         module, _ = Module.objects.get_or_create(
             name=name,
@@ -52,7 +52,7 @@ def get_matching_modules(name, stream, version, context, arch):
     """ Return modules that match name, stream, version, context, and arch,
         regardless of repo
     """
-    m_arch, c = PackageArchitecture.objects.get_or_create(name=arch)
+    m_arch = get_or_create_package_arch(arch)
     modules = Module.objects.filter(
         name=name,
         stream=stream,
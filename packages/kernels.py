@@ -0,0 +1,96 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+# kernel package names that are matched exactly (rpm and arch)
+KERNEL_NAMES = (
+    'kernel',
+    'linux',
+    'linux-lts',
+    'linux-zen',
+    'linux-hardened',
+    'linux-rt',
+    'linux-rt-lts',
+    'linux-headers',
+    'linux-lts-headers',
+    'linux-zen-headers',
+    'linux-hardened-headers',
+    'linux-rt-headers',
+    'linux-rt-lts-headers',
+)
+
+# deb kernel package prefixes, longest first to avoid linux-modules-
+# matching linux-modules-extra-
+DEB_KERNEL_PREFIXES = (
+    'linux-image-unsigned-',
+    'linux-modules-extra-',
+    'linux-cloud-tools-',
+    'linux-image-uc-',
+    'linux-image-',
+    'linux-headers-',
+    'linux-modules-',
+    'linux-support-',
+    'linux-kbuild-',
+    'linux-tools-',
+)
+
+# deb prefixes that are only kernel packages when followed by a version
+DEB_VERSIONED_KERNEL_PREFIXES = (
+    'linux-modules-extra-',
+    'linux-modules-',
+)
+
+KERNEL_PREFIXES = ('kernel-', 'virtualbox-kmp-')
+
+
+def get_deb_kernel_flavour(name):
+    """ Extract the flavour suffix from a DEB kernel package name.
+
+        e.g. 'linux-image-6.8.0-51-generic' → 'generic'
+             'linux-image-6.8.0-51-lowlatency' → 'lowlatency'
+             'linux-image-6.1.0-28-cloud-amd64' → 'cloud-amd64'
+             'linux-modules-extra-6.8.0-51-generic' → 'generic'
+        Returns None if the flavour cannot be determined.
+    """
+    for prefix in DEB_KERNEL_PREFIXES:
+        if name.startswith(prefix):
+            # version parts are numeric/dotted, flavour starts after
+            # e.g. '6.8.0-51-generic' → parts=['6.8.0', '51', 'generic']
+            parts = name[len(prefix):].split('-')
+            for i, part in enumerate(parts):
+                if part and not part[0].isdigit():
+                    return '-'.join(parts[i:])
+            return None
+    return None
+
+
+def get_kernel_classification(name):
+    """ Classify a package name as a kernel package.
+        Returns a tuple of (family, flavour), where family is the exact kernel
+        package name or the kernel package prefix that the name matches, and
+        flavour is the deb kernel flavour if there is one.
+        Returns (None, None) if the name is not a kernel package name.
+    """
+    if name in KERNEL_NAMES:
+        return name, None
+    for prefix in KERNEL_PREFIXES:
+        if name.startswith(prefix):
+            return prefix, None
+    for prefix in DEB_KERNEL_PREFIXES:
+        if name.startswith(prefix):
+            if prefix in DEB_VERSIONED_KERNEL_PREFIXES and not name[len(prefix):][:1].isdigit():
+                continue
+            return prefix, get_deb_kernel_flavour(name)
+    return None, None
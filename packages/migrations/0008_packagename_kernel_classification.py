@@ -0,0 +1,107 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+# a copy of the kernel classification in packages.kernels at the time of this
+# migration, so that later changes to it do not change this migration
+KERNEL_NAMES = (
+    'kernel',
+    'linux',
+    'linux-lts',
+    'linux-zen',
+    'linux-hardened',
+    'linux-rt',
+    'linux-rt-lts',
+    'linux-headers',
+    'linux-lts-headers',
+    'linux-zen-headers',
+    'linux-hardened-headers',
+    'linux-rt-headers',
+    'linux-rt-lts-headers',
+)
+
+DEB_KERNEL_PREFIXES = (
+    'linux-image-unsigned-',
+    'linux-modules-extra-',
+    'linux-cloud-tools-',
+    'linux-image-uc-',
+    'linux-image-',
+    'linux-headers-',
+    'linux-modules-',
+    'linux-support-',
+    'linux-kbuild-',
+    'linux-tools-',
+)
+
+DEB_VERSIONED_KERNEL_PREFIXES = (
+    'linux-modules-extra-',
+    'linux-modules-',
+)
+
+KERNEL_PREFIXES = ('kernel-', 'virtualbox-kmp-')
+
+
+def get_deb_kernel_flavour(name):
+    """Extract the flavour suffix from a DEB kernel package name."""
+    for prefix in DEB_KERNEL_PREFIXES:
+        if name.startswith(prefix):
+            parts = name[len(prefix):].split('-')
+            for i, part in enumerate(parts):
+                if part and not part[0].isdigit():
+                    return '-'.join(parts[i:])
+            return None
+    return None
+
+
+def get_kernel_classification(name):
+    """Classify a package name as a kernel package, returning (family, flavour)."""
+    if name in KERNEL_NAMES:
+        return name, None
+    for prefix in KERNEL_PREFIXES:
+        if name.startswith(prefix):
+            return prefix, None
+    for prefix in DEB_KERNEL_PREFIXES:
+        if name.startswith(prefix):
+            if prefix in DEB_VERSIONED_KERNEL_PREFIXES and not name[len(prefix):][:1].isdigit():
+                continue
+            return prefix, get_deb_kernel_flavour(name)
+    return None, None
+
+
+def classify_kernel_names(apps, schema_editor):
+    """Backfill kernel_family and kernel_flavour for existing package names."""
+    PackageName = apps.get_model('packages', 'PackageName')
+    names = []
+    for package_name in PackageName.objects.only('id', 'name').iterator():
+        family, flavour = get_kernel_classification(package_name.name)
+        if family is not None:
+            package_name.kernel_family = family
+            package_name.kernel_flavour = flavour
+            names.append(package_name)
+    PackageName.objects.bulk_update(names, ['kernel_family', 'kernel_flavour'], batch_size=500)
+
+
+def reverse_classify(apps, schema_editor):
+    """No-op reverse."""
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0007_alter_package_epoch_alter_package_release_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packagename',
+            name='kernel_family',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='packagename',
+            name='kernel_flavour',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(classify_kernel_names, reverse_classify),
+    ]
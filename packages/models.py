@@ -18,19 +18,17 @@
 from django.db import models
 from django.urls import reverse
 
-try:
-    from version_utils.rpm import labelCompare
-except ImportError:
-    from rpm import labelCompare
-from debian.debian_support import Version, version_compare
-
 from arch.models import PackageArchitecture
+from packages.kernels import get_kernel_classification
 from packages.managers import PackageManager
+from packages.versions import get_version_key
 
 
 class PackageName(models.Model):
 
     name = models.CharField(unique=True, max_length=255)
+    kernel_family = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    kernel_flavour = models.CharField(max_length=255, blank=True, null=True)
 
     class Meta:
         verbose_name = 'Package'
@@ -43,6 +41,15 @@ class PackageName(models.Model):
     def get_absolute_url(self):
         return reverse('packages:package_name_detail', args=[self.name])
 
+    def save(self, *args, **kwargs):
+        self.classify_kernel()
+        super().save(*args, **kwargs)
+
+    def classify_kernel(self):
+        """ Set the kernel family and flavour of this package name
+        """
+        self.kernel_family, self.kernel_flavour = get_kernel_classification(self.name)
+
 
 class PackageCategory(models.Model):
 
@@ -145,25 +152,24 @@ class Package(models.Model):
         elif self.packagetype == 'D' or self.packagetype == 'A':
             return self._version_string_deb_arch()
 
+    @property
+    def version_key(self):
+        """ Returns a sort key for the package version, computed once per
+            instance, or None if the package type has no version ordering
+        """
+        if '_version_key' not in self.__dict__:
+            self.__dict__['_version_key'] = get_version_key(
+                self.packagetype, self.epoch, self.version, self.release)
+        return self.__dict__['_version_key']
+
     def compare_version(self, other):
-        if self.packagetype == 'R' and other.packagetype == 'R':
-            return labelCompare(self.get_version_string(),
-                                other.get_version_string())
-        elif self.packagetype == 'D' and other.packagetype == 'D':
-            vs = Version(self.get_version_string())
-            vo = Version(other.get_version_string())
-            return version_compare(vs, vo)
-        elif self.packagetype == 'A' and other.packagetype == 'A':
-            if self.epoch == other.epoch \
-                    and self.version == other.version \
-                    and self.release == other.release:
-                return 0
-            vs = Version(self.get_version_string())
-            vo = Version(other.get_version_string())
-            return version_compare(vs, vo)
-        elif self.packagetype == 'G' and other.packagetype == 'G':
-            return labelCompare(self.get_version_string(),
-                                other.get_version_string())
+        if self.packagetype != other.packagetype:
+            return
+        key = self.version_key
+        other_key = other.version_key
+        if key is None or other_key is None:
+            return
+        return (key > other_key) - (key < other_key)
 
     def repo_count(self):
         from repos.models import Repository
@@ -18,6 +18,7 @@ from django.test import TestCase, override_settings
 
 from arch.models import PackageArchitecture
 from packages.models import Package, PackageName, PackageUpdate
+from packages.utils import get_or_create_packages, normalize_package_key
 
 
 @override_settings(
@@ -200,3 +201,39 @@ class PackageUpdateMethodTests(TestCase):
             security=False,
         )
         self.assertFalse(bug_update.security)
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class PackageNameKernelTests(TestCase):
+    """Tests for PackageName kernel classification."""
+
+    def test_kernel_classification(self):
+        """Test kernel names are classified when created."""
+        expected = {
+            'kernel': ('kernel', None),
+            'kernel-core': ('kernel-', None),
+            'linux-lts-headers': ('linux-lts-headers', None),
+            'linux-image-6.8.0-51-generic': ('linux-image-', 'generic'),
+            'linux-image-unsigned-6.8.0-51-lowlatency': ('linux-image-unsigned-', 'lowlatency'),
+            'linux-modules-extra-6.8.0-51-generic': ('linux-modules-extra-', 'generic'),
+            'linux-headers-6.1.0-28-cloud-amd64': ('linux-headers-', 'cloud-amd64'),
+            'linux-modules-nvidia-550-generic': (None, None),
+            'nginx': (None, None),
+        }
+        for name, classification in expected.items():
+            package_name = PackageName.objects.create(name=name)
+            package_name.refresh_from_db()
+            self.assertEqual((package_name.kernel_family, package_name.kernel_flavour), classification, name)
+
+    def test_kernel_classification_bulk(self):
+        """Test kernel names created in bulk are classified."""
+        keys = [
+            normalize_package_key('linux-image-6.8.0-51-generic', '', '6.8.0', '51.52', 'amd64', Package.DEB),
+            normalize_package_key('bash', '', '5.1', '1', 'amd64', Package.DEB),
+        ]
+        get_or_create_packages(keys)
+        self.assertEqual(PackageName.objects.get(name='linux-image-6.8.0-51-generic').kernel_family, 'linux-image-')
+        self.assertIsNone(PackageName.objects.get(name='bash').kernel_family)
@@ -0,0 +1,168 @@
+# Copyright 2025 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from arch.models import PackageArchitecture
+from packages.models import (
+    Package, PackageCategory, PackageName, PackageUpdate,
+)
+from packages.utils import (
+    _lock_package_names, _lookup_packages, get_or_create_package_updates,
+    get_or_create_packages, mark_security_updates, normalize_package_key,
+)
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class BulkPackageTests(TestCase):
+    """Tests for bulk package resolution."""
+
+    def test_normalize_package_key(self):
+        """Test normalize_package_key() lowercases names and clears zero epochs."""
+        key = normalize_package_key('NGINX', '0', '1.18.0', '1', 'amd64', Package.DEB)
+        self.assertEqual(key, ('nginx', '', '1.18.0', '1', 'amd64', Package.DEB, None))
+
+    def test_normalize_package_key_gpg_pubkey(self):
+        """Test normalize_package_key() skips gpg-pubkey pseudo packages."""
+        self.assertIsNone(normalize_package_key('gpg-pubkey', '', 'abc', 'def', 'noarch', Package.RPM))
+
+    def test_get_or_create_packages_creates(self):
+        """Test get_or_create_packages() creates names, arches and packages."""
+        keys = [
+            normalize_package_key('nginx', '', '1.18.0', '1', 'amd64', Package.DEB),
+            normalize_package_key('curl', '', '7.81.0', '1', 'amd64', Package.DEB),
+        ]
+        package_ids = get_or_create_packages(keys)
+        self.assertEqual(len(package_ids), 2)
+        self.assertEqual(Package.objects.count(), 2)
+        self.assertEqual(PackageName.objects.count(), 2)
+        self.assertEqual(PackageArchitecture.objects.count(), 1)
+        package = Package.objects.get(id=package_ids[keys[0]])
+        self.assertEqual(package.name.name, 'nginx')
+
+    def test_get_or_create_packages_reuses_existing(self):
+        """Test get_or_create_packages() returns existing packages."""
+        arch = PackageArchitecture.objects.create(name='x86_64')
+        name = PackageName.objects.create(name='bash')
+        existing = Package.objects.create(
+            name=name, arch=arch, epoch='', version='5.1', release='1.el9', packagetype=Package.RPM)
+        key = normalize_package_key('bash', '', '5.1', '1.el9', 'x86_64', Package.RPM)
+        package_ids = get_or_create_packages([key, key])
+        self.assertEqual(package_ids, {key: existing.id})
+        self.assertEqual(Package.objects.count(), 1)
+
+    def test_get_or_create_packages_locks_names(self):
+        """Test get_or_create_packages() only creates packages while holding their name locks."""
+        existing = normalize_package_key('bash', '', '5.1', '1.el9', 'x86_64', Package.RPM)
+        get_or_create_packages([existing])
+        new = normalize_package_key('curl', '', '7.76.1', '1.el9', 'x86_64', Package.RPM)
+        with patch('packages.utils._lock_package_names', wraps=_lock_package_names) as lock:
+            get_or_create_packages([existing])
+            lock.assert_not_called()
+            package_ids = get_or_create_packages([existing, new])
+        lock.assert_called_once_with({PackageName.objects.get(name='curl').id})
+        self.assertEqual(Package.objects.get(id=package_ids[new]).name.name, 'curl')
+
+    def test_lookup_packages_exact_keys(self):
+        """Test _lookup_packages() only fetches the packages matching the given keys."""
+        arch = PackageArchitecture.objects.create(name='x86_64')
+        name = PackageName.objects.create(name='bash')
+        packages = [
+            Package.objects.create(
+                name=name, arch=arch, epoch='', version=f'5.{i}', release='1.el9', packagetype=Package.RPM)
+            for i in range(5)
+        ]
+        dkey = (name.id, '', '5.2', '1.el9', arch.id, Package.RPM, None)
+        self.assertEqual(_lookup_packages([dkey]), {dkey: packages[2].id})
+
+    def test_get_or_create_packages_gentoo_category(self):
+        """Test get_or_create_packages() sets the category of uncategorized gentoo packages."""
+        arch = PackageArchitecture.objects.create(name='amd64')
+        name = PackageName.objects.create(name='portage')
+        existing = Package.objects.create(
+            name=name, arch=arch, epoch='', version='3.0.63', release='', packagetype=Package.GENTOO)
+        key = normalize_package_key('portage', '', '3.0.63', '', 'amd64', Package.GENTOO, 'sys-apps')
+        package_ids = get_or_create_packages([key])
+        self.assertEqual(package_ids[key], existing.id)
+        existing.refresh_from_db()
+        self.assertEqual(existing.category, PackageCategory.objects.get(name='sys-apps'))
+
+    def test_get_or_create_packages_empty(self):
+        """Test get_or_create_packages() with no packages."""
+        self.assertEqual(get_or_create_packages([None]), {})
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class BulkPackageUpdateTests(TestCase):
+    """Tests for bulk package update resolution."""
+
+    def setUp(self):
+        """Set up test data."""
+        keys = [
+            normalize_package_key('bash', '', version, '1.el9', 'x86_64', Package.RPM)
+            for version in ('5.0', '5.1', '5.2')
+        ]
+        package_ids = get_or_create_packages(keys)
+        self.old, self.new, self.newer = [package_ids[key] for key in keys]
+
+    def test_get_or_create_package_updates(self):
+        """Test get_or_create_package_updates() creates, reuses and upgrades updates."""
+        existing = PackageUpdate.objects.create(oldpackage_id=self.old, newpackage_id=self.new, security=False)
+        update_ids = get_or_create_package_updates([
+            (self.old, self.new, True),
+            (self.old, self.newer, False),
+            (self.old, self.newer, True),
+            (self.new, self.newer, False),
+        ])
+        self.assertEqual(len(update_ids), 3)
+        self.assertEqual(update_ids[(self.old, self.new)], existing.id)
+        self.assertEqual(PackageUpdate.objects.count(), 3)
+        self.assertEqual(
+            set(PackageUpdate.objects.filter(security=True).values_list('oldpackage_id', 'newpackage_id')),
+            {(self.old, self.new), (self.old, self.newer)},
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(get_or_create_package_updates([(self.new, self.newer, False)]),
+                             {(self.new, self.newer): update_ids[(self.new, self.newer)]})
+
+    def test_get_or_create_package_updates_mixed_pairs(self):
+        """Test an existing update for a pair that was not asked for is ignored."""
+        unrelated = PackageUpdate.objects.create(oldpackage_id=self.old, newpackage_id=self.newer, security=False)
+        update_ids = get_or_create_package_updates([
+            (self.old, self.new, True),
+            (self.new, self.newer, False),
+        ])
+        self.assertEqual(set(update_ids), {(self.old, self.new), (self.new, self.newer)})
+        self.assertNotIn(unrelated.id, update_ids.values())
+        unrelated.refresh_from_db()
+        self.assertFalse(unrelated.security)
+
+    def test_mark_security_updates(self):
+        """Test mark_security_updates() marks updates and removes duplicates."""
+        PackageUpdate.objects.create(oldpackage_id=self.old, newpackage_id=self.new, security=False)
+        PackageUpdate.objects.create(oldpackage_id=self.old, newpackage_id=self.new, security=True)
+        PackageUpdate.objects.create(oldpackage_id=self.new, newpackage_id=self.newer, security=False)
+        self.assertEqual(mark_security_updates(PackageUpdate.objects.all()), 1)
+        self.assertEqual(PackageUpdate.objects.count(), 2)
+        self.assertFalse(PackageUpdate.objects.filter(security=False).exists())
@@ -14,10 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+from debian.debian_support import version_compare
 from django.test import TestCase, override_settings
 
 from arch.models import PackageArchitecture
 from packages.models import Package, PackageName
+from packages.versions import deb_evr_key, get_version_key, rpm_version_key
 
 
 @override_settings(
@@ -314,3 +316,67 @@ class GetVersionStringTests(TestCase):
         )
         result = pkg.get_version_string()
         self.assertEqual(result, ('', '2.0.0', 'r1'))
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class VersionKeyTests(TestCase):
+    """Tests for memoized package version sort keys."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.arch = PackageArchitecture.objects.create(name='x86_64')
+        self.pkg_name = PackageName.objects.create(name='openssl')
+
+    def _create(self, packagetype, epoch, version, release):
+        """Helper to create a package."""
+        return Package.objects.create(
+            name=self.pkg_name,
+            arch=self.arch,
+            epoch=epoch,
+            version=version,
+            release=release,
+            packagetype=packagetype,
+        )
+
+    def test_rpm_key_ordering(self):
+        """Test rpm keys follow rpmvercmp ordering."""
+        versions = ['1.0~rc1', '1.0', '1.0^git1', '1.0a', '1.0.1', '1.00.2', '1.10']
+        keys = [get_version_key(Package.RPM, '', version, '1') for version in versions]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(rpm_version_key('1.0'), rpm_version_key('1_0'))
+        self.assertEqual(rpm_version_key('001'), rpm_version_key('1'))
+
+    def test_rpm_empty_epoch_equals_zero(self):
+        """Test an empty rpm epoch sorts the same as epoch 0."""
+        pkg1 = self._create(Package.RPM, '', '2.4.57', '5.el9')
+        pkg2 = self._create(Package.RPM, '0', '2.4.57', '5.el9')
+        self.assertEqual(pkg1.compare_version(pkg2), 0)
+
+    def test_deb_key_matches_version_compare(self):
+        """Test deb keys agree with python-debian version comparison."""
+        versions = ['1.0~rc1-1', '1.0-1', '1.0-1ubuntu1', '1.0+dfsg-1', '1.0.0-1',
+                    '1.0a-1', '1:0.9-1', '1.0-1~bpo1', '2~~-1', '2~-1', '2-1']
+        for v1 in versions:
+            for v2 in versions:
+                expected = version_compare(v1, v2)
+                expected = (expected > 0) - (expected < 0)
+                key1 = deb_evr_key(v1)
+                key2 = deb_evr_key(v2)
+                self.assertEqual((key1 > key2) - (key1 < key2), expected, (v1, v2))
+
+    def test_version_key_memoized_on_instance(self):
+        """Test version_key is computed once per package instance."""
+        pkg = self._create(Package.DEB, '', '1.0', '1')
+        key = pkg.version_key
+        self.assertIs(pkg.version_key, key)
+        self.assertEqual(key, get_version_key(Package.DEB, '', '1.0', '1'))
+
+    def test_compare_different_types(self):
+        """Test packages of different types are not comparable."""
+        pkg1 = self._create(Package.RPM, '', '1.0', '1')
+        pkg2 = self._create(Package.DEB, '', '1.0', '1')
+        self.assertIsNone(pkg1.compare_version(pkg2))
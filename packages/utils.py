@@ -18,15 +18,23 @@
 import re
 
 from django.core.exceptions import MultipleObjectsReturned
-from django.db import IntegrityError, transaction
-from django.db.models import Count, Min
+from django.db import transaction
+from django.db.models import Count, Exists, Min, OuterRef, Q
 
 from arch.models import PackageArchitecture
+from arch.utils import get_or_create_package_arch
 from packages.models import (
     Package, PackageCategory, PackageName, PackageString, PackageUpdate,
 )
+from util.cache import get_cached, get_ingestion_caches, set_cached
 from util.logging import error_message, info_message, warning_message
 
+# batch size for bulk package queries, keeps IN clauses within sqlite limits
+BULK_BATCH_SIZE = 500
+# batch size for exact package key lookups, which use six parameters per key
+LOOKUP_BATCH_SIZE = 100
+PACKAGE_KEY_FIELDS = ('name_id', 'epoch', 'version', 'release', 'arch_id', 'packagetype')
+
 
 def convert_package_to_packagestring(package):
     """ Convert a Package object to a PackageString object
@@ -174,8 +182,8 @@ def get_or_create_package(name, epoch, version, release, arch, p_type):
     if epoch in [None, 0, '0']:
         epoch = ''
 
-    package_name, c = PackageName.objects.get_or_create(name=name)
-    package_arch, c = PackageArchitecture.objects.get_or_create(name=arch)
+    package_name = get_or_create_package_name(name)
+    package_arch = get_or_create_package_arch(arch)
     with transaction.atomic():
         try:
             package, c = Package.objects.get_or_create(
@@ -203,43 +211,266 @@ def get_or_create_package(name, epoch, version, release, arch, p_type):
     return package
 
 
+def get_or_create_package_name(name):
+    """ Get or create a PackageName, using the ingestion cache if active
+        Returns the PackageName
+    """
+    return get_cached(
+        'packagename', name,
+        lambda: PackageName.objects.get_or_create(name=name)[0],
+    )
+
+
+def normalize_package_key(name, epoch, version, release, arch, p_type, category=None):
+    """ Normalize package attributes into the natural key used by
+        get_or_create_packages. Returns None for the pseudo package gpg-pubkey.
+        The repo of gentoo packages is not part of the key, as it is not
+        stored.
+    """
+    name = name.lower()
+    if name == 'gpg-pubkey':
+        return
+    if epoch in [None, 0, '0']:
+        epoch = ''
+    return (name, epoch, version, release, arch, p_type, category or None)
+
+
+def _chunks(items, size):
+    """ Split a list of items into lists of at most size items
+    """
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _bulk_get_or_create_names(model, names, cache_name=None):
+    """ Bulk get or create rows of a model with a unique name field, using the
+        named ingestion cache if one is active.
+        Returns a dict mapping name to id
+    """
+    name_ids = {}
+    caches = get_ingestion_caches()
+    if cache_name and caches is not None and cache_name in caches:
+        cache = caches[cache_name]
+        for name in names:
+            cached = cache.get(name)
+            if cached is not None:
+                name_ids[name] = cached.id
+    names = [name for name in names if name not in name_ids]
+    if not names:
+        return name_ids
+    objs = [model(name=name) for name in names]
+    if model is PackageName:
+        for obj in objs:
+            obj.classify_kernel()
+    model.objects.bulk_create(objs, ignore_conflicts=True)
+    for chunk in _chunks(names, BULK_BATCH_SIZE):
+        for name, name_id in model.objects.filter(name__in=chunk).values_list('name', 'id'):
+            name_ids[name] = name_id
+            if cache_name:
+                set_cached(cache_name, name, model(id=name_id, name=name))
+    return name_ids
+
+
+def _lookup_packages(db_keys):
+    """ Fetch the natural keys of the packages that match the given database
+        keys in name, epoch, version, release, arch and type, in any category.
+        Returns a dict mapping (name_id, epoch, version, release, arch_id,
+        packagetype, category_id) to the lowest matching package id
+    """
+    existing = {}
+    for chunk in _chunks({dkey[:6] for dkey in db_keys}, LOOKUP_BATCH_SIZE):
+        q = Q()
+        for key in chunk:
+            q |= Q(**dict(zip(PACKAGE_KEY_FIELDS, key)))
+        rows = Package.objects.filter(q).order_by('-id').values_list(*PACKAGE_KEY_FIELDS, 'category_id', 'id')
+        for row in rows:
+            existing[row[:-1]] = row[-1]
+    return existing
+
+
+def get_or_create_packages(package_keys):
+    """ Bulk get or create Package objects from a list of normalized package
+        keys (see normalize_package_key). PackageNames, PackageArchitectures,
+        PackageCategories and Packages are resolved in batched queries rather
+        than per package. Returns a dict mapping each key to a Package id.
+    """
+    package_keys = {key for key in package_keys if key is not None}
+    if not package_keys:
+        return {}
+
+    name_ids = _bulk_get_or_create_names(PackageName, {key[0] for key in package_keys}, 'packagename')
+    arch_ids = _bulk_get_or_create_names(PackageArchitecture, {key[4] for key in package_keys}, 'packagearchitecture')
+    category_ids = _bulk_get_or_create_names(PackageCategory, {key[6] for key in package_keys if key[6]})
+
+    def db_key(key):
+        name, epoch, version, release, arch, p_type, category = key
+        return (name_ids[name], epoch, version, release, arch_ids[arch], p_type, category_ids.get(category))
+
+    db_keys = {key: db_key(key) for key in package_keys}
+    existing = _lookup_packages(db_keys.values())
+    missing_name_ids = {dkey[0] for dkey in db_keys.values() if dkey not in existing}
+    if missing_name_ids:
+        with transaction.atomic():
+            _lock_package_names(missing_name_ids)
+            existing = _create_packages(db_keys)
+
+    package_ids = {}
+    for key, dkey in db_keys.items():
+        package_id = existing.get(dkey)
+        if package_id is None:
+            error_message(text=f'Unable to get or create package: {key}')
+            continue
+        package_ids[key] = package_id
+    return package_ids
+
+
+def _lock_package_names(name_ids):
+    """ Lock the PackageName rows with the given ids until the end of the
+        current transaction, in id order so that concurrent callers cannot
+        deadlock. The unique constraint of Package does not apply when its
+        category is NULL, so packages are only created while holding the
+        locks of their names, to stop concurrent processes from creating the
+        same package twice. Databases without row locks, such as SQLite,
+        only allow a single writer anyway.
+    """
+    for chunk in _chunks(sorted(name_ids), BULK_BATCH_SIZE):
+        list(PackageName.objects.select_for_update().filter(id__in=chunk).order_by('id').values_list('id', flat=True))
+
+
+def _create_packages(db_keys):
+    """ Create the packages for the database keys of db_keys that do not
+        exist yet. Must be called while holding the locks of the names of the
+        packages to create (see _lock_package_names). Returns a dict mapping
+        the database keys of the matching packages to their lowest package id
+        (see _lookup_packages)
+    """
+    existing = _lookup_packages(db_keys.values())
+
+    # gentoo packages may have been created without a category, so reuse
+    # those and set the category, as get_or_create_package callers do
+    uncategorized = {}
+    for key, package_id in existing.items():
+        if key[6] is None:
+            uncategorized[key[:6]] = package_id
+
+    missing = []
+    recategorize = {}
+    for key, dkey in db_keys.items():
+        if dkey in existing:
+            continue
+        if dkey[6] is not None and dkey[:6] in uncategorized:
+            recategorize.setdefault(dkey[6], []).append(uncategorized.pop(dkey[:6]))
+            continue
+        name_id, epoch, version, release, arch_id, p_type, category_id = dkey
+        missing.append(Package(
+            name_id=name_id,
+            epoch=epoch,
+            version=version,
+            release=release,
+            arch_id=arch_id,
+            packagetype=p_type,
+            category_id=category_id,
+        ))
+
+    for category_id, package_ids in recategorize.items():
+        Package.objects.filter(id__in=package_ids).update(category_id=category_id)
+    if missing:
+        Package.objects.bulk_create(missing, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+    if missing or recategorize:
+        existing = _lookup_packages(db_keys.values())
+    return existing
+
+
+def _lookup_package_updates(pairs):
+    """ Returns a dict mapping each (oldpackage_id, newpackage_id) pair that
+        has a PackageUpdate to its (id, security). If both a security and a
+        non-security version of an update exist, the security one is used.
+        The query matches any combination of the old and new ids in a batch,
+        so updates for pairs that were not asked for are dropped.
+    """
+    pairs = list(pairs)
+    existing = {}
+    for i in range(0, len(pairs), BULK_BATCH_SIZE):
+        batch = set(pairs[i:i + BULK_BATCH_SIZE])
+        updates = PackageUpdate.objects.filter(
+            oldpackage_id__in={pair[0] for pair in batch},
+            newpackage_id__in={pair[1] for pair in batch},
+        ).order_by('security')
+        for update_id, old_id, new_id, security in updates.values_list(
+                'id', 'oldpackage_id', 'newpackage_id', 'security'):
+            if (old_id, new_id) in batch:
+                existing[(old_id, new_id)] = (update_id, security)
+    return existing
+
+
+def get_or_create_package_updates(updates):
+    """ Bulk get or create PackageUpdate objects from a list of
+        (oldpackage_id, newpackage_id, security) tuples. Existing updates are
+        resolved with batched queries, and existing non-security updates
+        that should be security updates are marked as such with one UPDATE.
+        If any of the tuples for an update has security=True, it is marked
+        as a security update, as different distros may mark the same update
+        in different ways and we err on the side of caution.
+        Returns a dict mapping each (oldpackage_id, newpackage_id) pair to a
+        PackageUpdate id.
+    """
+    wanted = {}
+    for old_id, new_id, security in updates:
+        wanted[(old_id, new_id)] = wanted.get((old_id, new_id), False) or bool(security)
+    if not wanted:
+        return {}
+
+    existing = _lookup_package_updates(wanted)
+    upgrade_ids = [
+        update_id for pair, (update_id, security) in existing.items()
+        if wanted[pair] and not security
+    ]
+    if upgrade_ids:
+        PackageUpdate.objects.filter(id__in=upgrade_ids).update(security=True)
+    missing = [
+        PackageUpdate(oldpackage_id=old_id, newpackage_id=new_id, security=security)
+        for (old_id, new_id), security in wanted.items() if (old_id, new_id) not in existing
+    ]
+    if missing:
+        PackageUpdate.objects.bulk_create(missing, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+        existing.update(_lookup_package_updates(
+            (update.oldpackage_id, update.newpackage_id) for update in missing))
+
+    update_ids = {}
+    for pair in wanted:
+        if pair not in existing:
+            error_message(text=f'Unable to get or create package update: {pair[0]} -> {pair[1]}')
+            continue
+        update_ids[pair] = existing[pair][0]
+    return update_ids
+
+
 def get_or_create_package_update(oldpackage, newpackage, security):
     """ Get or create a PackageUpdate object. Returns the object. Returns None
         if it cannot be created
     """
-    # see if any version of this update exists
-    # if it's already marked as a security update, leave it that way
-    # if not, mark it as a security update if security==True
-    # this could be an issue if different distros mark the same update
-    # in different ways (security vs bugfix) but in reality this is not
-    # very likely to happen. if it does, we err on the side of caution
-    # and mark it as the security update
-    try:
-        update = PackageUpdate.objects.get(oldpackage=oldpackage, newpackage=newpackage)
-    except PackageUpdate.DoesNotExist:
-        update = None
-    except MultipleObjectsReturned:
-        e = 'Error: MultipleObjectsReturned when attempting to add package \n'
-        e += f'update with oldpackage={oldpackage} | newpackage={newpackage}:'
-        error_message(text=e)
-        updates = PackageUpdate.objects.filter(oldpackage=oldpackage, newpackage=newpackage)
-        for update in updates:
-            error_message(text=str(update))
+    update_ids = get_or_create_package_updates([(oldpackage.id, newpackage.id, security)])
+    update_id = update_ids.get((oldpackage.id, newpackage.id))
+    if update_id is None:
         return
-    try:
-        if update:
-            if security and not update.security:
-                update.security = True
-                update.save()
-        else:
-            update, c = PackageUpdate.objects.get_or_create(
-                oldpackage=oldpackage,
-                newpackage=newpackage,
-                security=security,
-            )
-    except IntegrityError:
-        update = PackageUpdate.objects.get(oldpackage=oldpackage, newpackage=newpackage, security=security)
-    return update
+    return PackageUpdate.objects.get(id=update_id)
+
+
+def mark_security_updates(updates):
+    """ Mark the non-security PackageUpdates in the updates QuerySet as
+        security updates with one UPDATE. Non-security updates that already
+        have a security version are deleted instead.
+        Returns the number of updates that were marked.
+    """
+    updates = updates.filter(security=False)
+    security_versions = PackageUpdate.objects.filter(
+        oldpackage=OuterRef('oldpackage'),
+        newpackage=OuterRef('newpackage'),
+        security=True,
+    )
+    updates.filter(Exists(security_versions)).delete()
+    return updates.update(security=True)
 
 
 def get_matching_packages(name, epoch, version, release, p_type, arch=None):
@@ -324,6 +555,7 @@ def clean_packages(remove_duplicates=False):
         info_message(text=f'Removing {plen} orphaned Packages')
         packages.delete()
     if remove_duplicates:
+        from repos.models import Mirror
         info_message(text='Checking for duplicate Packages...')
         duplicates = Package.objects.values(
             'name', 'arch', 'epoch', 'version', 'release', 'packagetype', 'category'
@@ -341,6 +573,8 @@ def clean_packages(remove_duplicates=False):
             ).exclude(id=dup['keep_id'])
             for package in to_delete:
                 info_message(text=f'Removing duplicate Package {package}')
+                # the latest Package index of these mirrors needs rebuilding
+                Mirror.objects.filter(packages=package).update(latest_packages_indexed=False)
                 package.delete()
 
 
@@ -0,0 +1,129 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+import re
+from functools import lru_cache
+
+from debian.debian_support import Version
+
+VERSION_KEY_CACHE_SIZE = 65536
+
+_rpm_segment_re = re.compile(r'~|\^|[0-9]+|[a-zA-Z]+')
+_deb_part_re = re.compile(r'\d+|\D+')
+_deb_digit_re = re.compile(r'\d')
+_deb_alpha_re = re.compile(r'[A-Za-z]')
+
+# rpm segment classes, in the order rpmvercmp sorts them
+_RPM_TILDE = (0,)
+_RPM_END = (1,)
+_RPM_CARET = (2,)
+_RPM_ALPHA = 3
+_RPM_NUMERIC = 4
+
+# the part that debian version strings are padded with when compared
+_DEB_PADDING = (1, 0)
+
+
+def rpm_version_key(version):
+    """ Returns a sort key for an rpm version or release string, so that
+        comparing keys gives the same result as rpmvercmp
+    """
+    key = []
+    for segment in _rpm_segment_re.findall(version or ''):
+        if segment == '~':
+            key.append(_RPM_TILDE)
+        elif segment == '^':
+            key.append(_RPM_CARET)
+        elif segment.isdigit():
+            key.append((_RPM_NUMERIC, int(segment)))
+        else:
+            key.append((_RPM_ALPHA, segment))
+    key.append(_RPM_END)
+    return tuple(key)
+
+
+def rpm_evr_key(epoch, version, release):
+    """ Returns a sort key for an rpm epoch, version and release
+    """
+    return (rpm_version_key(epoch or '0'), rpm_version_key(version), rpm_version_key(release))
+
+
+def _deb_char_order(char):
+    """ Returns the weight of a character when comparing debian versions
+    """
+    if char == '~':
+        return -1
+    if _deb_digit_re.match(char):
+        return int(char) + 1
+    if _deb_alpha_re.match(char):
+        return ord(char)
+    return ord(char) + 256
+
+
+def _deb_part_key(part):
+    """ Returns a sort key for a run of digits or non-digits in a debian
+        version string. Digit runs compare numerically, other runs compare
+        by character weight, and runs of different kinds are ordered by the
+        weight of their first character.
+    """
+    if _deb_digit_re.match(part):
+        return (1, int(part))
+    weights = tuple(_deb_char_order(char) for char in part) + (0,)
+    if part[0] == '~':
+        return (0, weights)
+    return (2, weights)
+
+
+def deb_version_key(version):
+    """ Returns a sort key for a debian upstream version or revision string.
+        Debian pads the shorter of two versions with '0' parts, so runs of
+        padding parts are encoded relative to the part that follows them.
+    """
+    key = []
+    skipped = 0
+    for part in _deb_part_re.findall(version or '0'):
+        part_key = _deb_part_key(part)
+        if part_key == _DEB_PADDING:
+            skipped += 1
+            continue
+        sign = 1 if part_key > _DEB_PADDING else -1
+        key.append((sign, -sign * skipped, part_key))
+        skipped = 0
+    key.append((0,))
+    return tuple(key)
+
+
+def deb_evr_key(version_string):
+    """ Returns a sort key for a full debian version string
+    """
+    version = Version(version_string)
+    return (int(version.epoch or '0'),
+            deb_version_key(version.upstream_version),
+            deb_version_key(version.debian_revision))
+
+
+@lru_cache(maxsize=VERSION_KEY_CACHE_SIZE)
+def get_version_key(packagetype, epoch, version, release):
+    """ Returns a sort key for a package version, or None if the package type
+        has no defined version ordering. Keys are only comparable between
+        packages of the same type.
+    """
+    if packagetype in ('R', 'G'):
+        return rpm_evr_key(epoch, version, release)
+    elif packagetype in ('D', 'A'):
+        epoch = f'{epoch}:' if epoch else ''
+        release = f'-{release}' if release else ''
+        return deb_evr_key(f'{epoch}{version}{release}')
@@ -0,0 +1,41 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reports.utils import compress_reports
+from util.fields import is_compression_enabled
+
+
+class Command(BaseCommand):
+    help = 'Compress the stored data of existing reports'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of reports to compress per batch'
+        )
+
+    def handle(self, *args, **options):
+        if not is_compression_enabled():
+            raise CommandError('Report compression is disabled (COMPRESS_REPORTS = False)')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be a positive integer')
+
+        count = compress_reports(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Checked {count} report(s) for compression'))
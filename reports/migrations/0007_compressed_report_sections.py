@@ -0,0 +1,40 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:01
+
+from django.db import migrations
+
+import util.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0006_report_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='report',
+            name='bug_updates',
+            field=util.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='modules',
+            field=util.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='packages',
+            field=util.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='repos',
+            field=util.fields.CompressedTextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='sec_updates',
+            field=util.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
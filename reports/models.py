@@ -22,6 +22,9 @@ from django.db import models
 from django.urls import reverse
 
 from hosts.utils import get_or_create_host
+from util.cache import ingestion_cache
+from util.counters import deferred_counts
+from util.fields import CompressedTextField
 from util.logging import error_message, info_message
 
 
@@ -38,12 +41,13 @@ class Report(models.Model):
     protocol = models.CharField(max_length=255, null=True)
     useragent = models.CharField(max_length=255, null=True)
     processed = models.BooleanField(default=False)
-    packages = models.TextField(null=True, blank=True)
-    sec_updates = models.TextField(null=True, blank=True)
-    bug_updates = models.TextField(null=True, blank=True)
-    repos = models.TextField(null=True, blank=True)
-    modules = models.TextField(null=True, blank=True)
+    packages = CompressedTextField(null=True, blank=True)
+    sec_updates = CompressedTextField(null=True, blank=True)
+    bug_updates = CompressedTextField(null=True, blank=True)
+    repos = CompressedTextField(null=True, blank=True)
+    modules = CompressedTextField(null=True, blank=True)
     reboot = models.TextField(null=True, blank=True)
+    fingerprint = models.CharField(max_length=64, null=True, blank=True)
 
     class Meta:
         verbose_name_plural = 'Report'
@@ -56,55 +60,61 @@ class Report(models.Model):
     def get_absolute_url(self):
         return reverse('reports:report_detail', args=[str(self.id)])
 
+    JSON_SECTIONS = ('packages', 'repos', 'modules', 'sec_updates', 'bug_updates')
+
+    def get_parsed_section(self, section):
+        """Parse a JSON section for Protocol 2 reports, caching the result."""
+        if self.protocol != '2':
+            return []
+        raw = getattr(self, section)
+        if not raw:
+            return []
+        parsed_sections = self.__dict__.setdefault('_parsed_sections', {})
+        cached = parsed_sections.get(section)
+        if cached is not None and cached[0] is raw:
+            return cached[1]
+        try:
+            parsed = json.loads(raw)
+        except json.JSONDecodeError:
+            parsed = []
+        parsed_sections[section] = (raw, parsed)
+        return parsed
+
+    def set_parsed_sections(self, **sections):
+        """Store already parsed JSON sections as compact JSON and cache them."""
+        parsed_sections = self.__dict__.setdefault('_parsed_sections', {})
+        for section, parsed in sections.items():
+            if section not in self.JSON_SECTIONS:
+                raise ValueError(f'Unknown report section: {section}')
+            parsed = parsed or []
+            raw = json.dumps(parsed, separators=(',', ':'))
+            setattr(self, section, raw)
+            parsed_sections[section] = (raw, parsed)
+
     @property
     def packages_parsed(self):
         """Parse packages JSON for Protocol 2 reports."""
-        if self.protocol == '2' and self.packages:
-            try:
-                return json.loads(self.packages)
-            except json.JSONDecodeError:
-                return []
-        return []
+        return self.get_parsed_section('packages')
 
     @property
     def repos_parsed(self):
         """Parse repos JSON for Protocol 2 reports."""
-        if self.protocol == '2' and self.repos:
-            try:
-                return json.loads(self.repos)
-            except json.JSONDecodeError:
-                return []
-        return []
+        return self.get_parsed_section('repos')
 
     @property
     def modules_parsed(self):
         """Parse modules JSON for Protocol 2 reports."""
-        if self.protocol == '2' and self.modules:
-            try:
-                return json.loads(self.modules)
-            except json.JSONDecodeError:
-                return []
-        return []
+        return self.get_parsed_section('modules')
 
     @property
     def sec_updates_parsed(self):
         """Parse security updates JSON for Protocol 2 reports."""
-        if self.protocol == '2' and self.sec_updates:
-            try:
-                return json.loads(self.sec_updates)
-            except json.JSONDecodeError:
-                return []
-        return []
+        return self.get_parsed_section('sec_updates')
 
     @property
     def bug_updates_parsed(self):
         """Parse bug updates JSON for Protocol 2 reports."""
-        if self.protocol == '2' and self.bug_updates:
-            try:
-                return json.loads(self.bug_updates)
-            except json.JSONDecodeError:
-                return []
-        return []
+        return self.get_parsed_section('bug_updates')
 
     @property
     def has_packages(self):
@@ -183,8 +193,16 @@ class Report(models.Model):
             fqdn = self.host.split('.', 1)
             if len(fqdn) == 2:
                 self.domain = fqdn.pop()
+
+        from reports.utils import get_report_fingerprint
+        self.fingerprint = get_report_fingerprint(
+            self.kernel, self.os, self.arch, self.tags, self.packages, self.repos,
+            self.modules, self.sec_updates, self.bug_updates,
+        )
         self.save()
 
+    @ingestion_cache()
+    @deferred_counts()
     def process(self, find_updates=True, verbose=False):
         """ Process a report and extract os, arch, domain, packages, repos etc
         """
@@ -196,6 +214,13 @@ class Report(models.Model):
             info_message(text=f'Report {self.id} has already been processed')
             return
 
+        if self.fingerprint and self.host:
+            from hosts.models import Host
+            host = Host.objects.filter(hostname=self.host, report_fingerprint=self.fingerprint).first()
+            if host:
+                self.process_unchanged(host, find_updates, verbose)
+                return
+
         from reports.utils import get_arch, get_domain, get_os
         arch = get_arch(self.arch)
         osvariant = get_os(self.os, arch)
@@ -206,23 +231,15 @@ class Report(models.Model):
             info_message(text=f'Processing report {self.id} - {self.host}')
 
         if self.protocol == '2':
-            # Protocol 2: JSON data
-            import json
-
+            # Protocol 2: JSON data, parsed once and cached on the instance
             from reports.utils import (
                 process_modules_json, process_packages_json,
                 process_repos_json, process_updates_json,
             )
-            packages_json = json.loads(self.packages) if self.packages else []
-            repos_json = json.loads(self.repos) if self.repos else []
-            modules_json = json.loads(self.modules) if self.modules else []
-            sec_updates_json = json.loads(self.sec_updates) if self.sec_updates else []
-            bug_updates_json = json.loads(self.bug_updates) if self.bug_updates else []
-
-            process_repos_json(repos_json, host, self.arch)
-            process_modules_json(modules_json, host)
-            process_packages_json(packages_json, host)
-            process_updates_json(sec_updates_json, bug_updates_json, host)
+            process_repos_json(self.repos_parsed, host, self.arch)
+            process_modules_json(self.modules_parsed, host)
+            process_packages_json(self.packages_parsed, host)
+            process_updates_json(self.sec_updates_parsed, self.bug_updates_parsed, host)
         else:
             # Protocol 1: Text data
             from reports.utils import (
@@ -236,8 +253,32 @@ class Report(models.Model):
 
         self.processed = True
         self.save()
+        host.report_fingerprint = self.fingerprint
+        host.updates_fingerprint = host.get_updates_fingerprint()
+        host.updates_stale = True
+        host.save(update_fields=['report_fingerprint', 'updates_fingerprint', 'updates_stale'])
 
         if find_updates:
             if verbose:
                 info_message(text=f'Finding updates for report {self.id} - {self.host}')
             host.find_updates()
+
+    def process_unchanged(self, host, find_updates=True, verbose=False):
+        """ Process a report whose contents match the last report processed
+            for the host. Only the report time and reboot status are updated,
+            and updates are only found again if the hosts repos have changed.
+        """
+        if verbose:
+            info_message(text=f'Report {self.id} - {self.host} is unchanged, skipping package processing')
+        host.ipaddress = self.report_ip
+        host.lastreport = self.created
+        host.reboot_required = self.reboot == 'True'
+        host.save(update_fields=['ipaddress', 'lastreport', 'reboot_required'])
+
+        self.processed = True
+        self.save()
+
+        if find_updates and host.repos_changed_since(host.updated_at):
+            if verbose:
+                info_message(text=f'Finding updates for report {self.id} - {self.host}')
+            host.find_updates()
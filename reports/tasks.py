@@ -16,11 +16,15 @@
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
 from celery import shared_task
+from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Max
 from django.db.utils import OperationalError
 
 from hosts.models import Host
 from reports.models import Report
+from util import get_setting_of_type
+from util.cache import ingestion_cache
 from util.logging import info_message, warning_message
 
 
@@ -31,11 +35,19 @@ from util.logging import info_message, warning_message
     retry_backoff=True,
     retry_kwargs={'max_retries': 5}
 )
+@ingestion_cache()
 def process_report(self, report_id):
     """ Task to process a single report
     """
     report = Report.objects.get(id=report_id)
-    report_id_lock_key = f'process_report_id_lock_{report_id}'
+    process_report_with_lock(report)
+
+
+def process_report_with_lock(report, find_updates=True):
+    """ Process a report, ensuring that only one report per host is processed
+        at a time
+    """
+    report_id_lock_key = f'process_report_id_lock_{report.id}'
     if report.host:
         report_host_lock_key = f'process_report_host_lock_{report.host}'
     else:
@@ -58,13 +70,67 @@ def process_report(self, report_id):
             else:
                 try:
                     cache.set(report_host_lock_key, report.id, lock_expire)
-                    report.process()
+                    report.process(find_updates=find_updates)
                 finally:
                     cache.delete(report_host_lock_key)
         finally:
             cache.delete(report_id_lock_key)
     else:
-        warning_message(f'Already processing report {report_id}, skipping task.')
+        warning_message(f'Already processing report {report.id}, skipping task.')
+
+
+def queue_report(report):
+    """ Queue a report for processing. If celery tasks are run eagerly the
+        report instance is processed in-process, so that sections that were
+        already parsed during upload are not decoded again
+    """
+    if getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+        with ingestion_cache():
+            process_report_with_lock(report)
+    else:
+        process_report.delay(report.id)
+
+
+def get_report_batch_size():
+    """ Find the number of reports to load per batch when batch processing
+    """
+    return get_setting_of_type(
+        setting_name='REPORT_BATCH_SIZE',
+        setting_type=int,
+        default=100,
+    )
+
+
+def mark_superseded_reports(reports):
+    """ Mark all but the newest unprocessed report of each host as processed,
+        using a single update. Reports without a host are left untouched.
+        Returns the number of reports that were marked as processed
+    """
+    pending = reports.filter(processed=False).exclude(host__isnull=True).exclude(host='')
+    latest_ids = pending.order_by().values('host').annotate(latest_id=Max('id')).values('latest_id')
+    return pending.exclude(id__in=latest_ids).update(processed=True)
+
+
+def process_reports_batch(reports=None, find_updates=True, batch_size=None):
+    """ Process unprocessed reports in batches, sharing the ingestion caches
+        between the reports of a batch. Only the newest unprocessed report of each host is
+        processed, older ones are marked as processed without being loaded.
+        Returns the number of reports that were processed
+    """
+    if reports is None:
+        reports = Report.objects.all()
+    batch_size = batch_size or get_report_batch_size()
+    superseded = mark_superseded_reports(reports)
+    if superseded:
+        info_message(text=f'Marked {superseded} superseded Reports as processed')
+
+    report_ids = list(reports.filter(processed=False).order_by('id').values_list('id', flat=True))
+    for i in range(0, len(report_ids), batch_size):
+        batch = Report.objects.filter(id__in=report_ids[i:i + batch_size]).order_by('id')
+        with ingestion_cache():
+            for report in batch:
+                process_report_with_lock(report, find_updates)
+    return len(report_ids)
 
 
 @shared_task(priority=1)
@@ -76,6 +142,13 @@ def process_reports():
         process_report.delay(report.id)
 
 
+@shared_task(priority=1)
+def process_reports_in_batches():
+    """ Task to process all unprocessed reports in batches within one worker
+    """
+    process_reports_batch()
+
+
 @shared_task(priority=2)
 def remove_reports_with_no_hosts():
     """ Task to remove processed reports where the host no longer exists
@@ -14,6 +14,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import gzip
+import json
+
+import zstandard
 from django.contrib.auth.models import User
 from django.test import TestCase, override_settings
 from rest_framework import status
@@ -141,6 +145,35 @@ class ReportAPITests(APITestCase):
         self.assertEqual(report.host, 'server1.example.com')
         self.assertEqual(report.tags, 'web,production')
         self.assertEqual(report.reboot, 'True')
+        self.assertEqual(len(report.fingerprint), 64)
+
+    def test_upload_compressed_report(self):
+        """Test uploading zstd and gzip encoded reports."""
+        data = json.dumps({
+            'protocol': 2,
+            'hostname': 'testhost.example.com',
+            'arch': 'x86_64',
+            'kernel': '5.15.0-91-generic',
+            'os': 'Ubuntu 22.04.3 LTS',
+            'packages': [{'name': 'nginx', 'version': '1.18.0', 'arch': 'amd64', 'type': 'deb'}],
+        }).encode('utf-8')
+        for encoding, body in (('zstd', zstandard.compress(data)), ('gzip', gzip.compress(data))):
+            response = self.client.generic(
+                'POST', self.url, body, content_type='application/json',
+                HTTP_CONTENT_ENCODING=encoding,
+            )
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            report = Report.objects.get(id=response.data['report_id'])
+            self.assertEqual(report.packages_parsed[0]['name'], 'nginx')
+
+    def test_upload_invalid_content_encoding(self):
+        """Test that unsupported or corrupt encoded bodies return 400."""
+        for encoding, body in (('br', b'{}'), ('zstd', b'not zstd'), ('gzip', b'not gzip')):
+            response = self.client.generic(
+                'POST', self.url, body, content_type='application/json',
+                HTTP_CONTENT_ENCODING=encoding,
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
     def test_upload_missing_required_field(self):
         """Test that missing required fields return 400."""
@@ -16,9 +16,12 @@
 
 import json
 
+from django.db import connection
 from django.test import TestCase, override_settings
 
 from reports.models import Report
+from reports.utils import compress_reports
+from util.fields import COMPRESSED_PREFIX
 
 
 @override_settings(
@@ -187,6 +190,30 @@ class ReportParsedPropertiesTests(TestCase):
         )
         self.assertEqual(report.bug_updates_parsed, updates)
 
+    def test_parsed_section_is_cached(self):
+        """Test parsed sections are decoded once and reused."""
+        packages = [{'name': 'nginx', 'version': '1.18.0', 'arch': 'amd64', 'type': 'deb'}]
+        report = Report.objects.create(
+            host='testhost.example.com',
+            protocol='2',
+            packages=json.dumps(packages),
+        )
+        self.assertIs(report.packages_parsed, report.packages_parsed)
+        report.packages = json.dumps([])
+        self.assertEqual(report.packages_parsed, [])
+
+    def test_set_parsed_sections(self):
+        """Test set_parsed_sections stores compact JSON and keeps parsed data."""
+        packages = [{'name': 'nginx', 'version': '1.18.0', 'arch': 'amd64', 'type': 'deb'}]
+        report = Report(host='testhost.example.com', protocol='2')
+        report.set_parsed_sections(packages=packages, repos=None)
+        self.assertIs(report.packages_parsed, packages)
+        self.assertEqual(report.repos, '[]')
+        self.assertNotIn(' ', report.packages)
+        report.save()
+        report = Report.objects.get(id=report.id)
+        self.assertEqual(report.packages_parsed, packages)
+
 
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
@@ -474,3 +501,136 @@ class ReportParseMethodTests(TestCase):
         report.parse(data, meta)
 
         self.assertEqual(report.reboot, 'True')
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class ReportFingerprintTests(TestCase):
+    """Tests for report fingerprints."""
+
+    def setUp(self):
+        self.meta = {
+            'REMOTE_ADDR': '192.168.1.100',
+            'HTTP_USER_AGENT': 'patchman-client/1.0',
+        }
+        self.data = {
+            'host': 'fingerprint.example.com',
+            'arch': 'x86_64',
+            'kernel': '5.15.0-91-generic',
+            'os': 'Ubuntu 22.04.3 LTS',
+            'protocol': '1',
+            'packages': "'nginx' '' '1.18.0' '1' 'amd64' 'deb'\n'curl' '' '7.81.0' '1' 'amd64' 'deb'",
+        }
+
+    def parse_report(self, **kwargs):
+        report = Report()
+        report.parse(dict(self.data, **kwargs), self.meta)
+        return report
+
+    def test_parse_sets_fingerprint(self):
+        """Test parse() computes a fingerprint that ignores package order."""
+        report = self.parse_report()
+        reordered = self.parse_report(
+            packages="'curl' '' '7.81.0' '1' 'amd64' 'deb'\n'nginx' '' '1.18.0' '1' 'amd64' 'deb'")
+        self.assertEqual(len(report.fingerprint), 64)
+        self.assertEqual(report.fingerprint, reordered.fingerprint)
+
+    def test_fingerprint_changes_with_kernel(self):
+        """Test a different kernel gives a different fingerprint."""
+        report = self.parse_report()
+        other = self.parse_report(kernel='5.15.0-92-generic')
+        self.assertNotEqual(report.fingerprint, other.fingerprint)
+
+    def test_unchanged_report_skips_processing(self):
+        """Test a report matching the hosts last fingerprint only updates the host."""
+        from hosts.models import Host
+        first = self.parse_report()
+        first.process(find_updates=False)
+        host = Host.objects.get(hostname='fingerprint.example.com')
+        self.assertEqual(host.report_fingerprint, first.fingerprint)
+        self.assertEqual(host.packages.count(), 2)
+
+        host.packages.clear()
+        second = self.parse_report(reboot='True')
+        second.process(find_updates=False)
+
+        second.refresh_from_db()
+        host.refresh_from_db()
+        self.assertTrue(second.processed)
+        self.assertTrue(host.reboot_required)
+        self.assertEqual(host.lastreport, second.created)
+        self.assertEqual(host.packages.count(), 0)
+
+    def test_changed_report_is_processed(self):
+        """Test a report with a new fingerprint is fully processed."""
+        from hosts.models import Host
+        self.parse_report().process(find_updates=False)
+        changed = self.parse_report(packages="'nginx' '' '1.18.0' '1' 'amd64' 'deb'")
+        changed.process(find_updates=False)
+        host = Host.objects.get(hostname='fingerprint.example.com')
+        self.assertEqual(host.report_fingerprint, changed.fingerprint)
+        self.assertEqual(host.packages.count(), 1)
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class ReportCompressionTests(TestCase):
+    """Tests for compressed storage of report sections."""
+
+    def setUp(self):
+        self.packages = json.dumps(
+            [{'name': f'pkg{i}', 'version': '1.0', 'arch': 'amd64', 'type': 'deb'} for i in range(50)]
+        )
+
+    def get_raw_packages(self, report):
+        """Return the packages column as stored in the database."""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT packages FROM reports_report WHERE id = %s', [report.id])
+            return cursor.fetchone()[0]
+
+    def test_sections_stored_compressed(self):
+        """Test report sections are compressed in the database."""
+        report = Report.objects.create(host='testhost.example.com', protocol='2', packages=self.packages)
+        raw = self.get_raw_packages(report)
+        self.assertTrue(raw.startswith(COMPRESSED_PREFIX))
+        self.assertLess(len(raw), len(self.packages))
+        report = Report.objects.get(id=report.id)
+        self.assertEqual(report.packages, self.packages)
+
+    @override_settings(COMPRESS_REPORTS=False)
+    def test_sections_stored_uncompressed_when_disabled(self):
+        """Test report sections are stored as-is when compression is disabled."""
+        report = Report.objects.create(host='testhost.example.com', protocol='2', packages=self.packages)
+        self.assertEqual(self.get_raw_packages(report), self.packages)
+        self.assertEqual(Report.objects.get(id=report.id).packages, self.packages)
+
+    def test_compress_reports(self):
+        """Test compress_reports compresses existing uncompressed reports."""
+        with override_settings(COMPRESS_REPORTS=False):
+            report = Report.objects.create(host='testhost.example.com', protocol='2', packages=self.packages)
+        self.assertEqual(compress_reports(batch_size=1), 1)
+        self.assertTrue(self.get_raw_packages(report).startswith(COMPRESSED_PREFIX))
+        self.assertEqual(Report.objects.get(id=report.id).packages_parsed[49]['name'], 'pkg49')
+        self.assertEqual(compress_reports(), 0)
+
+    def test_prefixed_value_round_trips(self):
+        """Test values that look compressed are stored and read back unchanged."""
+        values = [COMPRESSED_PREFIX, f'{COMPRESSED_PREFIX}not base64!', f'{COMPRESSED_PREFIX}{self.packages}']
+        for value in values:
+            report = Report.objects.create(host='testhost.example.com', protocol='2', packages=value)
+            self.assertEqual(Report.objects.get(id=report.id).packages, value)
+            with override_settings(COMPRESS_REPORTS=False):
+                report = Report.objects.create(host='testhost.example.com', protocol='2', packages=value)
+            self.assertEqual(Report.objects.get(id=report.id).packages, value)
+
+    def test_undecodable_value_read_unchanged(self):
+        """Test stored values that cannot be decompressed are read unchanged."""
+        report = Report.objects.create(host='testhost.example.com', protocol='2')
+        value = f'{COMPRESSED_PREFIX}aGVsbG8='
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE reports_report SET packages = %s WHERE id = %s', [value, report.id])
+        self.assertEqual(Report.objects.get(id=report.id).packages, value)
@@ -15,6 +15,7 @@
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
 import json
+from unittest.mock import patch
 
 from django.test import TestCase, override_settings
 from django.utils import timezone
@@ -25,7 +26,8 @@ from hosts.models import Host
 from operatingsystems.models import OSRelease, OSVariant
 from reports.models import Report
 from reports.tasks import (
-    process_report, process_reports, remove_reports_with_no_hosts,
+    mark_superseded_reports, process_report, process_reports,
+    process_reports_batch, remove_reports_with_no_hosts,
 )
 
 
@@ -164,6 +166,65 @@ class ProcessReportsTaskTests(TestCase):
         process_reports()
 
 
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class ProcessReportsBatchTests(TestCase):
+    """Tests for batched report processing."""
+
+    def create_report(self, hostname, kernel='5.15.0-91-generic'):
+        """Create an unprocessed protocol 2 report."""
+        return Report.objects.create(
+            host=hostname,
+            domain='example.com',
+            report_ip='192.168.1.60',
+            os='Ubuntu 22.04.3 LTS',
+            kernel=kernel,
+            arch='x86_64',
+            protocol='2',
+            packages=json.dumps([]),
+            repos=json.dumps([]),
+            modules=json.dumps([]),
+            sec_updates=json.dumps([]),
+            bug_updates=json.dumps([]),
+        )
+
+    def test_mark_superseded_reports(self):
+        """Test only the newest unprocessed report per host is kept."""
+        old = self.create_report('batchhost.example.com')
+        new = self.create_report('batchhost.example.com')
+        other = self.create_report('otherhost.example.com')
+        self.assertEqual(mark_superseded_reports(Report.objects.all()), 1)
+        self.assertTrue(Report.objects.get(id=old.id).processed)
+        self.assertFalse(Report.objects.get(id=new.id).processed)
+        self.assertFalse(Report.objects.get(id=other.id).processed)
+
+    def test_process_reports_batch(self):
+        """Test process_reports_batch processes the newest report per host."""
+        self.create_report('batchhost.example.com', kernel='5.15.0-90-generic')
+        self.create_report('batchhost.example.com', kernel='5.15.0-91-generic')
+        for i in range(3):
+            self.create_report(f'batchhost{i}.example.com')
+
+        processed = process_reports_batch(find_updates=False, batch_size=2)
+
+        self.assertEqual(processed, 4)
+        self.assertFalse(Report.objects.filter(processed=False).exists())
+        self.assertEqual(Host.objects.count(), 4)
+        host = Host.objects.get(hostname='batchhost.example.com')
+        self.assertEqual(host.kernel, '5.15.0-91-generic')
+
+    def test_process_reports_processes_every_report(self):
+        """Test the process_reports task does not skip older reports of a host."""
+        old = self.create_report('batchhost.example.com', kernel='5.15.0-90-generic')
+        self.create_report('batchhost.example.com', kernel='5.15.0-91-generic')
+        with patch.object(Report, 'process', autospec=True) as report_process:
+            process_reports()
+        self.assertIn(old.id, [call.args[0].id for call in report_process.call_args_list])
+        self.assertEqual(report_process.call_count, 2)
+
+
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
     CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
@@ -22,12 +22,15 @@ from django.utils import timezone
 from arch.models import MachineArchitecture, PackageArchitecture
 from domains.models import Domain
 from hosts.models import Host, HostRepo
+from modules.models import Module
 from operatingsystems.models import OSRelease, OSVariant
 from packages.models import Package, PackageName
+from packages.utils import normalize_package_key
 from reports.models import Report
 from reports.utils import (
-    process_package, process_package_json, process_package_text, process_repo,
-    process_repo_json, process_update,
+    process_package, process_package_json, process_package_text,
+    process_packages, process_repo, process_repo_json, process_update,
+    update_host_modules, update_host_packages,
 )
 from repos.models import Mirror, Repository
 
@@ -342,6 +345,74 @@ class ProcessUpdateTests(TestCase):
         self.assertIsNone(update)
 
 
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class UpdateHostPackagesTests(TestCase):
+    """Tests for bulk reconciliation of host packages."""
+
+    def setUp(self):
+        """Set up test data."""
+        self.arch = MachineArchitecture.objects.create(name='x86_64')
+        self.osrelease = OSRelease.objects.create(name='Ubuntu 22.04')
+        self.osvariant = OSVariant.objects.create(
+            name='Ubuntu 22.04 x86_64',
+            osrelease=self.osrelease,
+            arch=self.arch,
+        )
+        self.domain = Domain.objects.create(name='example.com')
+        self.host = Host.objects.create(
+            hostname='bulk.example.com',
+            ipaddress='192.168.1.101',
+            arch=self.arch,
+            osvariant=self.osvariant,
+            domain=self.domain,
+            lastreport=timezone.now(),
+        )
+
+    def test_update_host_packages_adds_and_removes(self):
+        """Test update_host_packages() applies the package diff to the host."""
+        stale = process_package('telnet', '', '0.17', '1', 'amd64', Package.DEB)
+        kept = process_package('nginx', '', '1.18.0', '1', 'amd64', Package.DEB)
+        self.host.packages.add(stale, kept)
+
+        update_host_packages(self.host, [
+            normalize_package_key('nginx', '', '1.18.0', '1', 'amd64', Package.DEB),
+            normalize_package_key('curl', '', '7.81.0', '1', 'amd64', Package.DEB),
+        ])
+
+        pkg_names = set(self.host.packages.values_list('name__name', flat=True))
+        self.assertEqual(pkg_names, {'nginx', 'curl'})
+        self.host.refresh_from_db()
+        self.assertEqual(self.host.packages_count, 2)
+
+    def test_update_host_modules_adds_and_removes(self):
+        """Test update_host_modules() applies the module diff to the host."""
+        pkg_arch = PackageArchitecture.objects.create(name='x86_64')
+        repo = Repository.objects.create(name='appstream', arch=self.arch, repotype=Repository.RPM)
+        stale, kept, new = [
+            Module.objects.create(
+                name=name, stream='1', version='1', context='abc', arch=pkg_arch, repo=repo,
+            ) for name in ('perl', 'nodejs', 'php')
+        ]
+        self.host.modules.add(stale, kept)
+
+        update_host_modules(self.host, [kept.id, new.id])
+
+        self.assertEqual(set(self.host.modules.all()), {kept, new})
+
+    def test_process_packages_text(self):
+        """Test process_packages() reconciles protocol 1 package strings."""
+        report = Report.objects.create(
+            host='bulk.example.com',
+            packages="'nginx' '' '1.18.0' '1' 'amd64' 'deb'\n'gpg-pubkey' '' 'abc' 'def' 'noarch' 'rpm'",
+        )
+        process_packages(report=report, host=self.host)
+        pkg_names = list(self.host.packages.values_list('name__name', flat=True))
+        self.assertEqual(pkg_names, ['nginx'])
+
+
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
     CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
@@ -15,11 +15,13 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import json
 import re
+from hashlib import sha256
 
 from django.db import IntegrityError
 
-from arch.models import MachineArchitecture, PackageArchitecture
+from arch.utils import get_or_create_machine_arch, get_or_create_package_arch
 from domains.models import Domain
 from hosts.models import HostRepo
 from modules.utils import get_or_create_module
@@ -29,12 +31,13 @@ from operatingsystems.utils import (
 from packages.models import Package, PackageCategory
 from packages.utils import (
     find_evr, get_or_create_package, get_or_create_package_update,
-    parse_package_string,
+    get_or_create_package_updates, get_or_create_packages,
+    normalize_package_key, parse_package_string,
 )
 from patchman.signals import pbar_start, pbar_update
 from repos.models import Mirror, MirrorPackage, Repository
-from repos.utils import get_or_create_repo
-from util.logging import debug_message, error_message, info_message
+from repos.utils import get_or_create_repo, get_repo_by_repo_id
+from util.logging import debug_message, error_message
 
 
 def process_repos(report, host):
@@ -77,36 +80,57 @@ def process_modules(report, host):
             module = process_module_text(module_str)
             if module:
                 module_ids.append(module.id)
-                host.modules.add(module)
             pbar_update.send(sender=None, index=i + 1)
 
-        for module in host.modules.all():
-            if module.id not in module_ids:
-                host.modules.remove(module)
+        update_host_modules(host, module_ids)
+
+
+def update_host_modules(host, module_ids):
+    """ Apply the difference between the modules in a report and the hosts
+        enabled modules as a single insert and a single delete
+    """
+    module_ids = set(module_ids)
+    enabled_ids = set(host.modules.values_list('id', flat=True))
+
+    stale_ids = enabled_ids - module_ids
+    if stale_ids:
+        host.modules.remove(*stale_ids)
+    new_ids = module_ids - enabled_ids
+    if new_ids:
+        host.modules.add(*new_ids)
 
 
 def process_packages(report, host):
     """ Processes the quoted packages string sent with a report
     """
     if report.packages:
-        package_ids = []
+        package_keys = []
 
         packages = parse_packages(report.packages)
         pbar_start.send(sender=None, ptext=f'{host} Packages', plen=len(packages))
         for i, pkg_str in enumerate(packages):
             debug_message(f'Processing report {report.id} package: {pkg_str}')
-            package = process_package_text(pkg_str)
-            if package:
-                package_ids.append(package.id)
-                host.packages.add(package)
-            else:
-                if pkg_str[0].lower() != 'gpg-pubkey':
-                    info_message(text=f'No package returned for {pkg_str}')
+            package_key = normalize_package_key(*get_package_text_attrs(pkg_str))
+            if package_key:
+                package_keys.append(package_key)
             pbar_update.send(sender=None, index=i + 1)
 
-        for package in host.packages.all():
-            if package.id not in package_ids:
-                host.packages.remove(package)
+        update_host_packages(host, package_keys)
+
+
+def update_host_packages(host, package_keys):
+    """ Bulk resolve the packages in a report and apply the difference to the
+        hosts installed packages as a single insert and a single delete
+    """
+    package_ids = set(get_or_create_packages(package_keys).values())
+    installed_ids = set(host.packages.values_list('id', flat=True))
+
+    stale_ids = installed_ids - package_ids
+    if stale_ids:
+        host.packages.remove(*stale_ids)
+    new_ids = package_ids - installed_ids
+    if new_ids:
+        host.packages.add(*new_ids)
 
 
 def process_updates(report, host):
@@ -136,16 +160,28 @@ def merge_updates(sec_updates, bug_updates):
 def add_updates(updates, host):
     """ Add updates to a Host
     """
-    for host_update in host.updates.all():
-        host.updates.remove(host_update)
+    update_packages = []
     ulen = len(updates)
     if ulen > 0:
         pbar_start.send(sender=None, ptext=f'{host} Updates', plen=ulen)
         for i, (u, sec) in enumerate(updates.items()):
-            update = process_update_text(host, u, sec)
-            if update:
-                host.updates.add(update)
+            packages = get_update_packages(host, *parse_update_text(u))
+            if packages:
+                update_packages.append((*packages, sec))
             pbar_update.send(sender=None, index=i + 1)
+    set_host_updates(host, update_packages)
+
+
+def set_host_updates(host, update_packages):
+    """ Replace the updates of a Host with the updates for a list of
+        (installed_package, package, security) tuples, which are resolved
+        with one bulk call
+    """
+    update_ids = get_or_create_package_updates([
+        (installed_package.id, package.id, security)
+        for installed_package, package, security in update_packages
+    ])
+    host.updates.set(update_ids.values())
 
 
 def parse_updates(updates_string, security):
@@ -161,9 +197,9 @@ def parse_updates(updates_string, security):
     return updates
 
 
-def process_update_text(host, update_string, security):
-    """ Processes a single sanitized update string and converts to an update
-        object. Only works if the original package exists. Returns None otherwise
+def parse_update_text(update_string):
+    """ Parses a single sanitized update string
+        Returns a tuple of (name, epoch, version, release, arch, repo_id)
     """
     update_str = update_string.split()
     repo_id = update_str[2]
@@ -174,12 +210,32 @@ def process_update_text(host, update_string, security):
 
     p_epoch, p_version, p_release = find_evr(update_str[1])
 
-    return process_update(host, p_name, p_epoch, p_version, p_release, p_arch, repo_id, security)
+    return p_name, p_epoch, p_version, p_release, p_arch, repo_id
+
+
+def process_update_text(host, update_string, security):
+    """ Processes a single sanitized update string and converts to an update
+        object. Only works if the original package exists. Returns None otherwise
+    """
+    return process_update(host, *parse_update_text(update_string), security)
 
 
 def process_update(host, name, epoch, version, release, arch, repo_id, security):
     """ Core update processing logic shared by text and JSON handlers
     """
+    packages = get_update_packages(host, name, epoch, version, release, arch, repo_id)
+    if packages:
+        installed_package, package = packages
+        return get_or_create_package_update(oldpackage=installed_package, newpackage=package, security=security)
+    return None
+
+
+def get_update_packages(host, name, epoch, version, release, arch, repo_id):
+    """ Gets or creates the package of an update and adds it to the mirrors
+        of the repo it is from. Returns a tuple of the installed package that
+        it updates and the package, or None if the host does not have a
+        package with the same name and arch installed.
+    """
     package = get_or_create_package(
         name=name,
         epoch=epoch,
@@ -188,19 +244,14 @@ def process_update(host, name, epoch, version, release, arch, repo_id, security)
         arch=arch,
         p_type=Package.RPM
     )
-    try:
-        repo = Repository.objects.get(repo_id=repo_id)
-    except Repository.DoesNotExist:
-        repo = None
+    repo = get_repo_by_repo_id(repo_id)
     if repo:
         for mirror in repo.mirror_set.all():
             MirrorPackage.objects.create(mirror=mirror, package=package)
 
     installed_packages = host.packages.filter(name=package.name, arch=package.arch, packagetype=Package.RPM)
     if installed_packages:
-        installed_package = installed_packages[0]
-        update = get_or_create_package_update(oldpackage=installed_package, newpackage=package, security=security)
-        return update
+        return installed_packages[0], package
     return None
 
 
@@ -234,7 +285,7 @@ def _get_repo_type(type_str):
 def process_repo(r_type, r_name, r_id, r_priority, urls, arch):
     """ Core repo processing logic shared by text and JSON handlers
     """
-    r_arch, _ = MachineArchitecture.objects.get_or_create(name=arch)
+    r_arch = get_or_create_machine_arch(arch)
 
     repository = None
     unknown = []
@@ -324,12 +375,9 @@ def parse_modules(modules_string):
 def process_module(m_name, m_stream, m_version, m_context, m_arch, repo_id, package_strings):
     """ Core module processing logic shared by text and JSON handlers
     """
-    arch, _ = PackageArchitecture.objects.get_or_create(name=m_arch)
+    arch = get_or_create_package_arch(m_arch)
 
-    try:
-        repo = Repository.objects.get(repo_id=repo_id)
-    except Repository.DoesNotExist:
-        repo = None
+    repo = get_repo_by_repo_id(repo_id)
 
     packages = set()
     for pkg_str in package_strings:
@@ -391,9 +439,9 @@ def process_package(name, epoch, version, release, arch, p_type, category=None,
     return package
 
 
-def process_package_text(pkg):
-    """ Processes a single sanitized package string and converts to a package
-        object
+def get_package_text_attrs(pkg):
+    """ Returns the name, epoch, version, release, arch, type and category
+        of a single sanitized package string
     """
     name = pkg[0]
     epoch = pkg[1] if pkg[1] else ''
@@ -403,13 +451,23 @@ def process_package_text(pkg):
 
     p_type = _get_package_type(pkg[5])
     p_category = pkg[6] if p_type == Package.GENTOO and len(pkg) > 6 else None
+
+    return name, epoch, ver, rel, arch, p_type, p_category
+
+
+def process_package_text(pkg):
+    """ Processes a single sanitized package string and converts to a package
+        object
+    """
+    p_type = _get_package_type(pkg[5])
     p_repo = pkg[7] if p_type == Package.GENTOO and len(pkg) > 7 else None
 
-    return process_package(name, epoch, ver, rel, arch, p_type, p_category, p_repo)
+    return process_package(*get_package_text_attrs(pkg), p_repo)
 
 
-def process_package_json(pkg):
-    """ Processes a single JSON package dict and converts to a package object
+def get_package_json_attrs(pkg):
+    """ Returns the name, epoch, version, release, arch, type and category
+        of a single JSON package dict
     """
     name = pkg['name']
     epoch = pkg.get('epoch', '')
@@ -418,9 +476,17 @@ def process_package_json(pkg):
     arch = pkg.get('arch', 'unknown')
     p_type = _get_package_type(pkg.get('type', ''))
     p_category = pkg.get('category') if p_type == Package.GENTOO else None
+
+    return name, epoch, ver, rel, arch, p_type, p_category
+
+
+def process_package_json(pkg):
+    """ Processes a single JSON package dict and converts to a package object
+    """
+    p_type = _get_package_type(pkg.get('type', ''))
     p_repo = pkg.get('repo') if p_type == Package.GENTOO else None
 
-    return process_package(name, epoch, ver, rel, arch, p_type, p_category, p_repo)
+    return process_package(*get_package_json_attrs(pkg), p_repo)
 
 
 def process_gentoo_package(package, name, category, repo):
@@ -434,23 +500,17 @@ def process_gentoo_package(package, name, category, repo):
 def process_packages_json(packages_json, host):
     """ Processes packages from JSON data (protocol 2)
     """
-    package_ids = []
+    package_keys = []
     pbar_start.send(sender=None, ptext=f'{host} Packages', plen=len(packages_json))
 
     for i, pkg in enumerate(packages_json):
         debug_message(f'Processing JSON package: {pkg}')
-        package = process_package_json(pkg)
-        if package:
-            package_ids.append(package.id)
-            host.packages.add(package)
-        else:
-            if pkg.get('name', '').lower() != 'gpg-pubkey':
-                info_message(text=f'No package returned for {pkg}')
+        package_key = normalize_package_key(*get_package_json_attrs(pkg))
+        if package_key:
+            package_keys.append(package_key)
         pbar_update.send(sender=None, index=i + 1)
 
-    for package in host.packages.all():
-        if package.id not in package_ids:
-            host.packages.remove(package)
+    update_host_packages(host, package_keys)
 
 
 def process_repo_json(repo, arch):
@@ -525,16 +585,14 @@ def process_modules_json(modules_json, host):
         mod = process_module_json(module)
         if mod:
             module_ids.append(mod.id)
-            host.modules.add(mod)
         pbar_update.send(sender=None, index=i + 1)
 
-    for mod in host.modules.all():
-        if mod.id not in module_ids:
-            host.modules.remove(mod)
+    update_host_modules(host, module_ids)
 
 
-def process_update_json(host, update, security):
-    """ Processes a single JSON update dict and converts to an update object
+def parse_update_json(update):
+    """ Parses a single JSON update dict
+        Returns a tuple of (name, epoch, version, release, arch, repo_id)
     """
     name = update.get('name')
     version = update.get('version')
@@ -543,36 +601,70 @@ def process_update_json(host, update, security):
 
     p_epoch, p_version, p_release = find_evr(version)
 
-    return process_update(host, name, p_epoch, p_version, p_release, arch, repo_id, security)
+    return name, p_epoch, p_version, p_release, arch, repo_id
+
+
+def process_update_json(host, update, security):
+    """ Processes a single JSON update dict and converts to an update object
+    """
+    return process_update(host, *parse_update_json(update), security)
 
 
 def process_updates_json(sec_updates_json, bug_updates_json, host):
     """ Processes updates from JSON data (protocol 2)
     """
-    # Clear existing updates
-    for host_update in host.updates.all():
-        host.updates.remove(host_update)
-
     # Merge updates, preferring security over bugfix
     sec_keys = {(u['name'], u['arch']) for u in sec_updates_json}
     bug_updates_filtered = [u for u in bug_updates_json if (u['name'], u['arch']) not in sec_keys]
 
     all_updates = [(u, True) for u in sec_updates_json] + [(u, False) for u in bug_updates_filtered]
 
+    update_packages = []
     if all_updates:
         pbar_start.send(sender=None, ptext=f'{host} Updates', plen=len(all_updates))
         for i, (update, security) in enumerate(all_updates):
-            update_obj = process_update_json(host, update, security)
-            if update_obj:
-                host.updates.add(update_obj)
+            packages = get_update_packages(host, *parse_update_json(update))
+            if packages:
+                update_packages.append((*packages, security))
             pbar_update.send(sender=None, index=i + 1)
+    set_host_updates(host, update_packages)
+
+
+def _normalize_fingerprint_section(section):
+    """ Returns a sorted list of canonical strings for a report section, which
+        is either a protocol 1 text block or a protocol 2 list of dicts
+    """
+    if not section:
+        return []
+    if isinstance(section, str):
+        return sorted(line.strip() for line in section.splitlines() if line.strip())
+    return sorted(json.dumps(item, sort_keys=True, separators=(',', ':')) for item in section)
+
+
+def get_report_fingerprint(kernel, os, arch, tags, packages, repos, modules, sec_updates, bug_updates):
+    """ Returns a stable hash of the normalized contents of a report, so that
+        a report with the same packages, repos, modules, updates, kernel and
+        os as the previous report of a host can be detected
+    """
+    content = {
+        'kernel': kernel or '',
+        'os': os or '',
+        'arch': arch or '',
+        'tags': tags or '',
+        'packages': _normalize_fingerprint_section(packages),
+        'repos': _normalize_fingerprint_section(repos),
+        'modules': _normalize_fingerprint_section(modules),
+        'sec_updates': _normalize_fingerprint_section(sec_updates),
+        'bug_updates': _normalize_fingerprint_section(bug_updates),
+    }
+    return sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
 
 
 def get_arch(arch):
     """ Get or create MachineArchitecture from arch
         Returns the MachineArchitecture
     """
-    return MachineArchitecture.objects.get_or_create(name=arch)[0]
+    return get_or_create_machine_arch(arch)
 
 
 def get_os(os, arch):
@@ -656,3 +748,30 @@ def get_domain(report_domain):
         report_domain = 'unknown'
     domain, c = Domain.objects.get_or_create(name=report_domain)
     return domain
+
+
+def compress_reports(batch_size=500):
+    """ Compress the stored sections of existing reports in batches, for
+        reports that were stored before compression was enabled
+        Returns the number of reports that were checked
+    """
+    from django.db.models import Q
+
+    from reports.models import Report
+    from util.fields import COMPRESSED_PREFIX
+
+    uncompressed = Q()
+    for field in Report.JSON_SECTIONS:
+        uncompressed |= Q(**{f'{field}__gt': ''}) & ~Q(**{f'{field}__startswith': COMPRESSED_PREFIX})
+    reports = Report.objects.filter(uncompressed).order_by('id')
+
+    count = 0
+    last_id = 0
+    while True:
+        batch = list(reports.filter(id__gt=last_id).only('id', *Report.JSON_SECTIONS)[:batch_size])
+        if not batch:
+            break
+        Report.objects.bulk_update(batch, Report.JSON_SECTIONS)
+        count += len(batch)
+        last_id = batch[-1].id
+    return count
@@ -15,7 +15,6 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
-import json
 from urllib.parse import parse_qs, unquote
 
 from django.conf import settings
@@ -42,8 +41,9 @@ from reports.tables import (
     ReportModuleTable, ReportPackageTable, ReportRepoTable, ReportTable,
     ReportUpdateTable,
 )
-from reports.tasks import process_report
-from util import sanitize_filter_params
+from reports.tasks import process_report, queue_report
+from reports.utils import get_report_fingerprint
+from util import decompress_request_body, sanitize_filter_params
 from util.filterspecs import Filter, FilterBar
 
 
@@ -78,13 +78,17 @@ def _get_filtered_reports(filter_params):
 def upload(request):
 
     if request.method == 'POST':
+        try:
+            decompress_request_body(request)
+        except ValueError as e:
+            return HttpResponse(str(e), status=400)
         data = request.POST.copy()
         meta = request.META.copy()
 
         report = Report.objects.create()
         report.parse(data, meta)
 
-        process_report.delay(report.id)
+        queue_report(report)
 
         if 'report' in data and data['report'] == 'true':
             packages = []
@@ -294,6 +298,13 @@ class ReportViewSet(viewsets.ViewSet):
 
     def create(self, request):
         """Handle protocol 2 JSON report upload."""
+        try:
+            decompress_request_body(request._request)
+        except ValueError as e:
+            return Response(
+                {'status': 'error', 'errors': str(e)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         serializer = ReportUploadSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(
@@ -326,8 +337,15 @@ class ReportViewSet(viewsets.ViewSet):
         # Convert reboot_required to string for compatibility
         reboot = 'True' if data.get('reboot_required') else 'False'
 
-        # Store JSON data as strings in the report model
-        report = Report.objects.create(
+        fingerprint = get_report_fingerprint(
+            unquote(data['kernel']), data['os'], data['arch'], tags,
+            data.get('packages'), data.get('repos'), data.get('modules'),
+            data.get('sec_updates'), data.get('bug_updates'),
+        )
+
+        # Store JSON data as compact strings in the report model, keeping the
+        # parsed sections on the instance for in-process processing
+        report = Report(
             host=hostname,
             domain=domain,
             tags=tags,
@@ -337,16 +355,14 @@ class ReportViewSet(viewsets.ViewSet):
             report_ip=report_ip,
             protocol='2',
             useragent=request.META.get('HTTP_USER_AGENT', ''),
-            packages=json.dumps(data.get('packages', [])),
-            repos=json.dumps(data.get('repos', [])),
-            modules=json.dumps(data.get('modules', [])),
-            sec_updates=json.dumps(data.get('sec_updates', [])),
-            bug_updates=json.dumps(data.get('bug_updates', [])),
             reboot=reboot,
+            fingerprint=fingerprint,
         )
+        report.set_parsed_sections(**{section: data.get(section) for section in Report.JSON_SECTIONS})
+        report.save()
 
         # Queue for async processing
-        process_report.delay(report.id)
+        queue_report(report)
 
         return Response(
             {
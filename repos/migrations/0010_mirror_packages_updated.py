@@ -0,0 +1,18 @@
+# Generated by Django 4.2.29 on 2026-10-18 01:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repos', '0009_backfill_mirror_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mirror',
+            name='packages_updated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
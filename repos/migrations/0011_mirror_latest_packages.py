@@ -0,0 +1,32 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0007_alter_package_epoch_alter_package_release_and_more'),
+        ('repos', '0010_mirror_packages_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mirror',
+            name='latest_packages_indexed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='MirrorLatestPackage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mirror', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='repos.mirror')),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='packages.package')),
+            ],
+            options={
+                'ordering': ['mirror', 'package'],
+                'unique_together': {('mirror', 'package')},
+            },
+        ),
+    ]
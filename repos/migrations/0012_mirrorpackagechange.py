@@ -0,0 +1,27 @@
+# Generated by Django 4.2.29 on 2026-10-18 02:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('packages', '0008_packagename_kernel_classification'),
+        ('repos', '0011_mirror_latest_packages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MirrorPackageChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('changed_at', models.DateTimeField(db_index=True)),
+                ('mirror', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='repos.mirror')),
+                ('name', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='packages.packagename')),
+            ],
+            options={
+                'ordering': ['changed_at'],
+            },
+        ),
+    ]
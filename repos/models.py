@@ -19,12 +19,14 @@ from django.db import models
 from django.urls import reverse
 
 from arch.models import MachineArchitecture
-from packages.models import Package
+from packages.models import Package, PackageName
 from repos.repo_types.arch import refresh_arch_repo
 from repos.repo_types.deb import refresh_deb_repo
 from repos.repo_types.gentoo import refresh_gentoo_repo
 from repos.repo_types.rpm import refresh_repo_errata, refresh_rpm_repo
-from util import get_setting_of_type
+from repos.utils import record_mirror_package_changes
+from util import get_datetime_now, get_setting_of_type
+from util.counters import deferred_counts
 from util.logging import error_message, info_message, warning_message
 
 
@@ -77,6 +79,7 @@ class Repository(models.Model):
         for mirror in self.mirror_set.all():
             mirror.show()
 
+    @deferred_counts()
     def refresh(self, force=False):
         """ Refresh all of a repos mirror metadata,
             force can be set to force a reset of all the mirrors metadata
@@ -118,7 +121,9 @@ class Repository(models.Model):
             each mirror so that it doesn't try to update its package metadata.
         """
         self.enabled = False
-        self.mirror_set.all().update(enabled=False, refresh=False)
+        ts = get_datetime_now()
+        self.mirror_set.all().update(enabled=False, refresh=False, packages_updated=ts)
+        record_mirror_package_changes(self.mirror_set.all(), ts)
 
     def enable(self):
         """ Enable a repo. This involves enabling each mirror, which allows it
@@ -126,7 +131,9 @@ class Repository(models.Model):
             mirror so that it updates its package metadata.
         """
         self.enabled = True
-        self.mirror_set.all().update(enabled=True, refresh=True)
+        ts = get_datetime_now()
+        self.mirror_set.all().update(enabled=True, refresh=True, packages_updated=ts)
+        record_mirror_package_changes(self.mirror_set.all(), ts)
 
 
 class Mirror(models.Model):
@@ -143,6 +150,10 @@ class Mirror(models.Model):
     enabled = models.BooleanField(default=True)
     refresh = models.BooleanField(default=True)
     fail_count = models.IntegerField(default=0)
+    # When the set of packages in this mirror last changed
+    packages_updated = models.DateTimeField(blank=True, null=True)
+    # Whether MirrorLatestPackage has been built for this mirror
+    latest_packages_indexed = models.BooleanField(default=False)
     # Cached count field for query optimization
     packages_count = models.PositiveIntegerField(default=0, db_index=True)
 
@@ -202,3 +213,29 @@ class MirrorPackage(models.Model):
 
     class Meta:
         ordering = ['mirror', 'package']
+
+
+class MirrorLatestPackage(models.Model):
+    """ The highest version Package for each name, arch, packagetype and
+        category in a Mirror, maintained by update_mirror_latest_packages()
+    """
+    mirror = models.ForeignKey(Mirror, on_delete=models.CASCADE)
+    package = models.ForeignKey(Package, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ['mirror', 'package']
+        ordering = ['mirror', 'package']
+
+
+class MirrorPackageChange(models.Model):
+    """ A package name that was added to or removed from a Mirror, recorded
+        by record_mirror_package_changes() so that host updates can be
+        re-evaluated for only the changed names. A change without a name
+        means that any of the packages of the Mirror may have changed.
+    """
+    mirror = models.ForeignKey(Mirror, on_delete=models.CASCADE)
+    name = models.ForeignKey(PackageName, on_delete=models.CASCADE, blank=True, null=True)
+    changed_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ['changed_at']
@@ -36,6 +36,7 @@ from util import (
     response_is_valid,
 )
 from util.logging import error_message, info_message, warning_message
+from util.metadata_cache import fetch_url_cached
 
 
 def refresh_gentoo_main_repo(repo):
@@ -66,13 +67,12 @@ def refresh_gentoo_main_repo(repo):
             warning_message(text=text)
             continue
 
-        res = get_url(mirror.url)
+        res, data = fetch_url_cached(mirror.url, 'Fetching Gentoo Repo data')
         mirror.last_access_ok = response_is_valid(res)
         if not mirror.last_access_ok:
             mirror.fail()
             continue
 
-        data = fetch_content(res, 'Fetching Gentoo Repo data')
         if data is None:
             mirror.fail()
             continue
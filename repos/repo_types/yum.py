@@ -21,11 +21,13 @@ import yaml
 from defusedxml import ElementTree
 
 from errata.sources.repos.yum import extract_updateinfo
-from packages.models import Package, PackageString
-from packages.utils import get_or_create_package, parse_package_string
+from packages.models import Package
+from packages.utils import (
+    get_or_create_package, normalize_package_key, parse_package_string,
+)
 from patchman.signals import pbar_start, pbar_update
-from repos.utils import fetch_mirror_data, update_mirror_packages
-from util import extract
+from repos.utils import fetch_mirror_data, sync_mirror_packages
+from util import EXTRACT_ERRORS, extract, extract_stream
 from util.logging import error_message, warning_message
 
 
@@ -105,58 +107,47 @@ def extract_module_metadata(data, url, repo):
             modules.add(module)
 
 
-def extract_yum_packages(data, url):
-    """ Extract package metadata from a yum primary.xml file
+def iter_yum_packages(data, url):
+    """ Incrementally extract package metadata from a yum primary.xml file,
+        given as bytes or a file object. The file is decompressed and parsed as a stream and each parsed
+        element is discarded, so memory use does not grow with the size of
+        the file. Yields a package key (see normalize_package_key) for each
+        package. Raises ElementTree.ParseError or one of EXTRACT_ERRORS if the
+        file is corrupt.
     """
-    extracted = extract(data, url)
     ns = 'http://linux.duke.edu/metadata/common'
-    packages = set()
-    try:
-        context = ElementTree.iterparse(BytesIO(extracted), events=('start', 'end'))
-        for event, elem in context:
-            if event == 'start':
-                if elem.tag == f'{{{ns}}}metadata':
-                    plen = int(elem.attrib.get('packages'))
-                    break
-        pbar_start.send(sender=None, ptext=f'Extracting {plen} Packages', plen=plen)
-        i = 0
-        for event, elem in context:
-            if event == 'start':
-                if elem.tag == f'{{{ns}}}package':
-                    if elem.attrib.get('type') == 'rpm':
-                        name = version = release = arch = ''
-            elif event == 'end':
-                if elem.tag == f'{{{ns}}}name':
-                    name = elem.text.lower()
-                elif elem.tag == f'{{{ns}}}arch':
-                    arch = elem.text
-                elif elem.tag == f'{{{ns}}}version':
-                    fullversion = elem
-                    epoch = fullversion.get('epoch')
-                    version = fullversion.get('ver')
-                    release = fullversion.get('rel')
-                elif elem.tag == f'{{{ns}}}package':
-                    if name and version and release and arch:
-                        if epoch == '0':
-                            epoch = ''
-                        package = PackageString(
-                            name=name,
-                            epoch=epoch,
-                            version=version,
-                            release=release,
-                            arch=arch,
-                            packagetype='R',
-                        )
-                        packages.add(package)
-                        pbar_update.send(sender=None, index=i + 1)
-                        i += 1
-                    else:
-                        text = f'Error parsing Package: {name} {epoch} {version} {release} {arch}'
-                        error_message(text=text)
-                elem.clear()
-    except ElementTree.ParseError as e:
-        error_message(text=f'Error parsing yum primary.xml from {url}: {e}')
-    return packages
+    root = None
+    i = 0
+    context = ElementTree.iterparse(extract_stream(data, url), events=('start', 'end'))
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag == f'{{{ns}}}metadata':
+                root = elem
+                plen = int(elem.attrib.get('packages', 0))
+                pbar_start.send(sender=None, ptext=f'Extracting {plen} Packages', plen=plen)
+            elif elem.tag == f'{{{ns}}}package':
+                name = epoch = version = release = arch = ''
+        elif event == 'end':
+            if elem.tag == f'{{{ns}}}name':
+                name = elem.text.lower()
+            elif elem.tag == f'{{{ns}}}arch':
+                arch = elem.text
+            elif elem.tag == f'{{{ns}}}version':
+                epoch = elem.get('epoch')
+                version = elem.get('ver')
+                release = elem.get('rel')
+            elif elem.tag == f'{{{ns}}}package':
+                if name and version and release and arch:
+                    i += 1
+                    pbar_update.send(sender=None, index=i)
+                    yield normalize_package_key(name, epoch, version, release, arch, Package.RPM)
+                else:
+                    text = f'Error parsing Package: {name} {epoch} {version} {release} {arch}'
+                    error_message(text=text)
+                # drop the parsed packages from the tree
+                if root is not None:
+                    root.clear()
+            elem.clear()
 
 
 def refresh_repomd_updateinfo(mirror, data, mirror_url):
@@ -229,22 +220,25 @@ def refresh_repomd_primary(mirror, data, mirror_url):
         checksum=checksum,
         checksum_type=checksum_type,
         text='Fetching Package data',
-        metadata_type='package')
+        metadata_type='package',
+        stream=True)
 
-    if not mirror.last_access_ok:
+    if not mirror.last_access_ok or data is None:
         return
 
-    if mirror.packages_checksum and mirror.packages_checksum == checksum:
-        text = 'Mirror Packages checksum has not changed, skipping Package refresh'
-        warning_message(text=text)
-        return
-    else:
-        mirror.packages_checksum = checksum
-        mirror.save()
-
-    packages = extract_yum_packages(data, url)
-    if packages:
-        update_mirror_packages(mirror, packages)
+    with data:
+        if mirror.packages_checksum and mirror.packages_checksum == checksum:
+            text = 'Mirror Packages checksum has not changed, skipping Package refresh'
+            warning_message(text=text)
+            return
+        else:
+            mirror.packages_checksum = checksum
+            mirror.save()
+
+        try:
+            sync_mirror_packages(mirror, iter_yum_packages(data, url))
+        except (ElementTree.ParseError, *EXTRACT_ERRORS) as e:
+            error_message(text=f'Error parsing yum primary.xml from {url}: {e}')
 
 
 def refresh_yum_repo(mirror, data, mirror_url, errata_only):
@@ -14,15 +14,69 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_save, pre_save
 from django.dispatch import receiver
 
-from repos.models import Mirror
+from packages.models import Package
+from repos.models import Mirror, MirrorPackage, Repository
+from repos.utils import (
+    MIRROR_SYNC_BATCH_SIZE, add_mirror_latest_package, record_repo_changes,
+    update_mirror_latest_packages,
+)
+from util.counters import register_count, update_counts
+
+register_count(Mirror, 'packages_count', 'packages')
 
 
 @receiver(m2m_changed, sender=Mirror.packages.through)
 def update_mirror_packages_count(sender, instance, action, **kwargs):
     """Update packages_count when Mirror.packages M2M changes."""
     if action in ('post_add', 'post_remove', 'post_clear'):
-        instance.packages_count = instance.packages.count()
-        instance.save(update_fields=['packages_count'])
+        update_counts(instance, 'packages_count')
+
+
+@receiver(post_save, sender=MirrorPackage)
+def update_mirror_latest_package(sender, instance, raw=False, **kwargs):
+    """Update the latest Package index when a package is added to a Mirror."""
+    if not raw:
+        add_mirror_latest_package(instance.mirror, instance.package)
+
+
+@receiver(m2m_changed, sender=Mirror.packages.through)
+def update_mirror_latest_packages_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    """Update the latest Package index when Mirror.packages M2M changes."""
+    if action in ('post_add', 'post_remove'):
+        if not pk_set:
+            return
+        if reverse:
+            for mirror in Mirror.objects.filter(id__in=pk_set, latest_packages_indexed=True):
+                update_mirror_latest_packages(mirror, [instance.name.name])
+        elif instance.latest_packages_indexed:
+            package_ids = list(pk_set)
+            names = set()
+            for i in range(0, len(package_ids), MIRROR_SYNC_BATCH_SIZE):
+                names.update(Package.objects.filter(
+                    id__in=package_ids[i:i + MIRROR_SYNC_BATCH_SIZE]).values_list('name__name', flat=True))
+            update_mirror_latest_packages(instance, names)
+    elif action == 'post_clear':
+        if reverse:
+            return
+        if instance.latest_packages_indexed:
+            update_mirror_latest_packages(instance)
+
+
+@receiver(pre_save, sender=Repository)
+def track_repo_security_change(sender, instance, raw=False, **kwargs):
+    """Track whether a Repository is marked as a security repo before save."""
+    instance._old_security = None
+    if instance.pk and not raw:
+        instance._old_security = Repository.objects.filter(pk=instance.pk).values_list(
+            'security', flat=True).first()
+
+
+@receiver(post_save, sender=Repository)
+def record_repo_security_change(sender, instance, created, raw=False, **kwargs):
+    """Record a change of the mirrors of a Repository when its security flag changes."""
+    old_security = getattr(instance, '_old_security', None)
+    if not created and not raw and old_security is not None and old_security != instance.security:
+        record_repo_changes([instance])
@@ -14,11 +14,21 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import gzip
+
+from defusedxml import ElementTree
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from arch.models import MachineArchitecture, PackageArchitecture
-from packages.models import Package, PackageName
-from repos.models import Mirror, MirrorPackage, Repository
+from packages.models import Package, PackageName, PackageString
+from repos.models import Mirror, MirrorLatestPackage, MirrorPackage, Repository
+from repos.repo_types.yum import iter_yum_packages
+from repos.utils import (
+    get_refresh_jobs, refresh_repos_concurrently, sync_mirror_packages,
+    update_mirror_latest_packages, update_mirror_packages,
+)
 
 
 @override_settings(
@@ -96,6 +106,80 @@ class MirrorPackageTests(TestCase):
         self.assertEqual(self.mirror.packages.count(), 1)
 
 
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class MirrorLatestPackageTests(TestCase):
+    """Tests for the latest Package index of mirrors."""
+
+    def setUp(self):
+        """Set up test data."""
+        machine_arch = MachineArchitecture.objects.create(name='x86_64')
+        PackageArchitecture.objects.create(name='x86_64')
+        repo = Repository.objects.create(name='test-repo', arch=machine_arch, repotype=Repository.RPM)
+        self.mirror = Mirror.objects.create(repo=repo, url='http://mirror.example.com/repo')
+
+    def get_packagestrings(self, *versions):
+        """Return PackageStrings for httpd with the given versions."""
+        return {
+            PackageString(name='httpd', epoch='', version=version, release='1.el9',
+                          arch='x86_64', packagetype=Package.RPM)
+            for version in versions
+        }
+
+    def get_latest_versions(self):
+        """Return the versions in the latest Package index of the mirror."""
+        latest = MirrorLatestPackage.objects.filter(mirror=self.mirror)
+        return sorted(latest.values_list('package__version', flat=True))
+
+    def test_update_mirror_packages_builds_index(self):
+        """Test update_mirror_packages builds and updates the index."""
+        update_mirror_packages(self.mirror, self.get_packagestrings('2.4.1', '2.4.10'))
+        self.mirror.refresh_from_db()
+        self.assertTrue(self.mirror.latest_packages_indexed)
+        self.assertEqual(self.get_latest_versions(), ['2.4.10'])
+
+        update_mirror_packages(self.mirror, self.get_packagestrings('2.4.1', '2.4.9'))
+        self.assertEqual(self.get_latest_versions(), ['2.4.9'])
+
+    def test_mirror_package_added_updates_index(self):
+        """Test adding a MirrorPackage directly updates the index."""
+        update_mirror_packages(self.mirror, self.get_packagestrings('2.4.1'))
+        newer = Package.objects.create(
+            name=PackageName.objects.get(name='httpd'),
+            arch=PackageArchitecture.objects.get(name='x86_64'),
+            epoch='', version='2.4.2', release='1.el9', packagetype=Package.RPM,
+        )
+        MirrorPackage.objects.create(mirror=self.mirror, package=newer)
+        self.assertEqual(self.get_latest_versions(), ['2.4.2'])
+
+    def test_mirror_packages_m2m_add_updates_index_once(self):
+        """Test adding many packages to a mirror updates the index with a fixed number of queries."""
+        update_mirror_packages(self.mirror, self.get_packagestrings('2.4.1'))
+        name = PackageName.objects.get(name='httpd')
+        arch = PackageArchitecture.objects.get(name='x86_64')
+        query_counts = []
+        for versions in (['2.4.2', '2.4.3'], [f'2.4.{i}' for i in range(4, 24)]):
+            packages = [
+                Package.objects.create(
+                    name=name, arch=arch, epoch='', version=version, release='1.el9', packagetype=Package.RPM)
+                for version in versions
+            ]
+            with CaptureQueriesContext(connection) as queries:
+                self.mirror.packages.add(*packages)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(self.get_latest_versions(), ['2.4.23'])
+
+    def test_update_mirror_latest_packages_in_batches(self):
+        """Test the index is rebuilt for the given names in batches."""
+        update_mirror_packages(self.mirror, self.get_packagestrings('2.4.1'))
+        MirrorLatestPackage.objects.all().delete()
+        update_mirror_latest_packages(self.mirror, ['httpd', 'nginx', 'curl'], batch_size=1)
+        self.assertEqual(self.get_latest_versions(), ['2.4.1'])
+
+
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
     CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
@@ -139,3 +223,135 @@ class MirrorModelTests(TestCase):
     def test_mirror_str(self):
         """Test mirror string representation."""
         self.assertIn(self.mirror.url, str(self.mirror))
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class YumPrimarySyncTests(TestCase):
+    """Tests for streaming yum primary.xml into a mirror."""
+
+    def setUp(self):
+        """Set up test data."""
+        machine_arch = MachineArchitecture.objects.create(name='x86_64')
+        repo = Repository.objects.create(name='test-repo', arch=machine_arch, repotype=Repository.RPM)
+        self.mirror = Mirror.objects.create(repo=repo, url='http://mirror.example.com/repo')
+
+    def get_primary_xml(self, *packages, truncate=False):
+        """Return a gzipped primary.xml for (name, epoch, version) tuples."""
+        xml = '<?xml version="1.0" encoding="UTF-8"?>\n'
+        xml += '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+        xml += f'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{len(packages)}">\n'
+        for name, epoch, version in packages:
+            xml += f'<package type="rpm"><name>{name}</name><arch>x86_64</arch>'
+            xml += f'<version epoch="{epoch}" ver="{version}" rel="1.el9"/></package>\n'
+        xml += '</metadata>\n'
+        if truncate:
+            xml = xml[:-len('</metadata>\n')]
+        return gzip.compress(xml.encode())
+
+    def get_mirror_packages(self):
+        """Return the (name, epoch, version) of the packages in the mirror."""
+        return sorted(self.mirror.packages.values_list('name__name', 'epoch', 'version'))
+
+    def test_iter_yum_packages(self):
+        """Test iter_yum_packages yields normalized package keys."""
+        data = self.get_primary_xml(('Bash', '0', '5.1'), ('perl', '4', '5.32'))
+        self.assertEqual(list(iter_yum_packages(data, 'primary.xml.gz')), [
+            ('bash', '', '5.1', '1.el9', 'x86_64', Package.RPM, None),
+            ('perl', '4', '5.32', '1.el9', 'x86_64', Package.RPM, None),
+        ])
+
+    def test_sync_mirror_packages_in_batches(self):
+        """Test sync_mirror_packages adds and removes packages in batches."""
+        packages = [(f'pkg{i}', '0', '1.0') for i in range(5)]
+        data = self.get_primary_xml(*packages)
+        sync_mirror_packages(self.mirror, iter_yum_packages(data, 'primary.xml.gz'), batch_size=2)
+        self.assertEqual(self.get_mirror_packages(), [(name, '', '1.0') for name, _, _ in packages])
+
+        data = self.get_primary_xml(('pkg0', '0', '1.0'), ('pkg1', '0', '1.1'), ('pkg1', '0', '1.1'))
+        sync_mirror_packages(self.mirror, iter_yum_packages(data, 'primary.xml.gz'), batch_size=2)
+        self.assertEqual(self.get_mirror_packages(), [('pkg0', '', '1.0'), ('pkg1', '', '1.1')])
+        self.mirror.refresh_from_db()
+        self.assertEqual(self.mirror.packages_count, 2)
+        self.assertEqual(MirrorLatestPackage.objects.filter(mirror=self.mirror).count(), 2)
+
+    def test_sync_mirror_packages_parse_error(self):
+        """Test a corrupt primary.xml adds the packages parsed but removes none."""
+        sync_mirror_packages(self.mirror, iter_yum_packages(
+            self.get_primary_xml(('bash', '0', '5.1')), 'primary.xml.gz'))
+        data = self.get_primary_xml(('perl', '0', '5.32'), ('curl', '0', '7.76'), truncate=True)
+        with self.assertRaises(ElementTree.ParseError):
+            sync_mirror_packages(self.mirror, iter_yum_packages(data, 'primary.xml.gz'), batch_size=1)
+        self.assertEqual(self.get_mirror_packages(), [('bash', '', '5.1'), ('curl', '', '7.76'), ('perl', '', '5.32')])
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class UpdateMirrorPackagesTests(TestCase):
+    """Tests for syncing a mirror from a set of PackageStrings."""
+
+    def setUp(self):
+        """Set up test data."""
+        machine_arch = MachineArchitecture.objects.create(name='x86_64')
+        repo = Repository.objects.create(name='test-repo', arch=machine_arch, repotype=Repository.GENTOO)
+        self.mirror = Mirror.objects.create(repo=repo, url='http://mirror.example.com/repo')
+
+    def get_packagestring(self, name, version, category=None, epoch=''):
+        """Return a gentoo PackageString."""
+        return PackageString(name=name, epoch=epoch, version=version, release='', arch='x86_64',
+                             packagetype=Package.GENTOO, category=category)
+
+    def test_update_mirror_packages(self):
+        """Test packages are added, kept and removed using natural keys."""
+        update_mirror_packages(self.mirror, {
+            self.get_packagestring('bash', '5.1', 'app-shells'),
+            self.get_packagestring('curl', '7.76', 'net-misc', epoch='0'),
+        })
+        bash = Package.objects.get(name__name='bash')
+        update_mirror_packages(self.mirror, {
+            self.get_packagestring('bash', '5.1', 'app-shells'),
+            self.get_packagestring('curl', '7.77', 'net-misc'),
+        })
+        self.assertEqual(sorted(self.mirror.packages.values_list('name__name', 'version')),
+                         [('bash', '5.1'), ('curl', '7.77')])
+        self.assertEqual(Package.objects.get(name__name='bash'), bash)
+        self.assertEqual(Package.objects.get(version='7.76').epoch, '')
+
+    def test_update_mirror_packages_recategorized(self):
+        """Test a package without a category is reused rather than added twice."""
+        update_mirror_packages(self.mirror, {self.get_packagestring('bash', '5.1')})
+        update_mirror_packages(self.mirror, {self.get_packagestring('bash', '5.1', 'app-shells')})
+        self.assertEqual(MirrorPackage.objects.filter(mirror=self.mirror).count(), 1)
+        self.assertEqual(Package.objects.get().category.name, 'app-shells')
+
+    def test_update_mirror_packages_empty(self):
+        """Test an empty set of packages removes all packages of the mirror."""
+        update_mirror_packages(self.mirror, {self.get_packagestring('bash', '5.1', 'app-shells')})
+        update_mirror_packages(self.mirror, set())
+        self.assertEqual(self.mirror.packages.count(), 0)
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class RefreshReposTests(TestCase):
+    """Tests for refreshing multiple repositories."""
+
+    def setUp(self):
+        """Set up test data."""
+        machine_arch = MachineArchitecture.objects.create(name='x86_64')
+        for name in ('repo-a', 'repo-b'):
+            Repository.objects.create(name=name, arch=machine_arch, repotype=Repository.RPM, auth_required=True)
+
+    def test_refresh_repos_concurrently_timings(self):
+        """Test each repo is refreshed and timed, in one process with SQLite."""
+        repos = Repository.objects.all()
+        self.assertEqual(get_refresh_jobs(4), 1)
+        timings = refresh_repos_concurrently(repos, 4)
+        self.assertEqual(sorted(name for name, _ in timings), sorted(str(repo) for repo in repos))
+        self.assertTrue(all(seconds >= 0 for _, seconds in timings))
@@ -15,26 +15,36 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import concurrent.futures
+import multiprocessing
 import re
+import time
+from collections import defaultdict
 from io import BytesIO
+from itertools import islice
+from operator import itemgetter
 
 from defusedxml import ElementTree
-from django.db import IntegrityError
-from django.db.models import Q
+from django.db import IntegrityError, connection, connections
+from django.db.models import Min, Q
 from tenacity import RetryError
 
-from packages.models import Package
-from packages.utils import (
-    convert_package_to_packagestring, convert_packagestring_to_package,
-)
+from packages.models import Package, PackageName
+from packages.utils import get_or_create_packages, normalize_package_key
 from patchman.signals import pbar_start, pbar_update
 from util import (
-    Checksum, extract, fetch_content, get_checksum, get_setting_of_type,
-    get_url, response_is_valid,
+    Checksum, extract, fetch_content, get_checksum, get_datetime_now,
+    get_setting_of_type, get_url, response_is_valid,
 )
+from util.cache import get_cached
+from util.counters import update_counts
 from util.logging import (
     debug_message, error_message, info_message, warning_message,
 )
+from util.metadata_cache import fetch_url_cached, fetch_url_cached_stream
+
+# number of package keys that sync_mirror_packages() processes at once
+MIRROR_SYNC_BATCH_SIZE = 1000
 
 
 def get_or_create_repo(r_name, r_arch, r_type, r_id=None):
@@ -53,43 +63,278 @@ def get_or_create_repo(r_name, r_arch, r_type, r_id=None):
         return repository
 
 
+def get_repo_by_repo_id(repo_id):
+    """ Get a Repository by its repo_id, using the ingestion cache if active.
+        Returns None if no Repository has that repo_id.
+    """
+    from repos.models import Repository
+
+    def fetch():
+        try:
+            return Repository.objects.get(repo_id=repo_id)
+        except Repository.DoesNotExist:
+            return None
+
+    return get_cached('repository', repo_id, fetch)
+
+
 def update_mirror_packages(mirror, packages):
-    """ Updates the packages contained on a mirror, and
-        removes obsolete packages.
+    """ Updates the packages contained on a mirror from a set of
+        PackageStrings, and removes obsolete packages.
     """
-    from repos.models import MirrorPackage  # noqa
+    package_keys = {
+        normalize_package_key(p.name, p.epoch, p.version, p.release, p.arch, p.packagetype, p.category)
+        for p in packages
+    }
+    sync_mirror_packages(mirror, package_keys, allow_empty=True)
 
-    old = set()
-    mirror_packages = mirror.packages.all()
-    plen = mirror_packages.count()
-    pbar_start.send(sender=None, ptext=f'Fetching {plen} existing Packages', plen=plen)
-    for i, package in enumerate(mirror_packages):
-        pbar_update.send(sender=None, index=i + 1)
-        strpackage = convert_package_to_packagestring(package)
-        old.add(strpackage)
 
-    removals = old.difference(packages)
-    rlen = len(removals)
-    pbar_start.send(sender=None, ptext=f'Removing {rlen} obsolete Packages', plen=rlen)
-    for i, strpackage in enumerate(removals):
-        pbar_update.send(sender=None, index=i + 1)
-        package = convert_packagestring_to_package(strpackage)
-        MirrorPackage.objects.filter(mirror=mirror, package=package).delete()
+def mirror_packages_changed(mirror, names):
+    """ Records that the packages with the given names were added to or
+        removed from a mirror, and updates its cached count and its latest
+        Package index
+    """
+    if not names:
+        if not mirror.latest_packages_indexed:
+            update_mirror_latest_packages(mirror)
+        return
+    mirror.packages_updated = get_datetime_now()
+    mirror.save(update_fields=['packages_updated'])
+    update_counts(mirror, 'packages_count')
+    names = list(names)
+    name_ids = []
+    for i in range(0, len(names), MIRROR_SYNC_BATCH_SIZE):
+        name_ids.extend(PackageName.objects.filter(
+            name__in=names[i:i + MIRROR_SYNC_BATCH_SIZE]).values_list('id', flat=True))
+    record_mirror_package_changes([mirror], mirror.packages_updated, name_ids)
+    if not mirror.latest_packages_indexed:
+        update_mirror_latest_packages(mirror)
+    else:
+        update_mirror_latest_packages(mirror, names)
+
+
+def get_mirror_package_keys(mirror):
+    """ Returns a dict mapping the natural key (see normalize_package_key) of
+        each package in a mirror to its Package id, fetched with one query
+    """
+    from repos.models import MirrorPackage
+
+    rows = MirrorPackage.objects.filter(mirror=mirror).values_list(
+        'package__name__name', 'package__epoch', 'package__version', 'package__release',
+        'package__arch__name', 'package__packagetype', 'package__category__name', 'package_id')
+    package_keys = {}
+    for name, epoch, version, release, arch, p_type, category, package_id in rows.iterator():
+        package_keys[normalize_package_key(name, epoch, version, release, arch, p_type, category)] = package_id
+    return package_keys
+
+
+def sync_mirror_packages(mirror, package_keys, batch_size=MIRROR_SYNC_BATCH_SIZE, allow_empty=False):
+    """ Updates the packages contained on a mirror from an iterable of
+        package keys (see normalize_package_key), and removes obsolete
+        packages. The keys are consumed in batches of batch_size, so they can
+        be streamed from a parser. For each batch, the packages that are not
+        in the mirror yet are resolved or created in bulk and added with one
+        bulk insert. Packages that were not seen are removed once all keys
+        have been consumed, so an error while reading the keys never removes
+        packages. If no keys are seen at all, no packages are removed unless
+        allow_empty is True.
+    """
+    from repos.models import MirrorPackage
+
+    existing = get_mirror_package_keys(mirror)
+    existing_ids = set(existing.values())
+    seen_ids = set()
+    names = set()
+    package_keys = iter(package_keys)
+    try:
+        while True:
+            batch = [key for key in islice(package_keys, batch_size) if key is not None]
+            if not batch:
+                break
+            new_keys = {key for key in batch if key not in existing}
+            seen_ids.update(existing[key] for key in batch if key in existing)
+            if not new_keys:
+                continue
+            mirror_packages = []
+            for key, package_id in get_or_create_packages(new_keys).items():
+                if package_id in existing_ids:
+                    # an existing package that was recategorized
+                    seen_ids.add(package_id)
+                elif package_id not in seen_ids:
+                    seen_ids.add(package_id)
+                    names.add(key[0])
+                    mirror_packages.append(MirrorPackage(mirror=mirror, package_id=package_id))
+            MirrorPackage.objects.bulk_create(mirror_packages, batch_size=batch_size)
+
+        if seen_ids or allow_empty:
+            removals = [(key, package_id) for key, package_id in existing.items() if package_id not in seen_ids]
+            rlen = len(removals)
+            pbar_start.send(sender=None, ptext=f'Removing {rlen} obsolete Packages', plen=rlen)
+            for i in range(0, rlen, batch_size):
+                batch = removals[i:i + batch_size]
+                MirrorPackage.objects.filter(
+                    mirror=mirror, package_id__in=[package_id for _, package_id in batch]).delete()
+                names.update(key[0] for key, _ in batch)
+                pbar_update.send(sender=None, index=i + len(batch))
+    finally:
+        mirror_packages_changed(mirror, names)
+
+
+def record_mirror_package_changes(mirrors, ts, name_ids=None):
+    """ Records that the packages with the given PackageName ids were added
+        to or removed from the mirrors at ts. If name_ids is None, records
+        that any of the packages of the mirrors may have changed.
+    """
+    from repos.models import MirrorPackageChange
+
+    if name_ids is None:
+        name_ids = [None]
+    changes = [
+        MirrorPackageChange(mirror=mirror, name_id=name_id, changed_at=ts)
+        for mirror in mirrors for name_id in name_ids
+    ]
+    MirrorPackageChange.objects.bulk_create(changes, batch_size=500)
+
+
+def record_repo_changes(repos):
+    """ Records that any of the packages of the mirrors of repos may have
+        changed, e.g. because whether they are security repos changed
+    """
+    from repos.models import Mirror
+
+    ts = get_datetime_now()
+    mirrors = Mirror.objects.filter(repo__in=repos)
+    mirrors.update(packages_updated=ts)
+    record_mirror_package_changes(mirrors, ts)
+
+
+def record_package_changes(package_ids, batch_size=1000):
+    """ Records that the packages with package_ids changed in every mirror
+        that contains them, e.g. because they were added to an erratum
+    """
+    from repos.models import MirrorPackage, MirrorPackageChange
+
+    ts = get_datetime_now()
+    package_ids = list(package_ids)
+    for i in range(0, len(package_ids), batch_size):
+        mirror_names = MirrorPackage.objects.filter(
+            package_id__in=package_ids[i:i + batch_size],
+        ).values_list('mirror_id', 'package__name_id').distinct()
+        MirrorPackageChange.objects.bulk_create(
+            [MirrorPackageChange(mirror_id=mirror_id, name_id=name_id, changed_at=ts)
+             for mirror_id, name_id in mirror_names],
+            batch_size=500,
+        )
+
+
+def clean_mirror_package_changes():
+    """ Removes the recorded mirror package changes that are older than the
+        last time that updates were found for every host
+    """
+    from hosts.models import Host
+    from repos.models import MirrorPackageChange
+
+    ts = Host.objects.aggregate(Min('updated_at'))['updated_at__min']
+    if ts is None:
+        return
+    MirrorPackageChange.objects.filter(changed_at__lt=ts).delete()
+
+
+def get_latest_packages(packages):
+    """ Given an iterable of Packages, returns a dict of the highest version
+        Package for each (name, arch, packagetype, category)
+    """
+    latest = {}
+    for package in packages:
+        key = (package.name_id, package.arch_id, package.packagetype, package.category_id)
+        current = latest.get(key)
+        if current is None or current.compare_version(package) == -1:
+            latest[key] = package
+    return latest
+
+
+def update_mirror_latest_packages(mirror, names=None, batch_size=MIRROR_SYNC_BATCH_SIZE):
+    """ Rebuilds the index of the highest version Package for each name,
+        arch, packagetype and category in a mirror. If names is given, only
+        the entries for those package names are rebuilt, in batches of
+        batch_size names, and the mirror is not marked as indexed.
+    """
+    if names is not None:
+        names = list(names)
+        for i in range(0, len(names), batch_size):
+            _update_mirror_latest_packages(mirror, names[i:i + batch_size])
+        return
+    _update_mirror_latest_packages(mirror)
+    if not mirror.latest_packages_indexed:
+        mirror.latest_packages_indexed = True
+        mirror.save(update_fields=['latest_packages_indexed'])
+
 
-    new = packages.difference(old)
-    nlen = len(new)
-    pbar_start.send(sender=None, ptext=f'Adding {nlen} new Packages', plen=nlen)
-    for i, strpackage in enumerate(new):
+def _update_mirror_latest_packages(mirror, names=None):
+    """ Rebuilds the latest Package index entries of a mirror for the given
+        package names, or for all of its packages
+    """
+    from repos.models import MirrorLatestPackage
+
+    packages = Package.objects.filter(mirror=mirror).order_by()
+    indexed = MirrorLatestPackage.objects.filter(mirror=mirror)
+    if names is not None:
+        packages = packages.filter(name__name__in=names)
+        indexed = indexed.filter(package__name__name__in=names)
+    latest = get_latest_packages(packages.only(
+        'id', 'name', 'epoch', 'version', 'release', 'arch', 'packagetype', 'category'))
+    latest_ids = {package.id for package in latest.values()}
+    indexed_ids = set(indexed.values_list('package_id', flat=True))
+
+    stale_ids = list(indexed_ids - latest_ids)
+    for i in range(0, len(stale_ids), 500):
+        MirrorLatestPackage.objects.filter(mirror=mirror, package_id__in=stale_ids[i:i + 500]).delete()
+    new_ids = latest_ids - indexed_ids
+    MirrorLatestPackage.objects.bulk_create(
+        [MirrorLatestPackage(mirror=mirror, package_id=package_id) for package_id in new_ids],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+def add_mirror_latest_package(mirror, package):
+    """ Updates the latest Package index of a mirror after a single package
+        has been added to it
+    """
+    from repos.models import MirrorLatestPackage
+
+    indexed = MirrorLatestPackage.objects.filter(
+        mirror=mirror,
+        package__name=package.name_id,
+        package__arch=package.arch_id,
+        package__packagetype=package.packagetype,
+        package__category=package.category_id,
+    ).select_related('package')
+    for latest in indexed:
+        if latest.package.compare_version(package) != -1:
+            return
+    indexed.delete()
+    MirrorLatestPackage.objects.get_or_create(mirror=mirror, package=package)
+
+
+def index_mirror_latest_packages():
+    """ Builds the latest Package index for mirrors that have not been indexed
+    """
+    from repos.models import Mirror
+
+    mirrors = Mirror.objects.filter(latest_packages_indexed=False)
+    mlen = mirrors.count()
+    if mlen == 0:
+        return
+    pbar_start.send(sender=None, ptext=f'Indexing latest Packages for {mlen} Mirrors', plen=mlen)
+    for i, mirror in enumerate(mirrors):
         pbar_update.send(sender=None, index=i + 1)
-        try:
-            package = convert_packagestring_to_package(strpackage)
-            mirror_package, c = MirrorPackage.objects.get_or_create(mirror=mirror, package=package)
-        except Package.MultipleObjectsReturned:
-            error_message(text=f'Duplicate Package found in {mirror}: {strpackage}')
+        update_mirror_latest_packages(mirror)
 
 
 def find_mirror_url(stored_mirror_url, formats):
-    """ Find the actual URL of the mirror by trying predefined paths
+    """ Find the actual URL of the mirror by trying predefined paths.
+        Returns the closed response of the first path found, or None
     """
     for fmt in formats:
         mirror_url = stored_mirror_url
@@ -102,8 +347,10 @@ def find_mirror_url(stored_mirror_url, formats):
             res = get_url(mirror_url)
         except RetryError:
             continue
-        if res is not None and res.ok:
-            return res
+        if res is not None:
+            res.close()
+            if res.ok:
+                return res
 
 
 def is_metalink(url):
@@ -122,6 +369,7 @@ def get_metalink_urls(url):
     if not response_is_valid(res):
         return
     if not res.headers.get('content-type') == 'application/metalink+xml':
+        res.close()
         return
     metalink_urls = []
     data = fetch_content(res, 'Fetching metalink data')
@@ -223,13 +471,24 @@ def check_for_metalinks(repo):
             add_mirrors_from_urls(repo, mirror_urls)
 
 
-def fetch_mirror_data(mirror, url, text, checksum=None, checksum_type=None, metadata_type=None):
+def fetch_mirror_data(mirror, url, text, checksum=None, checksum_type=None, metadata_type=None, stream=False):
+    """ Fetch metadata from a mirror and verify its checksum if one is given.
+        If stream is True, the metadata is returned as a file object that is
+        spooled to disk if large, and the checksum is computed while
+        downloading it, rather than holding it all in memory.
+        Returns None if the metadata cannot be fetched or is invalid
+    """
     if not url:
         mirror.fail()
         return
 
+    verify = checksum and checksum_type and metadata_type
     try:
-        res = get_url(url)
+        if stream:
+            res, data, computed_checksum = fetch_url_cached_stream(
+                url, text, Checksum[checksum_type] if verify else None)
+        else:
+            res, data = fetch_url_cached(url, text)
     except RetryError:
         mirror.fail()
         return
@@ -240,13 +499,15 @@ def fetch_mirror_data(mirror, url, text, checksum=None, checksum_type=None, meta
     mirror.last_access_ok = True
     mirror.save()
 
-    data = fetch_content(res, text)
     if not data:
         return
 
-    if checksum and checksum_type and metadata_type:
-        computed_checksum = get_checksum(data, Checksum[checksum_type])
+    if verify:
+        if not stream:
+            computed_checksum = get_checksum(data, Checksum[checksum_type])
         if not mirror_checksum_is_valid(computed_checksum, checksum, mirror, metadata_type):
+            if stream:
+                data.close()
             mirror.fail()
             return
     return data
@@ -272,10 +533,51 @@ def find_best_repo(package, hostrepos):
     """ Given a package and a set of HostRepos, determine the best
         repo. Returns the best repo.
     """
-    best_repo = None
     package_repos = hostrepos.filter(repo__mirror__packages=package).select_related('repo').distinct()
+    return select_best_repo(list(package_repos))
 
-    package_repos = list(package_repos)
+
+def get_best_repo_resolver(hostrepos, packages):
+    """ Returns a function that, given a Package, returns the best HostRepo
+        in hostrepos that contains it, as find_best_repo() does. The
+        HostRepos of every Package in packages are loaded with one query when
+        the function is first called, and the best repo of each Package is
+        cached, so no further queries are made.
+    """
+    from repos.models import MirrorPackage
+
+    hostrepo_list = []
+    package_hostrepo_ids = defaultdict(set)
+    best_repos = {}
+    loaded = []
+
+    def load():
+        loaded.append(True)
+        hostrepo_list.extend(sorted(hostrepos.distinct(), key=lambda hr: (hr.repo.name, hr.id)))
+        mirror_packages = MirrorPackage.objects.filter(
+            mirror__repo__hostrepo__in=[hr.id for hr in hostrepo_list],
+            package__in=packages,
+        )
+        for package_id, hostrepo_id in mirror_packages.values_list('package_id', 'mirror__repo__hostrepo'):
+            package_hostrepo_ids[package_id].add(hostrepo_id)
+
+    def get_best_repo(package):
+        if not loaded:
+            load()
+        if package.id not in best_repos:
+            hostrepo_ids = package_hostrepo_ids.get(package.id, ())
+            best_repos[package.id] = select_best_repo([hr for hr in hostrepo_list if hr.id in hostrepo_ids])
+        return best_repos[package.id]
+
+    return get_best_repo
+
+
+def select_best_repo(package_repos):
+    """ Given an ordered list of HostRepos that contain a package, determine
+        the best repo. Security repos are preferred, then higher priorities.
+        Returns the best repo.
+    """
+    best_repo = None
     if package_repos:
         best_repo = package_repos[0]
     if len(package_repos) > 1:
@@ -299,6 +601,80 @@ def get_max_mirrors():
     return max_mirrors
 
 
+def get_refresh_jobs(jobs):
+    """ Returns the number of worker processes to use to refresh repos.
+        SQLite only supports a single writer, so a single process is used.
+    """
+    if jobs > 1 and connection.vendor == 'sqlite':
+        warning_message(text='SQLite only supports a single writer, refreshing Repositories in a single process')
+        return 1
+    return max(jobs, 1)
+
+
+def _init_refresh_worker():
+    """ Ensure that a worker process opens its own database connections
+    """
+    connections.close_all()
+
+
+def refresh_repo_timed(repo_id, force=False):
+    """ Refresh the metadata of a repo and time it
+        Returns a tuple of (repo name, seconds taken)
+    """
+    from repos.models import Repository
+
+    repo = Repository.objects.get(id=repo_id)
+    start = time.monotonic()
+    info_message(text=f'Repository {repo.id} : {repo}')
+    repo.refresh(force)
+    info_message(text='')
+    return str(repo), time.monotonic() - start
+
+
+def refresh_repos_concurrently(repos, jobs, force=False):
+    """ Refresh the metadata of repos using a pool of worker processes.
+        Each repo is refreshed by a single worker, which refreshes its mirrors
+        one after another, so writes to a mirror are never concurrent.
+        Workers that add the same new Package wait for each other, see
+        get_or_create_packages().
+        Returns a list of (repo name, seconds taken)
+    """
+    repo_ids = [repo.id for repo in repos]
+    jobs = get_refresh_jobs(jobs)
+    timings = []
+    if jobs == 1:
+        for repo_id in repo_ids:
+            timings.append(refresh_repo_timed(repo_id, force))
+    else:
+        rlen = len(repo_ids)
+        pbar_start.send(sender=None, ptext=f'Refreshing {rlen} Repositories using {jobs} processes', plen=rlen)
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, mp_context=context, initializer=_init_refresh_worker) as executor:
+            futures = [executor.submit(refresh_repo_timed, repo_id, force) for repo_id in repo_ids]
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                try:
+                    timings.append(future.result())
+                except Exception as e:
+                    error_message(text=f'Error refreshing Repository: {e}')
+                pbar_update.send(sender=None, index=i + 1)
+    show_repo_refresh_timings(timings)
+    return timings
+
+
+def show_repo_refresh_timings(timings, slowest=5):
+    """ Print a summary of the time taken to refresh each repo
+    """
+    if not timings:
+        return
+    total = sum(seconds for _, seconds in timings)
+    info_message(text=f'Refreshed {len(timings)} Repositories in {total:.2f}s of processing time, '
+                      f'{total / len(timings):.2f}s per Repository')
+    for name, seconds in sorted(timings, key=itemgetter(1), reverse=True)[:slowest]:
+        info_message(text=f'  {name} : {seconds:.2f}s')
+
+
 def clean_repos():
     """ Remove repositories that contain no mirrors
     """
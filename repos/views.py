@@ -39,6 +39,7 @@ from repos.serializers import (
 )
 from repos.tables import MirrorTable, RepositoryTable
 from repos.tasks import refresh_repo
+from repos.utils import record_repo_changes
 from util import sanitize_filter_params
 from util.filterspecs import Filter, FilterBar
 
@@ -481,9 +482,11 @@ def repo_bulk_action(request):
         repos.update(enabled=False)
         messages.success(request, f'Disabled {count} {name}')
     elif action == 'mark_security':
+        record_repo_changes(repos.filter(security=False))
         repos.update(security=True)
         messages.success(request, f'Marked {count} {name} as security')
     elif action == 'mark_non_security':
+        record_repo_changes(repos.filter(security=True))
         repos.update(security=False)
         messages.success(request, f'Marked {count} {name} as non-security')
     elif action == 'refresh':
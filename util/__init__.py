@@ -16,11 +16,13 @@
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
 import bz2
+import gzip
 import lzma
 import os
+import tempfile
+import threading
 import zlib
 
-import magic
 import requests
 
 try:
@@ -32,16 +34,20 @@ except ImportError:
 from datetime import datetime, timezone
 from enum import Enum
 from hashlib import md5, sha1, sha256, sha512
+from io import BytesIO
 from time import time
 from urllib.parse import parse_qs, urlencode
 
 from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import make_aware
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, HTTPError, Timeout
 from tenacity import (
     retry, retry_if_exception_type, stop_after_attempt, wait_exponential,
 )
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
 
 from util.logging import (
     create_pbar, debug_message, error_message, info_message, quiet_mode,
@@ -52,6 +58,11 @@ pbar = None
 verbose = not quiet_mode
 Checksum = Enum('Checksum', 'md5 sha sha1 sha256 sha512')
 
+# size of the chunks that request content is read in
+CONTENT_CHUNK_SIZE = 65536
+# size above which fetch_stream() writes the request content to disk
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
 http_proxy = os.getenv('http_proxy')
 https_proxy = os.getenv('https_proxy')
 proxies = {
@@ -59,6 +70,114 @@ proxies = {
    'https': https_proxy,
 }
 
+# the retry policy of http requests, the session itself does not retry
+http_retry = retry(
+    retry=retry_if_exception_type((HTTPError, Timeout, ConnectionResetError)),
+    stop=stop_after_attempt(4),
+    wait=wait_exponential(multiplier=1, min=1, max=10),
+    reraise=False,
+)
+
+# the http session of each thread, as sessions are not thread-safe
+sessions = threading.local()
+connection_counts = {'opened': 0, 'requested': 0}
+connection_counts_lock = threading.Lock()
+
+
+def count_connection(name):
+    """ Increment a http connection counter of this process
+    """
+    with connection_counts_lock:
+        connection_counts[name] += 1
+
+
+class CountingConnectionPoolMixin:
+    """ Counts the connections a connection pool hands out for requests and
+        how many of them it had to open
+    """
+
+    def _get_conn(self, timeout=None):
+        count_connection('requested')
+        return super()._get_conn(timeout)
+
+    def _new_conn(self):
+        count_connection('opened')
+        return super()._new_conn()
+
+
+class CountingHTTPConnectionPool(CountingConnectionPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(CountingConnectionPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+counting_pool_classes = {
+    'http': CountingHTTPConnectionPool,
+    'https': CountingHTTPSConnectionPool,
+}
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """ A http adapter whose per-host connection pools count the connections
+        they open and reuse
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = counting_pool_classes
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = counting_pool_classes
+        return manager
+
+
+def get_session():
+    """ Returns the http session of this thread, creating it if needed.
+        The session keeps connections alive in a connection pool per host,
+        so that consecutive requests to a host reuse its connections.
+        HTTP_POOL_CONNECTIONS sets the number of hosts to keep pools for and
+        HTTP_POOL_MAXSIZE the number of connections to keep per host.
+        A forked process creates its own session rather than sharing the
+        connections of its parent.
+    """
+    session = getattr(sessions, 'session', None)
+    if session is None or sessions.pid != os.getpid():
+        adapter = PooledHTTPAdapter(
+            pool_connections=get_setting_of_type('HTTP_POOL_CONNECTIONS', int, 10),
+            pool_maxsize=get_setting_of_type('HTTP_POOL_MAXSIZE', int, 10),
+            max_retries=0,
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.proxies.update({scheme: proxy for scheme, proxy in proxies.items() if proxy})
+        sessions.session = session
+        sessions.pid = os.getpid()
+    return session
+
+
+def get_connection_counts():
+    """ Returns the number of http connections opened and reused by this
+        process
+    """
+    with connection_counts_lock:
+        opened = connection_counts['opened']
+        requested = connection_counts['requested']
+    return {'opened': opened, 'reused': requested - opened}
+
+
+def show_connection_counts():
+    """ Print the number of http connections opened and reused by this
+        process, if any were used
+    """
+    counts = get_connection_counts()
+    if counts['opened']:
+        info_message(text=f'HTTP connections opened: {counts["opened"]}, reused: {counts["reused"]}')
+
 
 def sanitize_filter_params(filter_params):
     """Sanitize filter_params to prevent query string injection."""
@@ -68,41 +187,72 @@ def sanitize_filter_params(filter_params):
     return urlencode(parsed, doseq=True)
 
 
-def fetch_content(response, text='', ljust=35):
-    """ Display a progress bar to fetch the request content if verbose is
-        True. Otherwise, just return the request content
+def iter_content(response, text='', ljust=35):
+    """ Yields the chunks of the request content, displaying a progress bar
+        if verbose is True
     """
-    if not response:
-        return
+    clen = None
     if verbose:
         content_length = response.headers.get('content-length')
         if content_length:
             clen = int(content_length)
             create_pbar(text, clen, ljust)
-            chunk_size = 16384
-            i = 0
-            data = b''
-            for chunk in response.iter_content(chunk_size=chunk_size, decode_unicode=False):
-                i += len(chunk)
-                if i > clen:
-                    update_pbar(clen)
-                else:
-                    update_pbar(i)
-                data += chunk
-            return data
         else:
             info_message(text=text)
+    i = 0
+    for chunk in response.iter_content(chunk_size=CONTENT_CHUNK_SIZE, decode_unicode=False):
+        i += len(chunk)
+        if clen:
+            update_pbar(min(i, clen))
+        yield chunk
+
+
+def fetch_content(response, text='', ljust=35):
+    """ Display a progress bar to fetch the request content if verbose is
+        True. Otherwise, just return the request content
+    """
+    if not response:
+        return
+    if verbose and response.headers.get('content-length'):
+        return b''.join(iter_content(response, text, ljust))
+    if verbose:
+        info_message(text=text)
     return response.content
 
 
-@retry(
-    retry=retry_if_exception_type((HTTPError, Timeout, ConnectionResetError)),
-    stop=stop_after_attempt(4),
-    wait=wait_exponential(multiplier=1, min=1, max=10),
-    reraise=False,
-)
+def fetch_stream(response, text='', checksum_type=None, ljust=35):
+    """ Fetch the request content into a temporary file, which is only written
+        to disk once it is larger than SPOOL_MAX_SIZE, and compute its checksum
+        in the same pass. Returns a tuple of the file object, positioned at its
+        start, and the checksum, or None if no checksum_type is given
+    """
+    hasher = get_hasher(checksum_type) if checksum_type else None
+    fileobj = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for chunk in iter_content(response, text, ljust):
+        if hasher:
+            hasher.update(chunk)
+        fileobj.write(chunk)
+    fileobj.seek(0)
+    return fileobj, hasher.hexdigest() if hasher else None
+
+
+def get_stream_checksum(fileobj, checksum_type):
+    """ Returns the checksum of the contents of a file object, reading it in
+        chunks, and rewinds the file object
+    """
+    hasher = get_hasher(checksum_type)
+    while chunk := fileobj.read(CONTENT_CHUNK_SIZE):
+        hasher.update(chunk)
+    fileobj.seek(0)
+    return hasher.hexdigest()
+
+
+@http_retry
 def get_url(url, headers=None, params=None):
     """ Perform a http GET on a URL. Return None on error.
+        The content of the response is streamed, so callers that do not read
+        it must close the response to release its connection. The content of
+        403 and 404 responses is read, so their connections are released.
     """
     response = None
     if not headers:
@@ -111,11 +261,16 @@ def get_url(url, headers=None, params=None):
         params = {}
     try:
         debug_message(text=f'Trying {url} headers:{headers} params:{params}')
-        response = requests.get(url, headers=headers, params=params, stream=True, proxies=proxies, timeout=30)
+        response = get_session().get(url, headers=headers, params=params, stream=True, timeout=30)
         debug_message(text=f'{response.status_code}: {response.headers}')
         if response.status_code in [403, 404]:
+            response.content
             return response
-        response.raise_for_status()
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            response.close()
+            raise
     except requests.exceptions.TooManyRedirects:
         error_message(text=f'Too many redirects - {url}')
     except ConnectionError:
@@ -199,29 +354,130 @@ def unzstd(contents):
         error_message(text=f'zstd: {e}')
 
 
-def extract(data, fmt):
-    """ Extract the contents based on mimetype or file ending. Return the
-        unmodified data if neither mimetype nor file ending matches, otherwise
-        return the extracted contents.
+REQUEST_CONTENT_ENCODINGS = ('gzip', 'x-gzip', 'zstd')
+
+
+def decompress_request_body(request):
+    """ Decompress a gzip or zstd encoded request body in place, so that
+        request.POST or the DRF request.data are parsed from the decompressed
+        body. The decompressed size is limited by DATA_UPLOAD_MAX_MEMORY_SIZE.
+        Raises ValueError for unsupported encodings or corrupt bodies.
     """
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+    if encoding in ('', 'identity'):
+        return
+    if encoding not in REQUEST_CONTENT_ENCODINGS:
+        raise ValueError(f'Unsupported Content-Encoding: {encoding}')
+    if encoding == 'zstd':
+        reader = zstd.ZstdDecompressor().stream_reader(BytesIO(request.body))
+    else:
+        reader = gzip.GzipFile(fileobj=BytesIO(request.body))
+    max_size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+    chunks = []
+    size = 0
     try:
-        mime = magic.from_buffer(data, mime=True)
-    except AttributeError:
-        # old python-magic API
-        m = magic.open(magic.MAGIC_MIME)
-        m.load()
-        mime = m.buffer(data).split(';')[0]
-    if mime == 'application/zstd' or fmt.endswith('zst'):
+        while chunk := reader.read(65536):
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise RequestDataTooBig('Decompressed request body exceeded DATA_UPLOAD_MAX_MEMORY_SIZE.')
+            chunks.append(chunk)
+    except (OSError, EOFError, zlib.error, zstd.ZstdError) as e:
+        raise ValueError(f'Invalid {encoding} request body: {e}')
+    body = b''.join(chunks)
+    request._body = body
+    request._stream = BytesIO(body)
+    request.META['CONTENT_LENGTH'] = str(len(body))
+    del request.META['HTTP_CONTENT_ENCODING']
+
+
+# errors that can be raised while reading from extract_stream()
+EXTRACT_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError, zstd.ZstdError)
+
+
+# leading bytes of the compression formats that extract() and
+# extract_stream() recognize
+COMPRESSION_MAGIC = (
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'BZh', 'bz2'),
+    (b'\x1f\x8b', 'gzip'),
+)
+
+
+def get_compression(header, fmt):
+    """ Returns the compression format of data from its leading bytes, or
+        from the file ending fmt if the leading bytes are not recognized.
+        Returns None if the data is not compressed.
+    """
+    for magic_bytes, compression in COMPRESSION_MAGIC:
+        if header.startswith(magic_bytes):
+            return compression
+    if fmt.endswith('zst'):
+        return 'zstd'
+    elif fmt.endswith('xz'):
+        return 'xz'
+    elif fmt.endswith('bz2'):
+        return 'bz2'
+    elif fmt.endswith('gz'):
+        return 'gzip'
+
+
+def extract_stream(data, fmt):
+    """ Returns a file object that incrementally extracts the contents of
+        data, which can be bytes or a seekable file object, based on its
+        leading bytes or file ending, so that the extracted contents are
+        never held in memory at once. If neither matches, the file object
+        reads the unmodified data. Reading from the file object can raise any
+        of EXTRACT_ERRORS if the data is corrupt.
+    """
+    if isinstance(data, bytes):
+        fileobj = BytesIO(data)
+    else:
+        fileobj = data
+    compression = get_compression(fileobj.read(8), fmt)
+    fileobj.seek(0)
+    if compression == 'zstd':
+        return zstd.ZstdDecompressor().stream_reader(fileobj)
+    elif compression == 'xz':
+        return lzma.LZMAFile(fileobj)
+    elif compression == 'bz2':
+        return bz2.BZ2File(fileobj)
+    elif compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj)
+    return fileobj
+
+
+def extract(data, fmt):
+    """ Extract the contents based on their leading bytes or file ending.
+        Return the unmodified data if neither matches, otherwise return the
+        extracted contents.
+    """
+    compression = get_compression(data[:8], fmt)
+    if compression == 'zstd':
         return unzstd(data)
-    if mime == 'application/x-xz' or fmt.endswith('xz'):
+    elif compression == 'xz':
         return unxz(data)
-    elif mime == 'application/x-bzip2' or fmt.endswith('bz2'):
+    elif compression == 'bz2':
         return bunzip2(data)
-    elif mime == 'application/gzip' or fmt.endswith('gz'):
+    elif compression == 'gzip':
         return gunzip(data)
     return data
 
 
+def get_hasher(checksum_type):
+    """ Returns a new hash object for the checksum type
+    """
+    if checksum_type == Checksum.sha or checksum_type == Checksum.sha1:
+        return sha1()
+    elif checksum_type == Checksum.sha256:
+        return sha256()
+    elif checksum_type == Checksum.sha512:
+        return sha512()
+    elif checksum_type == Checksum.md5:
+        return md5()
+    raise ValueError(f'Unknown checksum type: {checksum_type}')
+
+
 def get_checksum(data, checksum_type):
     """ Returns the checksum of the data. Returns None otherwise.
     """
@@ -19,3 +19,6 @@ from django.apps import AppConfig
 
 class UtilConfig(AppConfig):
     name = 'util'
+
+    def ready(self):
+        import util.signals  # noqa
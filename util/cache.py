@@ -0,0 +1,143 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from util import get_setting_of_type
+
+_MISSING = object()
+_state = threading.local()
+
+
+class LRUCache:
+    """ A small bounded least-recently-used cache
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+
+def get_ingestion_cache_size():
+    """ Find the max number of entries per ingestion lookup cache
+    """
+    return get_setting_of_type(
+        setting_name='INGESTION_CACHE_SIZE',
+        setting_type=int,
+        default=4096,
+    )
+
+
+def get_ingestion_caches():
+    """ Returns the dict of lookup caches for the active ingestion context,
+        or None if no ingestion context is active in this thread
+    """
+    return getattr(_state, 'caches', None)
+
+
+@contextmanager
+def ingestion_cache(maxsize=None):
+    """ Context manager that enables bounded in-process lookup caches for
+        small dimension tables (architectures, package names, repositories)
+        while reports are ingested. Nested contexts share the outermost caches.
+        The caches are emptied when the outermost context exits, so that
+        changes made by other processes are seen by the next context. Keep
+        contexts short, e.g. one per task or batch of reports, as signals
+        only invalidate the caches of the process making the change.
+    """
+    if get_ingestion_caches() is not None:
+        yield get_ingestion_caches()
+        return
+    _state.caches = {}
+    _state.maxsize = maxsize or get_ingestion_cache_size()
+    try:
+        yield _state.caches
+    finally:
+        for cache in _state.caches.values():
+            cache.clear()
+        _state.caches = None
+
+
+def get_cached(cache_name, key, fetch):
+    """ Returns the value for key from the named ingestion cache, calling
+        fetch() and caching the result on a miss. Calls fetch() directly if
+        no ingestion context is active.
+    """
+    caches = get_ingestion_caches()
+    if caches is None:
+        return fetch()
+    cache = caches.get(cache_name)
+    if cache is None:
+        cache = caches[cache_name] = LRUCache(_state.maxsize)
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = fetch()
+        cache.set(key, value)
+    return value
+
+
+def set_cached(cache_name, key, value):
+    """ Stores a value in the named ingestion cache, if one is active
+    """
+    caches = get_ingestion_caches()
+    if caches is None:
+        return
+    cache = caches.get(cache_name)
+    if cache is None:
+        cache = caches[cache_name] = LRUCache(_state.maxsize)
+    cache.set(key, value)
+
+
+def invalidate_cached(cache_name, key=_MISSING):
+    """ Removes key from the named ingestion cache, or clears the whole cache
+        if no key is given
+    """
+    caches = get_ingestion_caches()
+    if caches is None or cache_name not in caches:
+        return
+    if key is _MISSING:
+        caches[cache_name].clear()
+    else:
+        caches[cache_name].invalidate(key)
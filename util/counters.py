@@ -0,0 +1,132 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+import os
+import threading
+from contextlib import contextmanager
+
+from django.db.models import Count, Q
+
+from util.logging import info_message
+
+_counts = {}
+_state = threading.local()
+
+
+def register_count(model, field, relation, **filters):
+    """ Register a cached count field of a model, which holds the number of
+        objects in the given m2m relation that match filters
+    """
+    _counts.setdefault(model, {})[field] = (relation, filters)
+
+
+def get_registered_counts():
+    """ Returns a dict mapping each model with cached count fields to a dict
+        of field name to (relation, filters)
+    """
+    return _counts
+
+
+def _reset_dirty_counts():
+    """ Discard the deferred_counts context inherited by a forked child
+        process, as only the parent flushes it. Changes made in the child are
+        recounted as they are made, or when a context of its own exits.
+    """
+    _state.dirty = None
+
+
+os.register_at_fork(after_in_child=_reset_dirty_counts)
+
+
+def get_dirty_counts():
+    """ Returns the dict of instances with stale cached counts for the active
+        deferred_counts context, or None if no context is active in this thread
+    """
+    return getattr(_state, 'dirty', None)
+
+
+def recount(instance, fields):
+    """ Recount the given cached count fields of instance and save them
+    """
+    counts = _counts[type(instance)]
+    for field in fields:
+        relation, filters = counts[field]
+        setattr(instance, field, getattr(instance, relation).filter(**filters).count())
+    instance.save(update_fields=list(fields))
+
+
+def update_counts(instance, *fields):
+    """ Update cached count fields of instance after one of its relations
+        changed. If a deferred_counts context is active, the fields are only
+        marked as dirty and are recounted once when the context exits.
+    """
+    dirty = get_dirty_counts()
+    if dirty is None:
+        recount(instance, fields)
+        return
+    key = (type(instance), instance.pk)
+    if key in dirty:
+        dirty[key][1].update(fields)
+    else:
+        dirty[key] = (instance, set(fields))
+
+
+def flush_counts():
+    """ Recount all dirty cached count fields of the active deferred_counts
+        context, once per instance
+    """
+    dirty = get_dirty_counts()
+    while dirty:
+        key = next(iter(dirty))
+        instance, fields = dirty.pop(key)
+        recount(instance, sorted(fields))
+
+
+@contextmanager
+def deferred_counts():
+    """ Context manager that suspends the per-change recounting of cached
+        count fields. Changed instances are recorded and their counts are
+        recounted once when the context exits. Nested contexts share the
+        outermost context. Forked child processes do not inherit the context.
+    """
+    if get_dirty_counts() is not None:
+        yield
+        return
+    _state.dirty = {}
+    try:
+        yield
+    finally:
+        try:
+            flush_counts()
+        finally:
+            _state.dirty = None
+
+
+def rebuild_counts(models=None):
+    """ Recount every cached count field of all instances of the given
+        models, or of all models with registered counts
+    """
+    for model, counts in _counts.items():
+        if models is not None and model not in models:
+            continue
+        for field, (relation, filters) in counts.items():
+            q = None
+            if filters:
+                q = Q(**{f'{relation}__{name}': value for name, value in filters.items()})
+            rows = model.objects.annotate(count=Count(relation, filter=q)).values_list('pk', 'count', field)
+            changed = [model(pk=pk, **{field: count}) for pk, count, current in rows if count != current]
+            model.objects.bulk_update(changed, [field], batch_size=500)
+            info_message(text=f'{model._meta.verbose_name_plural} {field}: {len(changed)} updated')
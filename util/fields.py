@@ -0,0 +1,79 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+from base64 import b64decode, b64encode
+
+from django.db import models
+
+from util import get_setting_of_type, zstd
+
+COMPRESSED_PREFIX = 'zstd:'
+
+
+def compress_text(value):
+    """ Returns the zstd compressed, base64 encoded form of value, prefixed
+        with COMPRESSED_PREFIX. Returns value unchanged if it is empty or if
+        compression would not make it smaller. Values that start with
+        COMPRESSED_PREFIX are always compressed, so that they are not mistaken
+        for compressed values when they are read back.
+    """
+    if not value:
+        return value
+    compressed = COMPRESSED_PREFIX + b64encode(zstd.compress(value.encode('utf-8'))).decode('ascii')
+    if len(compressed) < len(value) or value.startswith(COMPRESSED_PREFIX):
+        return compressed
+    return value
+
+
+def decompress_text(value):
+    """ Returns the decompressed form of a value stored by compress_text.
+        Values that were stored uncompressed, or that cannot be decompressed,
+        are returned unchanged.
+    """
+    if not value or not value.startswith(COMPRESSED_PREFIX):
+        return value
+    try:
+        return zstd.decompress(b64decode(value[len(COMPRESSED_PREFIX):], validate=True)).decode('utf-8')
+    except (ValueError, zstd.ZstdError):
+        return value
+
+
+def is_compression_enabled():
+    """ Returns True if large text payloads should be stored compressed
+    """
+    return get_setting_of_type(
+        setting_name='COMPRESS_REPORTS',
+        setting_type=bool,
+        default=True,
+    )
+
+
+class CompressedTextField(models.TextField):
+    """ A TextField that is stored zstd compressed in the database and is
+        transparently decompressed when loaded. Uncompressed values that were
+        stored before compression was enabled are read unchanged. Values that
+        start with COMPRESSED_PREFIX are compressed even if compression is
+        disabled, so they read back as stored.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        return decompress_text(value)
+
+    def get_db_prep_save(self, value, connection):
+        value = super().get_db_prep_save(value, connection)
+        if isinstance(value, str) and (is_compression_enabled() or value.startswith(COMPRESSED_PREFIX)):
+            value = compress_text(value)
+        return value
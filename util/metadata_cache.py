@@ -0,0 +1,283 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+import json
+import os
+import shutil
+import tempfile
+from hashlib import sha256
+
+from util import (
+    fetch_content, fetch_stream, get_setting_of_type, get_stream_checksum,
+    get_url, response_is_valid,
+)
+from util.logging import debug_message, warning_message
+
+bypass = False
+
+
+def get_metadata_cache_bypass():
+    """ Get the global metadata cache bypass
+    """
+    return bypass
+
+
+def set_metadata_cache_bypass(value):
+    """ Set the global metadata cache bypass. If True, cached metadata is
+        ignored and always downloaded again, but the cache is still updated
+    """
+    global bypass
+    bypass = value
+
+
+def get_metadata_cache_dir():
+    """ Returns the directory of the metadata cache, or None if the
+        metadata cache is disabled
+    """
+    return get_setting_of_type(
+        setting_name='METADATA_CACHE_DIR',
+        setting_type=str,
+        default=None,
+    )
+
+
+def get_metadata_cache_size():
+    """ Returns the maximum size of the metadata cache in bytes
+    """
+    return get_setting_of_type(
+        setting_name='METADATA_CACHE_SIZE',
+        setting_type=int,
+        default=1024 * 1024 * 1024,
+    )
+
+
+def get_cache_path(cache_dir, url):
+    """ Returns the path of a url in the metadata cache, without a file
+        ending. Its validators are stored in a .json file, which names the
+        .data file that holds its content
+    """
+    return os.path.join(cache_dir, sha256(url.encode()).hexdigest())
+
+
+def get_data_filename(url, etag, last_modified):
+    """ Returns the name of the file that holds the content of a url for the
+        given validators, so that the validators can never be paired with
+        the content of other validators
+    """
+    validators = sha256(f'{etag}\n{last_modified}'.encode()).hexdigest()[:16]
+    return f'{sha256(url.encode()).hexdigest()}.{validators}.data'
+
+
+def get_cached_headers(cache_dir, url):
+    """ Returns the stored validators of a url in the metadata cache,
+        or None if the url is not cached
+    """
+    try:
+        with open(f'{get_cache_path(cache_dir, url)}.json') as f:
+            headers = json.load(f)
+    except (OSError, ValueError):
+        return
+    if headers.get('url') != url or not headers.get('data'):
+        return
+    if not os.path.exists(os.path.join(cache_dir, headers['data'])):
+        return
+    return headers
+
+
+def open_cached_content(cache_dir, url):
+    """ Returns a file object to read the content of a url from the metadata
+        cache, and marks it as recently used. Returns None if the url is not
+        cached
+    """
+    headers = get_cached_headers(cache_dir, url)
+    if headers is None:
+        return
+    data_path = os.path.join(cache_dir, headers['data'])
+    try:
+        fileobj = open(data_path, 'rb')
+        os.utime(data_path)
+    except OSError:
+        return
+    return fileobj
+
+
+def get_cached_content(cache_dir, url):
+    """ Returns the content of a url from the metadata cache, and marks it as
+        recently used. Returns None if the url is not cached
+    """
+    fileobj = open_cached_content(cache_dir, url)
+    if fileobj is None:
+        return
+    with fileobj:
+        return fileobj.read()
+
+
+def get_conditional_headers(cached_headers):
+    """ Returns the request headers to only fetch a url if it has changed
+        since it was cached
+    """
+    headers = {}
+    if cached_headers:
+        if cached_headers.get('etag'):
+            headers['If-None-Match'] = cached_headers['etag']
+        if cached_headers.get('last_modified'):
+            headers['If-Modified-Since'] = cached_headers['last_modified']
+    return headers
+
+
+def _write_file(path, data, mode):
+    """ Atomically write data, which can be bytes, a string or a file object,
+        to a file, so that concurrent readers never see a partially written
+        file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, f)
+                data.seek(0)
+            else:
+                f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def store_cached_content(cache_dir, url, response, data):
+    """ Store the content of a url, as bytes or a file object, and its ETag
+        and Last-Modified validators in the metadata cache. Responses without
+        validators are not stored. The content is written before the
+        validators that name it, so a crash or a concurrent writer can never
+        pair validators with other content
+    """
+    etag = response.headers.get('etag')
+    last_modified = response.headers.get('last-modified')
+    if not etag and not last_modified:
+        return
+    old_headers = get_cached_headers(cache_dir, url)
+    data_filename = get_data_filename(url, etag, last_modified)
+    headers = {'url': url, 'etag': etag, 'last_modified': last_modified, 'data': data_filename}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _write_file(os.path.join(cache_dir, data_filename), data, 'wb')
+        _write_file(f'{get_cache_path(cache_dir, url)}.json', json.dumps(headers), 'w')
+    except OSError as e:
+        warning_message(text=f'Unable to write to metadata cache {cache_dir}: {e}')
+        return
+    if old_headers and old_headers['data'] != data_filename:
+        try:
+            os.unlink(os.path.join(cache_dir, old_headers['data']))
+        except FileNotFoundError:
+            pass
+    evict_cached_content(cache_dir, get_metadata_cache_size())
+
+
+def evict_cached_content(cache_dir, max_size):
+    """ Remove the least recently used content from the metadata cache until
+        it is no larger than max_size bytes
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith('.data'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, data_path in sorted(entries):
+        if size <= max_size:
+            break
+        headers_path = os.path.join(cache_dir, f'{os.path.basename(data_path).split(".")[0]}.json')
+        try:
+            with open(headers_path) as f:
+                if json.load(f).get('data') == os.path.basename(data_path):
+                    os.unlink(headers_path)
+        except (OSError, ValueError):
+            pass
+        try:
+            os.unlink(data_path)
+        except FileNotFoundError:
+            pass
+        size -= entry_size
+        debug_message(text=f'Evicted {data_path} from metadata cache')
+
+
+def get_url_conditional(cache_dir, url):
+    """ Perform a http GET on a url, conditional on the ETag and Last-Modified
+        of its copy in the metadata cache, if there is one.
+        Returns a tuple of (response, not modified), where not modified is
+        True if the cached copy is still current
+    """
+    cached_headers = None
+    if cache_dir and not bypass:
+        cached_headers = get_cached_headers(cache_dir, url)
+    res = get_url(url, headers=get_conditional_headers(cached_headers))
+    not_modified = bool(cached_headers) and res is not None and res.status_code == 304
+    if not_modified:
+        # read the empty body, so that the connection is released
+        res.content
+        debug_message(text=f'{url} has not been modified, using cached content')
+    return res, not_modified
+
+
+def fetch_url_cached(url, text=''):
+    """ Fetch the content of a url, using the metadata cache if
+        METADATA_CACHE_DIR is set. If a cached copy exists, the request is
+        conditional on its ETag and Last-Modified, and on 304 Not Modified the
+        cached content is returned without downloading it again.
+        Returns a tuple of (response, content). The content is None if the
+        response is not valid
+    """
+    cache_dir = get_metadata_cache_dir()
+    res, not_modified = get_url_conditional(cache_dir, url)
+    if not_modified:
+        data = get_cached_content(cache_dir, url)
+        if data is not None:
+            return res, data
+        res = get_url(url)
+    if not response_is_valid(res):
+        return res, None
+    data = fetch_content(res, text)
+    if cache_dir and data:
+        store_cached_content(cache_dir, url, res, data)
+    return res, data
+
+
+def fetch_url_cached_stream(url, text='', checksum_type=None):
+    """ Fetch the content of a url like fetch_url_cached(), but return it as
+        a file object rather than holding it in memory, and compute its
+        checksum in the same pass as downloading it (see fetch_stream).
+        Returns a tuple of (response, file object, checksum). The file object
+        and checksum are None if the response is not valid. The checksum is
+        None if no checksum_type is given
+    """
+    cache_dir = get_metadata_cache_dir()
+    res, not_modified = get_url_conditional(cache_dir, url)
+    if not_modified:
+        fileobj = open_cached_content(cache_dir, url)
+        if fileobj is not None:
+            checksum = get_stream_checksum(fileobj, checksum_type) if checksum_type else None
+            return res, fileobj, checksum
+        res = get_url(url)
+    if not response_is_valid(res):
+        return res, None, None
+    fileobj, checksum = fetch_stream(res, text, checksum_type)
+    if cache_dir:
+        store_cached_content(cache_dir, url, res, fileobj)
+    return res, fileobj, checksum
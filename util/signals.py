@@ -0,0 +1,53 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from arch.models import MachineArchitecture, PackageArchitecture
+from packages.models import PackageName
+from repos.models import Repository
+from util.cache import invalidate_cached
+
+NAME_CACHES = {
+    MachineArchitecture: 'machinearchitecture',
+    PackageArchitecture: 'packagearchitecture',
+    PackageName: 'packagename',
+}
+
+
+@receiver(post_save, sender=MachineArchitecture)
+@receiver(post_save, sender=PackageArchitecture)
+@receiver(post_save, sender=PackageName)
+def invalidate_name_cache_on_save(sender, instance, created, **kwargs):
+    """Invalidate the ingestion cache when an existing name is changed."""
+    if not created:
+        invalidate_cached(NAME_CACHES[sender])
+
+
+@receiver(post_delete, sender=MachineArchitecture)
+@receiver(post_delete, sender=PackageArchitecture)
+@receiver(post_delete, sender=PackageName)
+def invalidate_name_cache_on_delete(sender, instance, **kwargs):
+    """Invalidate the ingestion cache entry for a deleted name."""
+    invalidate_cached(NAME_CACHES[sender], instance.name)
+
+
+@receiver(post_save, sender=Repository)
+@receiver(post_delete, sender=Repository)
+def invalidate_repository_cache(sender, instance, **kwargs):
+    """Invalidate cached repo_id lookups when a Repository changes."""
+    invalidate_cached('repository')
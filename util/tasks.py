@@ -21,7 +21,9 @@ from modules.utils import clean_modules
 from packages.utils import (
     clean_packagenames, clean_packages, clean_packageupdates,
 )
-from repos.utils import clean_repos, remove_mirror_trailing_slashes
+from repos.utils import (
+    clean_repos, index_mirror_latest_packages, remove_mirror_trailing_slashes,
+)
 
 
 @shared_task(priority=1)
@@ -35,5 +37,6 @@ def clean_database(remove_duplicate_packages=False):
     clean_architectures()
     clean_repos()
     remove_mirror_trailing_slashes()
+    index_mirror_latest_packages()
     clean_modules()
     clean_packageupdates()
@@ -0,0 +1,115 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+from django.test import TestCase, override_settings
+
+from arch.models import MachineArchitecture, PackageArchitecture
+from arch.utils import get_or_create_machine_arch, get_or_create_package_arch
+from repos.models import Repository
+from repos.utils import get_repo_by_repo_id
+from util.cache import (
+    LRUCache, get_cached, get_ingestion_caches, ingestion_cache,
+)
+
+
+class LRUCacheTests(TestCase):
+    """Tests for the LRUCache class."""
+
+    def test_evicts_least_recently_used(self):
+        """Test the least recently used entry is evicted when full."""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        """Test invalidate() removes a single entry."""
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class IngestionCacheTests(TestCase):
+    """Tests for the ingestion lookup caches."""
+
+    def test_no_context_calls_fetch(self):
+        """Test get_cached() always fetches outside an ingestion context."""
+        calls = []
+        get_cached('test', 'key', lambda: calls.append(1))
+        get_cached('test', 'key', lambda: calls.append(1))
+        self.assertEqual(len(calls), 2)
+        self.assertIsNone(get_ingestion_caches())
+
+    def test_caches_cleared_on_exit(self):
+        """Test each outermost context, e.g. each task, starts with empty caches."""
+
+        @ingestion_cache()
+        def task():
+            return get_cached('test', 'key', lambda: calls.append(1))
+
+        calls = []
+        with ingestion_cache() as caches:
+            get_cached('test', 'key', lambda: calls.append(1))
+        self.assertEqual(len(caches['test']), 0)
+        task()
+        task()
+        self.assertEqual(len(calls), 3)
+
+    def test_nested_contexts_share_caches(self):
+        """Test nested ingestion contexts reuse the outer caches."""
+        with ingestion_cache() as outer:
+            with ingestion_cache() as inner:
+                self.assertIs(outer, inner)
+            self.assertIs(get_ingestion_caches(), outer)
+        self.assertIsNone(get_ingestion_caches())
+
+    def test_arch_lookups_are_cached(self):
+        """Test repeated arch lookups only query the database once."""
+        with ingestion_cache():
+            arch = get_or_create_package_arch('x86_64')
+            with self.assertNumQueries(0):
+                self.assertEqual(get_or_create_package_arch('x86_64'), arch)
+            march = get_or_create_machine_arch('x86_64')
+            with self.assertNumQueries(0):
+                self.assertEqual(get_or_create_machine_arch('x86_64'), march)
+
+    def test_deleted_arch_is_invalidated(self):
+        """Test deleting a cached arch removes it from the cache."""
+        with ingestion_cache():
+            arch = get_or_create_package_arch('noarch')
+            arch.delete()
+            new_arch = get_or_create_package_arch('noarch')
+            self.assertIsNotNone(new_arch.id)
+            self.assertTrue(PackageArchitecture.objects.filter(id=new_arch.id).exists())
+
+    def test_repository_save_invalidates_repo_id_lookups(self):
+        """Test a missing repo_id is found after a Repository is saved with it."""
+        arch = MachineArchitecture.objects.create(name='x86_64')
+        with ingestion_cache():
+            self.assertIsNone(get_repo_by_repo_id('baseos'))
+            repo = Repository.objects.create(name='BaseOS', arch=arch, repotype=Repository.RPM)
+            repo.repo_id = 'baseos'
+            repo.save()
+            self.assertEqual(get_repo_by_repo_id('baseos'), repo)
@@ -0,0 +1,108 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+import concurrent.futures
+import multiprocessing
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from arch.models import MachineArchitecture, PackageArchitecture
+from domains.models import Domain
+from hosts.models import Host
+from operatingsystems.models import OSRelease, OSVariant
+from packages.models import Package, PackageName, PackageUpdate
+from util.counters import deferred_counts, get_dirty_counts, rebuild_counts
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class DeferredCountsTests(TestCase):
+    """Tests for deferred cached count maintenance."""
+
+    def setUp(self):
+        """Set up test data."""
+        m_arch = MachineArchitecture.objects.create(name='x86_64')
+        self.arch = PackageArchitecture.objects.create(name='x86_64')
+        osrelease = OSRelease.objects.create(name='Rocky Linux 9')
+        osvariant = OSVariant.objects.create(name='Rocky Linux 9 x86_64', osrelease=osrelease, arch=m_arch)
+        self.host = Host.objects.create(
+            hostname='counts.example.com', ipaddress='192.168.1.10', osvariant=osvariant,
+            kernel='5.14.0-362.el9.x86_64', arch=m_arch, domain=Domain.objects.create(name='example.com'),
+            lastreport=timezone.now(),
+        )
+        self.packages = [
+            Package.objects.create(
+                name=PackageName.objects.create(name=f'pkg{i}'), arch=self.arch,
+                epoch='', version='1.0', release='1', packagetype=Package.RPM,
+            ) for i in range(3)
+        ]
+
+    def test_counts_updated_immediately(self):
+        """Test counts are recounted on each change outside a context."""
+        self.host.packages.add(self.packages[0])
+        self.host.refresh_from_db()
+        self.assertEqual(self.host.packages_count, 1)
+
+    def test_counts_deferred_until_exit(self):
+        """Test counts are recounted once when the context exits."""
+        with deferred_counts():
+            for package in self.packages:
+                self.host.packages.add(package)
+            self.host.packages.remove(self.packages[0])
+            self.assertEqual(Host.objects.get(id=self.host.id).packages_count, 0)
+            self.assertEqual(len(get_dirty_counts()), 1)
+            with self.assertNumQueries(0):
+                with deferred_counts():
+                    pass
+        self.assertIsNone(get_dirty_counts())
+        self.assertEqual(Host.objects.get(id=self.host.id).packages_count, 2)
+
+    def test_deferred_counts_decorator(self):
+        """Test deferred_counts can be used as a decorator."""
+        @deferred_counts()
+        def add_packages():
+            self.host.packages.add(*self.packages)
+            return len(get_dirty_counts())
+
+        self.assertEqual(add_packages(), 1)
+        self.assertEqual(Host.objects.get(id=self.host.id).packages_count, 3)
+
+    def test_deferred_counts_not_inherited_by_forked_children(self):
+        """Test forked child processes do not record changes in the parent context."""
+        context = multiprocessing.get_context('fork')
+        with deferred_counts():
+            self.host.packages.add(self.packages[0])
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                self.assertIsNone(executor.submit(get_dirty_counts).result())
+            self.assertEqual(len(get_dirty_counts()), 1)
+        self.host.refresh_from_db()
+        self.assertEqual(self.host.packages_count, 1)
+
+    def test_rebuild_counts(self):
+        """Test rebuild_counts recounts all registered counts in bulk."""
+        update = PackageUpdate.objects.create(
+            oldpackage=self.packages[0], newpackage=self.packages[1], security=True)
+        Host.packages.through.objects.bulk_create(
+            [Host.packages.through(host=self.host, package=package) for package in self.packages])
+        Host.updates.through.objects.create(host=self.host, packageupdate=update)
+        rebuild_counts()
+        self.host.refresh_from_db()
+        self.assertEqual(self.host.packages_count, 3)
+        self.assertEqual(self.host.sec_updates_count, 1)
+        self.assertEqual(self.host.bug_updates_count, 0)
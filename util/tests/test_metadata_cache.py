@@ -0,0 +1,138 @@
+# Copyright 2026 Marcus Furlong <furlongm@gmail.com>
+#
+# This file is part of Patchman.
+#
+# Patchman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 only.
+#
+# Patchman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Patchman. If not, see <http://www.gnu.org/licenses/>
+
+import os
+import tempfile
+from hashlib import sha256
+from unittest.mock import MagicMock, patch
+
+from django.test import TestCase, override_settings
+
+from util import Checksum
+from util.metadata_cache import (
+    evict_cached_content, fetch_url_cached, fetch_url_cached_stream,
+    get_cache_path, get_cached_content, get_cached_headers,
+    set_metadata_cache_bypass, store_cached_content,
+)
+
+URL = 'http://mirror.example.com/repo/repodata/repomd.xml'
+
+
+def get_response(status_code=200, content=b'', headers=None):
+    """Return a mock http response."""
+    response = MagicMock()
+    response.status_code = status_code
+    response.ok = status_code < 400
+    response.content = content
+    response.headers = headers or {}
+    return response
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+)
+class MetadataCacheTests(TestCase):
+    """Tests for the on-disk metadata cache."""
+
+    def setUp(self):
+        """Set up a temporary cache directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(set_metadata_cache_bypass, False)
+        self.settings_override = override_settings(METADATA_CACHE_DIR=self.tmpdir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    @patch('util.metadata_cache.get_url')
+    def test_not_modified_uses_cached_content(self, get_url):
+        """Test a 304 response returns the cached content."""
+        get_url.return_value = get_response(content=b'repomd', headers={'etag': '"abc"'})
+        res, data = fetch_url_cached(URL)
+        self.assertEqual(data, b'repomd')
+        get_url.assert_called_once_with(URL, headers={})
+
+        get_url.reset_mock()
+        get_url.return_value = get_response(status_code=304)
+        res, data = fetch_url_cached(URL)
+        self.assertEqual(data, b'repomd')
+        get_url.assert_called_once_with(URL, headers={'If-None-Match': '"abc"'})
+
+    @patch('util.metadata_cache.get_url')
+    def test_bypass_ignores_cached_content(self, get_url):
+        """Test the bypass sends no conditional headers but updates the cache."""
+        get_url.return_value = get_response(content=b'old', headers={'last-modified': 'Mon, 01 Jan 2024'})
+        fetch_url_cached(URL)
+        set_metadata_cache_bypass(True)
+        get_url.return_value = get_response(content=b'new', headers={'last-modified': 'Tue, 02 Jan 2024'})
+        res, data = fetch_url_cached(URL)
+        self.assertEqual(data, b'new')
+        get_url.assert_called_with(URL, headers={})
+
+        set_metadata_cache_bypass(False)
+        get_url.return_value = get_response(status_code=304)
+        res, data = fetch_url_cached(URL)
+        self.assertEqual(data, b'new')
+        get_url.assert_called_with(URL, headers={'If-Modified-Since': 'Tue, 02 Jan 2024'})
+
+    @patch('util.metadata_cache.get_url')
+    def test_stream_not_modified_uses_cached_file(self, get_url):
+        """Test the stream fetch caches the spooled content and reads it back."""
+        response = get_response(headers={'etag': '"abc"', 'content-length': '6'})
+        response.iter_content.return_value = iter([b'rep', b'omd'])
+        get_url.return_value = response
+        res, fileobj, checksum = fetch_url_cached_stream(URL, checksum_type=Checksum.sha256)
+        with fileobj:
+            self.assertEqual(fileobj.read(), b'repomd')
+        self.assertEqual(checksum, sha256(b'repomd').hexdigest())
+
+        get_url.return_value = get_response(status_code=304)
+        res, fileobj, checksum = fetch_url_cached_stream(URL, checksum_type=Checksum.sha256)
+        with fileobj:
+            self.assertEqual(fileobj.read(), b'repomd')
+        self.assertEqual(checksum, sha256(b'repomd').hexdigest())
+
+    @patch('util.metadata_cache.get_url')
+    def test_response_without_validators_not_cached(self, get_url):
+        """Test responses without ETag or Last-Modified are not cached."""
+        get_url.return_value = get_response(content=b'repomd')
+        fetch_url_cached(URL)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_evict_least_recently_used(self):
+        """Test the least recently used content is evicted first."""
+        urls = [f'{URL}.{i}' for i in range(3)]
+        for i, url in enumerate(urls):
+            store_cached_content(self.tmpdir.name, url, get_response(headers={'etag': f'"{i}"'}), b'x' * 10)
+            headers = get_cached_headers(self.tmpdir.name, url)
+            os.utime(os.path.join(self.tmpdir.name, headers['data']), (i, i))
+        evict_cached_content(self.tmpdir.name, 20)
+        cached = [get_cached_content(self.tmpdir.name, url) is not None for url in urls]
+        self.assertEqual(cached, [False, True, True])
+        self.assertFalse(os.path.exists(f'{get_cache_path(self.tmpdir.name, urls[0])}.json'))
+
+    def test_failed_write_keeps_validators_with_their_content(self):
+        """Test the validators are never paired with other content if a write fails."""
+        store_cached_content(self.tmpdir.name, URL, get_response(headers={'etag': '"old"'}), b'old')
+        with patch('util.metadata_cache.json.dumps', side_effect=OSError):
+            store_cached_content(self.tmpdir.name, URL, get_response(headers={'etag': '"new"'}), b'new')
+        self.assertEqual(get_cached_headers(self.tmpdir.name, URL)['etag'], '"old"')
+        self.assertEqual(get_cached_content(self.tmpdir.name, URL), b'old')
+
+        store_cached_content(self.tmpdir.name, URL, get_response(headers={'etag': '"new"'}), b'new')
+        self.assertEqual(get_cached_headers(self.tmpdir.name, URL)['etag'], '"new"')
+        self.assertEqual(get_cached_content(self.tmpdir.name, URL), b'new')
+        self.assertEqual(len([name for name in os.listdir(self.tmpdir.name) if name.endswith('.data')]), 1)
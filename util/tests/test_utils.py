@@ -14,17 +14,23 @@
 # You should have received a copy of the GNU General Public License
 # along with Patchman. If not, see <http://www.gnu.org/licenses/>
 
+import bz2
 import gzip
 import hashlib
+import lzma
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 from unittest.mock import MagicMock
 
 from django.test import TestCase, override_settings
 
 from util import (
-    Checksum, bunzip2, extract, get_checksum, get_md5, get_sha1, get_sha256,
-    get_sha512, gunzip, has_setting_of_type, is_epoch_time, response_is_valid,
-    sanitize_filter_params, tz_aware_datetime,
+    Checksum, bunzip2, extract, extract_stream, fetch_stream, get_checksum,
+    get_connection_counts, get_md5, get_session, get_sha1, get_sha256,
+    get_sha512, get_stream_checksum, get_url, gunzip, has_setting_of_type,
+    is_epoch_time, response_is_valid, sanitize_filter_params,
+    tz_aware_datetime,
 )
 
 
@@ -144,6 +150,18 @@ class CompressionTests(TestCase):
         result = extract(data, 'unknown')
         self.assertEqual(result, data)
 
+    def test_extract_detects_magic_bytes(self):
+        """Test extract detects the compression from the leading bytes."""
+        original = b'test content'
+        self.assertEqual(extract(bz2.compress(original), 'primary.xml'), original)
+        self.assertEqual(extract(lzma.compress(original), 'Packages'), original)
+
+    def test_extract_stream_file_object(self):
+        """Test extract_stream incrementally extracts a file object."""
+        original = b'test content' * 1000
+        with extract_stream(BytesIO(gzip.compress(original)), 'primary.xml') as f:
+            self.assertEqual(f.read(), original)
+
 
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,
@@ -168,6 +186,57 @@ class URLFetchTests(TestCase):
         """Test response_is_valid with None."""
         self.assertFalse(response_is_valid(None))
 
+    def test_fetch_stream_checksum(self):
+        """Test fetch_stream spools the content and computes its checksum."""
+        chunks = [b'a' * 100, b'b' * 100]
+        response = MagicMock()
+        response.headers = {'content-length': '200'}
+        response.iter_content.return_value = iter(chunks)
+        fileobj, checksum = fetch_stream(response, checksum_type=Checksum.sha256)
+        with fileobj:
+            self.assertEqual(fileobj.read(), b''.join(chunks))
+            fileobj.seek(0)
+            self.assertEqual(get_stream_checksum(fileobj, Checksum.sha256), checksum)
+        self.assertEqual(checksum, hashlib.sha256(b''.join(chunks)).hexdigest())
+
+    def test_get_url_reuses_connections(self):
+        """Test consecutive requests to a host reuse a pooled connection."""
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(404 if self.path == '/missing' else 200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f'http://127.0.0.1:{server.server_port}/repomd.xml'
+
+        self.assertIs(get_session(), get_session())
+        before = get_connection_counts()
+        self.assertEqual(get_url(f'http://127.0.0.1:{server.server_port}/missing').status_code, 404)
+        for _ in range(3):
+            self.assertEqual(get_url(url).content, b'ok')
+        after = get_connection_counts()
+        self.assertEqual(after['opened'] - before['opened'], 1)
+        self.assertEqual(after['reused'] - before['reused'], 3)
+
+    def test_get_session_per_thread(self):
+        """Test each thread uses its own http session."""
+        thread_sessions = []
+        thread = threading.Thread(target=lambda: thread_sessions.append(get_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_sessions[0], get_session())
+
 
 @override_settings(
     CELERY_TASK_ALWAYS_EAGER=True,